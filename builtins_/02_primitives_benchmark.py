@@ -0,0 +1,187 @@
+# coding: utf-8
+
+"""asyncio 基础操作的开销
+ref: https://docs.python.org/zh-cn/3/library/asyncio-eventloop.html
+
+1. task: 创建并等待任务完成的耗时
+
+2. timers: 同时挂起 1万 ~ 100万 个 `asyncio.sleep` 时, 定时器的调度开销
+
+3. gather: 不同扇出数量下 `asyncio.gather` 的耗时
+
+4. queue: `asyncio.Queue` 单生产者单消费者的吞吐量
+
+5. executor: `run_in_executor` 往返线程池的耗时
+
+6. lag: 事件循环中有 CPU 密集任务时, 定时回调的延迟
+
+事件循环通过 `--loop` 指定: `asyncio` 为默认, `uvloop` 需要安装 uvloop,
+也可以传入 `module:PolicyClass` 形式的事件循环策略.
+结果以 JSON 输出, 包含 Python 版本与事件循环信息, 便于对比.
+
+    python 02_primitives_benchmark.py --loop uvloop --output uvloop.json
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import platform
+import statistics
+import sys
+import time
+
+
+async def bench_task(n=100_000):
+    async def noop():
+        pass
+
+    start = time.perf_counter()
+    for _ in range(n):
+        await asyncio.create_task(noop())
+    elapsed = time.perf_counter() - start
+    return {'n': n, 'us_per_task': elapsed / n * 1e6}
+
+
+async def bench_timers(counts=(10_000, 100_000, 1_000_000), delay=0.1):
+    results = []
+    for n in counts:
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(asyncio.sleep(delay)) for _ in range(n)]
+        scheduled = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        results.append({
+            'n': n,
+            'schedule_us_per_timer': (scheduled - start) / n * 1e6,
+            # 超出 delay 的部分即定时器的调度与唤醒开销
+            'overhead_us_per_timer': max(elapsed - delay, 0) / n * 1e6,
+        })
+    return results
+
+
+async def bench_gather(fan_outs=(10, 100, 1000, 10_000), repeat=20):
+    async def noop():
+        pass
+
+    results = []
+    for n in fan_outs:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await asyncio.gather(*(noop() for _ in range(n)))
+        elapsed = (time.perf_counter() - start) / repeat
+        results.append({'fan_out': n, 'ms_per_gather': elapsed * 1e3})
+    return results
+
+
+async def bench_queue(n=200_000, maxsize=1024):
+    queue = asyncio.Queue(maxsize)
+
+    async def producer():
+        for i in range(n):
+            await queue.put(i)
+        await queue.put(None)
+
+    async def consumer():
+        while await queue.get() is not None:
+            pass
+
+    start = time.perf_counter()
+    await asyncio.gather(producer(), consumer())
+    elapsed = time.perf_counter() - start
+    return {'n': n, 'maxsize': maxsize, 'items_per_second': n / elapsed}
+
+
+async def bench_executor(n=10_000):
+    loop = asyncio.get_running_loop()
+    # 预热线程池
+    await loop.run_in_executor(None, int)
+    start = time.perf_counter()
+    for _ in range(n):
+        await loop.run_in_executor(None, int)
+    elapsed = time.perf_counter() - start
+    return {'n': n, 'us_per_round_trip': elapsed / n * 1e6}
+
+
+async def bench_lag(duration=2.0, interval=0.01, busy=(0, 0.001, 0.01)):
+    """每个 interval 检查一次回调实际被调度的延迟, 同时有任务每轮占用 CPU busy 秒"""
+    results = []
+    for busy_seconds in busy:
+        stop = time.perf_counter() + duration
+        lags = []
+
+        async def probe():
+            while time.perf_counter() < stop:
+                expected = time.perf_counter() + interval
+                await asyncio.sleep(interval)
+                lags.append(max(time.perf_counter() - expected, 0))
+
+        async def cpu():
+            while time.perf_counter() < stop:
+                end = time.perf_counter() + busy_seconds
+                while time.perf_counter() < end:
+                    pass
+                await asyncio.sleep(0)
+
+        await asyncio.gather(probe(), cpu())
+        lags.sort()
+        results.append({
+            'busy_ms': busy_seconds * 1e3,
+            'p50_ms': statistics.median(lags) * 1e3,
+            'p99_ms': lags[int(len(lags) * 0.99) - 1] * 1e3,
+            'max_ms': lags[-1] * 1e3,
+        })
+    return results
+
+
+benchmarks = {
+    'task': bench_task,
+    'timers': bench_timers,
+    'gather': bench_gather,
+    'queue': bench_queue,
+    'executor': bench_executor,
+    'lag': bench_lag,
+}
+
+
+def set_loop_policy(name: str) -> str:
+    """设置事件循环策略, 返回实际使用的策略名称"""
+    if name == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif name != 'asyncio':
+        module, _, attr = name.partition(':')
+        asyncio.set_event_loop_policy(getattr(importlib.import_module(module), attr)())
+    policy = asyncio.get_event_loop_policy()
+    return f'{type(policy).__module__}.{type(policy).__qualname__}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--loop', default='asyncio', help='asyncio, uvloop 或 module:PolicyClass')
+    parser.add_argument('--only', nargs='*', choices=list(benchmarks), help='只运行指定的测试')
+    parser.add_argument('--output', help='结果写入的 JSON 文件, 默认输出到标准输出')
+    args = parser.parse_args()
+
+    policy = set_loop_policy(args.loop)
+    results = {
+        'python': sys.version,
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'loop_policy': policy,
+        'results': {},
+    }
+    for name in args.only or benchmarks:
+        print(f'running {name} ...', file=sys.stderr)
+        results['results'][name] = asyncio.run(benchmarks[name]())
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,498 @@
 # created by jlshix on 2021-02-01
 
 """https://fastapi.tiangolo.com/zh/tutorial/path-params/
+
+默认的路由按声明顺序逐个用正则匹配, 因此 `/users/me` 必须在 `/users/{user_id}` 之前声明,
+且匹配耗时随路由数量线性增长.
+
+`RadixRouter` 将路由模板按路径段组织为前缀树, 查找耗时只与路径段数有关:
+
+1. 同一层级先匹配静态段, 再按声明顺序匹配参数段, 最后是 `{param:path}`, 与声明顺序无关
+
+2. 参数段使用路由本身的转换器 (int, float, uuid 等) 的正则判断是否匹配,
+   命中后仍由路由自身的 `matches` 完成类型转换, 因此行为与默认路由一致
+
+3. Mount, Host 等无法放入树中的路由, 未命中时回退到默认的逐个匹配
+
+使用 `use_radix_router(app)` 替换应用的路由.
+
+`/files/{file_path:path}` 从 `FileServer` 的根目录 (环境变量 `C02_FILES_ROOT`) 提供文件, 未设置时一律返回 404:
+
+1. 服务器支持 ASGI 的 `http.response.zerocopysend` 扩展时交由其 `os.sendfile` 发送,
+   否则按块从 mmap 中读出发送, 不会将整个文件读入内存
+
+2. 支持单个 `Range` 区间 (206/416) 与 `If-None-Match` (304), ETag 由 stat 结果生成并短暂缓存,
+   stat 与 open 等可能读盘的调用都在线程池中执行
+
+3. 路径解析后必须位于根目录之内, 否则与文件不存在一样返回 404
+
+`/models/{model_name}` 的每个模型对应 `ModelRegistry` 根目录 (环境变量 `C02_MODELS_ROOT`) 下的 `{name}.npz` 权重文件:
+
+1. 第一次请求时才在线程池中加载, 同一个事件循环中同一个模型的并发请求只加载一次.
+   未设置根目录或没有该模型的权重文件时只返回说明文字, 权重文件损坏时返回 503
+
+2. 已加载的模型总大小超过 memory_budget (环境变量 `C02_MODELS_BUDGET_MB`, 默认 512) 时, 淘汰最久未使用的模型,
+   刚加载的模型本身超出预算时也保留
+
+3. 环境变量 `C02_MODELS_WARMUP` (逗号分隔) 中的模型在 startup 时加载, `/model-registry/` 返回各模型是否已加载,
+   大小及加载耗时
 """
+import asyncio
+import mmap
+import os
+import re
+import socket
+import stat
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from email.utils import formatdate
 from enum import Enum
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Pattern, Tuple
 
+import numpy as np
 import pytest
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.routing import APIRouter
 from fastapi.testclient import TestClient
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import URL
+from starlette.responses import RedirectResponse, Response
+from starlette.routing import BaseRoute, Match, Route, Router, WebSocketRoute, compile_path
+from starlette.types import Receive, Scope, Send
+
+
+class _Node:
+    __slots__ = ('static', 'params', 'catch_all', 'routes')
+
+    def __init__(self):
+        self.static: Dict[str, _Node] = {}
+        self.params: Dict[str, Tuple[Pattern, _Node]] = {}
+        self.catch_all: List[BaseRoute] = []
+        self.routes: List[BaseRoute] = []
+
+
+class RadixTree:
+    """按路径段组织的路由前缀树, `candidates` 按优先级返回可能匹配的路由"""
+
+    def __init__(self, routes: List[BaseRoute]):
+        self.root = _Node()
+        self.unindexed: List[BaseRoute] = []
+        for route in routes:
+            if not self.insert(route):
+                self.unindexed.append(route)
+
+    def insert(self, route: BaseRoute) -> bool:
+        if not isinstance(route, (Route, WebSocketRoute)):
+            return False
+        segments = route.path.split('/')
+        node = self.root
+        for i, segment in enumerate(segments):
+            if '{' not in segment:
+                node = node.static.setdefault(segment, _Node())
+                continue
+            regex, _, convertors = compile_path('/' + segment)
+            if any(c.regex == '.*' for c in convertors.values()):
+                # `{param:path}` 只支持作为最后一段
+                if i != len(segments) - 1 or segment.count('{') != 1 or not segment.startswith('{'):
+                    return False
+                node.catch_all.append(route)
+                return True
+            if segment not in node.params:
+                node.params[segment] = (re.compile(regex.pattern[1:].lstrip('/')), _Node())
+            node = node.params[segment][1]
+        node.routes.append(route)
+        return True
+
+    def candidates(self, path: str) -> Iterator[BaseRoute]:
+        return self._search(self.root, path.split('/'), 0)
+
+    def _search(self, node: _Node, segments: List[str], i: int) -> Iterator[BaseRoute]:
+        if i == len(segments):
+            yield from node.routes
+            return
+        segment = segments[i]
+        child = node.static.get(segment)
+        if child is not None:
+            yield from self._search(child, segments, i + 1)
+        for regex, child in node.params.values():
+            if regex.match(segment):
+                yield from self._search(child, segments, i + 1)
+        yield from node.catch_all
+
+
+class _RouteList(list):
+    """路由列表, 任何修改 (追加, 替换, 删除等) 都会清除缓存的前缀树"""
+
+    tree: Optional[RadixTree] = None
+
+
+def _invalidating(name: str) -> Callable:
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        self.tree = None
+        return method(self, *args)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__iadd__', '__imul__'):
+    setattr(_RouteList, _name, _invalidating(_name))
+
+
+class RadixRouter(APIRouter):
+    """使用前缀树查找路由的 APIRouter, 路由列表被修改或重新赋值后会在下次请求时重建树"""
+
+    @property
+    def routes(self) -> _RouteList:
+        routes = self.__dict__['routes']
+        if not isinstance(routes, _RouteList):
+            routes = self.__dict__['routes'] = _RouteList(routes)
+        return routes
+
+    @routes.setter
+    def routes(self, routes: List[BaseRoute]):
+        self.__dict__['routes'] = _RouteList(routes)
+
+    @property
+    def tree(self) -> RadixTree:
+        routes = self.routes
+        if routes.tree is None:
+            routes.tree = RadixTree(routes)
+        return routes.tree
+
+    def lookup(self, scope: Scope) -> Tuple[Optional[BaseRoute], Match, dict]:
+        partial = None
+        for route in self.tree.candidates(scope['path']):
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return route, match, child_scope
+            if match == Match.PARTIAL and partial is None:
+                partial = route, match, child_scope
+        return partial or (None, Match.NONE, {})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await super().__call__(scope, receive, send)
+            return
+
+        if 'router' not in scope:
+            scope['router'] = self
+        route, match, child_scope = self.lookup(scope)
+        if route is not None and (match == Match.FULL or not self.tree.unindexed):
+            scope.update(child_scope)
+            await route.handle(scope, receive, send)
+            return
+        if self.tree.unindexed:
+            await super().__call__(scope, receive, send)
+            return
+
+        if scope['type'] == 'http' and self.redirect_slashes and scope['path'] != '/':
+            redirect_scope = dict(scope)
+            if scope['path'].endswith('/'):
+                redirect_scope['path'] = redirect_scope['path'].rstrip('/')
+            else:
+                redirect_scope['path'] = redirect_scope['path'] + '/'
+            if self.lookup(redirect_scope)[0] is not None:
+                response = RedirectResponse(url=str(URL(scope=redirect_scope)))
+                await response(scope, receive, send)
+                return
+
+        await self.default(scope, receive, send)
+
+
+def use_radix_router(app: FastAPI) -> RadixRouter:
+    """将应用的路由替换为 RadixRouter, 已注册和之后注册的路由均保留"""
+    app.router.__class__ = RadixRouter
+    return app.router
+
+
+class FileStat(NamedTuple):
+    path: str
+    size: int
+    etag: str
+    last_modified: str
+
+
+class FileRangeResponse(Response):
+    """发送文件 [start, end) 区间的响应, 优先使用 zerocopysend 扩展"""
+
+    def __init__(self, file: FileStat, start: int, end: int, status_code: int, headers: dict,
+                 chunk_size: int = 256 * 1024):
+        self.file = file
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.status_code = status_code
+        self.background = None
+        self.init_headers({**headers, 'content-length': str(end - start)})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        count = self.end - self.start
+        if count == 0:
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        f = await run_in_threadpool(open, self.file.path, 'rb')
+        with f:
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.zerocopysend', 'file': f, 'offset': self.start, 'count': count})
+                return
+            if count <= self.chunk_size:
+                body = await run_in_threadpool(os.pread, f.fileno(), count, self.start)
+                await send({'type': 'http.response.body', 'body': body})
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset in range(self.start, self.end, self.chunk_size):
+                    stop = min(offset + self.chunk_size, self.end)
+                    # 缺页时会读磁盘, 放到线程池中以免阻塞事件循环
+                    chunk = await run_in_threadpool(mm.__getitem__, slice(offset, stop))
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': stop < self.end})
+
+
+class FileServer:
+    """以 root 为根目录提供文件
+
+    路径解析 (realpath) 与 stat 在同一次线程池调用中完成, 结果 (含 ETag) 按请求的路径缓存 stat_ttl 秒,
+    最多 max_cache 项
+    """
+
+    range_regex = re.compile(r'bytes=(\d*)-(\d*)$')
+
+    def __init__(self, root: str, stat_ttl: float = 1.0, max_cache: int = 4096):
+        self.root = os.path.realpath(root)
+        # 根目录为 '/' 时已以分隔符结尾
+        self._prefix = os.path.join(self.root, '')
+        self.stat_ttl = stat_ttl
+        self.max_cache = max_cache
+        self._cache: 'OrderedDict[str, Tuple[float, FileStat]]' = OrderedDict()
+
+    def resolve(self, file_path: str) -> str:
+        """会读取文件系统 (符号链接), 在线程池中调用"""
+        # 含 NUL 的路径 realpath 会抛出 ValueError
+        if '\0' in file_path:
+            raise HTTPException(status_code=404, detail='Not Found')
+        full = os.path.realpath(os.path.join(self.root, file_path.lstrip('/')))
+        if not full.startswith(self._prefix):
+            raise HTTPException(status_code=404, detail='Not Found')
+        return full
+
+    def _lookup(self, file_path: str) -> Optional[FileStat]:
+        full = self.resolve(file_path)
+        try:
+            st = os.stat(full)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return FileStat(full, st.st_size, f'"{st.st_mtime_ns:x}-{st.st_size:x}"', formatdate(st.st_mtime, usegmt=True))
+
+    async def stat(self, file_path: str) -> FileStat:
+        now = time.monotonic()
+        cached = self._cache.get(file_path)
+        if cached is not None and cached[0] > now:
+            self._cache.move_to_end(file_path)
+            return cached[1]
+        try:
+            file = await run_in_threadpool(self._lookup, file_path)
+        except HTTPException:
+            file = None
+        now = time.monotonic()
+        if file is None:
+            self._cache.pop(file_path, None)
+            raise HTTPException(status_code=404, detail='Not Found')
+        self._cache[file_path] = (now + self.stat_ttl, file)
+        self._cache.move_to_end(file_path)
+        if len(self._cache) > self.max_cache:
+            self._cache.popitem(last=False)
+        return file
+
+    def parse_range(self, value: str, size: int) -> Optional[Tuple[int, int]]:
+        """返回 [start, end), 格式不支持 (如多个区间) 或无效 (如 last < first) 时返回 None 以发送整个文件,
+        有效但无法满足时抛出 416, 见 RFC 7233 2.1"""
+        match = self.range_regex.match(value.strip())
+        if match is None or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first and last and int(last) < int(first):
+            return None
+        if first:
+            start, end = int(first), size if not last else min(int(last) + 1, size)
+        else:
+            start, end = max(size - int(last), 0), size
+        if start >= end:
+            raise HTTPException(status_code=416, headers={'content-range': f'bytes */{size}'})
+        return start, end
+
+    async def response(self, file_path: str, request: Request) -> Response:
+        file = await self.stat(file_path)
+        headers = {'etag': file.etag, 'last-modified': file.last_modified, 'accept-ranges': 'bytes'}
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            if '*' in tags or file.etag in tags:
+                return Response(status_code=304, headers=headers)
+        content_range = request.headers.get('range')
+        byte_range = None if content_range is None else self.parse_range(content_range, file.size)
+        if byte_range is None:
+            return FileRangeResponse(file, 0, file.size, 200, headers)
+        start, end = byte_range
+        headers['content-range'] = f'bytes {start}-{end - 1}/{file.size}'
+        return FileRangeResponse(file, start, end, 206, headers)
+
+
+file_server: Optional[FileServer] = FileServer(os.environ['C02_FILES_ROOT']) if 'C02_FILES_ROOT' in os.environ else None
+
+
+def load_npz_model(path: str) -> Dict[str, np.ndarray]:
+    """np.load 读取 npz 时是惰性的, 这里读出全部数组"""
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def make_synthetic_model(path: str, layers: Iterable[Tuple[int, int]], seed: int = 0):
+    """生成随机权重的 npz 文件, 用于测试与基准"""
+    rng = np.random.default_rng(seed)
+    weights = {}
+    for i, (n_in, n_out) in enumerate(layers):
+        weights[f'layer{i}.weight'] = rng.standard_normal((n_in, n_out), dtype=np.float32)
+        weights[f'layer{i}.bias'] = np.zeros(n_out, dtype=np.float32)
+    tmp = f'{path}.tmp.npz'
+    np.savez(tmp, **weights)
+    os.replace(tmp, path)
+
+
+class ModelLoadError(Exception):
+    """权重文件存在但无法读取 (如文件损坏)"""
+
+
+class LoadedModel:
+    __slots__ = ('name', 'weights', 'nbytes', 'parameters', 'load_seconds')
+
+    def __init__(self, name: str, weights: Dict[str, np.ndarray], load_seconds: float):
+        self.name = name
+        self.weights = weights
+        self.nbytes = sum(array.nbytes for array in weights.values())
+        self.parameters = sum(array.size for array in weights.values())
+        self.load_seconds = load_seconds
+
+
+class ModelRegistry:
+    """按需加载 root 下的 `{name}.npz`, 已加载的模型按 LRU 保持在 memory_budget 字节之内"""
+
+    def __init__(self, root: str, memory_budget: int = 512 * 2 ** 20,
+                 loader: Callable[[str], Dict[str, np.ndarray]] = load_npz_model):
+        self.root = root
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self._models: 'OrderedDict[str, LoadedModel]' = OrderedDict()
+        # 任务只能在创建它的事件循环中等待, 因此按 (事件循环, 模型名) 区分
+        self._inflight: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Task] = {}
+        self.resident_bytes = 0
+        self.hits = 0
+        self.loads = 0
+        self.coalesced = 0
+        self.evictions = 0
+        # 最近一次加载的耗时, 淘汰后仍保留
+        self.load_seconds: Dict[str, float] = {}
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, f'{name}.npz')
+
+    async def get(self, name: str) -> LoadedModel:
+        model = self._models.get(name)
+        if model is not None:
+            self._models.move_to_end(name)
+            self.hits += 1
+            return model
+        key = (asyncio.get_running_loop(), name)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._load(key))
+            self._inflight[key] = task
+        # 某个请求被取消时不影响加载本身和其他请求
+        return await asyncio.shield(task)
+
+    def _read(self, name: str) -> LoadedModel:
+        start = time.perf_counter()
+        try:
+            weights = self.loader(self.path(name))
+        except FileNotFoundError:
+            raise
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile) as e:
+            raise ModelLoadError(f'Failed to load model {name}: {e}') from e
+        return LoadedModel(name, weights, time.perf_counter() - start)
+
+    async def _load(self, key: Tuple[asyncio.AbstractEventLoop, str]) -> LoadedModel:
+        name = key[1]
+        try:
+            model = await run_in_threadpool(self._read, name)
+        finally:
+            del self._inflight[key]
+        self.loads += 1
+        self.load_seconds[name] = model.load_seconds
+        loaded = self._models.get(name)
+        if loaded is not None:
+            # 其他事件循环中已加载
+            self._models.move_to_end(name)
+            return loaded
+        self._models[name] = model
+        self.resident_bytes += model.nbytes
+        while self.resident_bytes > self.memory_budget and len(self._models) > 1:
+            _, evicted = self._models.popitem(last=False)
+            self.resident_bytes -= evicted.nbytes
+            self.evictions += 1
+        return model
+
+    async def warm_up(self, names: Iterable[str]):
+        """依次加载, 避免同时读入多个模型"""
+        for name in names:
+            await self.get(name)
+
+    def evict(self, name: str) -> bool:
+        model = self._models.pop(name, None)
+        if model is None:
+            return False
+        self.resident_bytes -= model.nbytes
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'memory_budget': self.memory_budget,
+            'resident_bytes': self.resident_bytes,
+            'hits': self.hits,
+            'loads': self.loads,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            # 按最近使用的顺序, 最后一个为最近使用的
+            'resident': list(self._models),
+            'models': {
+                name: {
+                    'resident': name in self._models,
+                    'nbytes': self._models[name].nbytes if name in self._models else None,
+                    'load_ms': seconds * 1e3,
+                }
+                for name, seconds in self.load_seconds.items()
+            },
+        }
+
+
+model_registry: Optional[ModelRegistry] = ModelRegistry(
+    os.environ['C02_MODELS_ROOT'],
+    memory_budget=int(float(os.environ.get('C02_MODELS_BUDGET_MB', '512')) * 2 ** 20),
+) if 'C02_MODELS_ROOT' in os.environ else None
 
 app = FastAPI()
+use_radix_router(app)
 
 
 class ModelName(Enum):
@@ -42,21 +526,52 @@ async def read_user(user_id: str):
     return {"user_id": user_id}
 
 
+@app.on_event('startup')
+async def warm_up_models():
+    names = [name.strip() for name in os.environ.get('C02_MODELS_WARMUP', '').split(',') if name.strip()]
+    if model_registry is not None:
+        await model_registry.warm_up(names)
+
+
+async def load_model(name: str) -> Optional[LoadedModel]:
+    """未设置根目录或没有该模型的权重文件时返回 None"""
+    if model_registry is None:
+        return None
+    try:
+        return await model_registry.get(name)
+    except FileNotFoundError:
+        return None
+    except ModelLoadError:
+        raise HTTPException(status_code=503, detail=f'Model {name} is not available')
+
+
 @app.get('/models/{model_name}')
 async def get_model(model_name: ModelName):
+    model = await load_model(model_name.value)
+    parameters = None if model is None else model.parameters
+
     if model_name == ModelName.alexnet:
-        return {'model_name': model_name, 'message': 'Deep Learning FTW!'}
+        return {'model_name': model_name, 'message': 'Deep Learning FTW!', 'parameters': parameters}
 
     if model_name.value == 'lenet':
-        return {'model_name': model_name, 'message': 'LeCNN all the images'}
+        return {'model_name': model_name, 'message': 'LeCNN all the images', 'parameters': parameters}
+
+    return {'model_name': model_name, 'message': 'Have some residuals', 'parameters': parameters}
+
 
-    return {'model_name': model_name, 'message': 'Have some residuals'}
+@app.get('/model-registry/')
+async def read_model_registry():
+    if model_registry is None:
+        raise HTTPException(status_code=404, detail='C02_MODELS_ROOT is not set')
+    return model_registry.stats()
 
 
 @app.get('/files/{file_path:path}')
-async def read_file_path(file_path: str):
+async def read_file_path(file_path: str, request: Request):
     """将 file_path 标记为 path, 允许包含 '/'"""
-    return {'file_path': file_path}
+    if file_server is None:
+        raise HTTPException(status_code=404, detail='Not Found')
+    return await file_server.response(file_path, request)
 
 
 @app.get('/not_path/{file_path}')
@@ -123,12 +638,22 @@ def test_model_name():
         ModelName('internet')
 
 
-def test_get_model():
+@pytest.fixture
+def models_root(tmp_path, monkeypatch):
+    """每个模型两层, 大小约为 (lenet 32KB, alexnet 64KB, resnet 96KB)"""
+    for i, name in enumerate(('lenet', 'alexnet', 'resnet'), start=1):
+        make_synthetic_model(str(tmp_path / f'{name}.npz'), [(64, 64 * i), (64 * i, 64)], seed=i)
+    monkeypatch.setitem(globals(), 'model_registry', ModelRegistry(str(tmp_path), memory_budget=170 * 1024))
+    return tmp_path
+
+
+def test_get_model(models_root):
     """传入允许的值时返回正确, 不正确的值就返回 422"""
     for item in ModelName:
         value = item.value
         resp = client.get(f'/models/{value}')
         assert resp.json()['model_name'] == value
+        assert resp.json()['parameters'] > 0
 
     resp = client.get(f'/models/internet')
     assert resp.status_code == 422
@@ -144,14 +669,171 @@ def test_get_model():
     }
 
 
-@pytest.mark.parametrize('path', [
-    'a/b/c', '/a/b/c', '~/', 'a.txt'
+def test_model_registry(models_root):
+    async def main():
+        # 并发的第一次请求只加载一次, 且得到同一个对象
+        models = await asyncio.gather(*(model_registry.get('lenet') for _ in range(5)))
+        assert all(model is models[0] for model in models)
+        assert (model_registry.loads, model_registry.coalesced) == (1, 4)
+        assert models[0].weights['layer0.weight'].shape == (64, 64)
+
+        await model_registry.get('alexnet')
+        await model_registry.get('lenet')
+        # 超出预算, 淘汰最久未使用的 alexnet
+        await model_registry.get('resnet')
+        assert list(model_registry._models) == ['lenet', 'resnet']
+        assert model_registry.resident_bytes <= model_registry.memory_budget
+
+        with pytest.raises(FileNotFoundError):
+            await model_registry.get('missing')
+        assert model_registry._inflight == {}
+
+    asyncio.run(main())
+    stats = model_registry.stats()
+    assert stats['resident'] == ['lenet', 'resnet']
+    assert (stats['hits'], stats['loads'], stats['evictions']) == (1, 3, 1)
+    assert stats['models']['alexnet']['resident'] is False
+    assert stats['models']['resnet']['nbytes'] == (64 * 192 + 192 + 192 * 64 + 64) * 4
+    assert stats['models']['lenet']['load_ms'] > 0
+
+
+def test_model_registry_loops(models_root):
+    """另一个事件循环 (如另一个 TestClient) 中正在加载时, 不等待那个循环中的任务"""
+    release = threading.Event()
+
+    def slow_loader(path: str) -> Dict[str, np.ndarray]:
+        release.wait(5)
+        return load_npz_model(path)
+
+    registry = ModelRegistry(str(models_root), loader=slow_loader)
+    models = []
+    other = threading.Thread(target=lambda: models.append(asyncio.run(registry.get('lenet'))))
+    other.start()
+
+    async def main():
+        task = asyncio.ensure_future(registry.get('lenet'))
+        await asyncio.sleep(0.05)
+        release.set()
+        return await task
+
+    models.append(asyncio.run(main()))
+    other.join(5)
+    assert len(models) == 2 and models[0] is models[1]
+    assert registry._inflight == {}
+    assert registry.stats()['resident'] == ['lenet']
+    assert registry.resident_bytes == models[0].nbytes
+
+
+@pytest.fixture
+def current_loop():
+    """starlette 0.13 的 TestClient 进入时使用当前线程的事件循环, 而之前测试中的 asyncio.run 结束时会将其清除"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def test_model_warm_up(models_root, monkeypatch, current_loop):
+    monkeypatch.setenv('C02_MODELS_WARMUP', 'resnet, lenet')
+    with TestClient(app) as warm_client:
+        stats = warm_client.get('/model-registry/').json()
+        assert stats['resident'] == ['resnet', 'lenet']
+        assert warm_client.get('/models/resnet').status_code == 200
+        assert warm_client.get('/model-registry/').json()['hits'] == 1
+
+
+def test_model_artifacts(models_root, monkeypatch):
+    """没有权重文件时只返回说明文字, 文件损坏时返回 503"""
+    os.remove(models_root / 'alexnet.npz')
+    resp = client.get('/models/alexnet')
+    assert resp.status_code == 200
+    assert resp.json() == {'model_name': 'alexnet', 'message': 'Deep Learning FTW!', 'parameters': None}
+
+    (models_root / 'lenet.npz').write_bytes(b'not a zip file')
+    assert client.get('/models/lenet').status_code == 503
+    make_synthetic_model(str(models_root / 'resnet.npz'), [(64, 64)])
+    with open(models_root / 'resnet.npz', 'r+b') as f:
+        f.truncate(100)
+    assert client.get('/models/resnet').status_code == 503
+    assert model_registry._inflight == {}
+
+    monkeypatch.setitem(globals(), 'model_registry', None)
+    assert client.get('/models/resnet').json()['parameters'] is None
+    assert client.get('/model-registry/').status_code == 404
+
+
+@pytest.fixture
+def files_root(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'a' / 'b' / 'c').write_bytes(b'abc')
+    (root / 'a.txt').write_bytes(b'0123456789')
+    (tmp_path / 'secret.txt').write_bytes(b'secret')
+    monkeypatch.setitem(globals(), 'file_server', FileServer(str(root)))
+    return root
+
+
+@pytest.mark.parametrize('path, content', [
+    ('a/b/c', b'abc'), ('/a/b/c', b'abc'), ('a.txt', b'0123456789')
 ])
-def test_read_file_with_path(path):
+def test_read_file_with_path(files_root, path, content):
     """指定为 ':path' 时兼容各种路径表示"""
     resp = client.get(f'/files/{path}')
     assert resp.status_code == 200
-    assert resp.json() == {'file_path': path}
+    assert resp.content == content
+
+
+@pytest.mark.parametrize('path', ['~/', 'a/b', 'missing.txt', '../secret.txt', 'a/../../secret.txt', 'a%00b'])
+def test_read_file_not_found(files_root, path):
+    """目录, 不存在的文件, 以及根目录之外的路径都返回 404"""
+    resp = client.get(f'/files/{path}')
+    assert resp.status_code == 404
+
+
+def test_read_file_without_root(monkeypatch):
+    """未设置 C02_FILES_ROOT 时不提供任何文件"""
+    monkeypatch.setitem(globals(), 'file_server', None)
+    assert client.get('/files/c02_path_params.py').status_code == 404
+
+
+def test_file_server_filesystem_root(files_root):
+    """根目录为 '/' 时同样可以访问其下的文件"""
+    server = FileServer('/')
+    full = os.path.realpath(files_root / 'a.txt')
+    assert server.resolve(full) == full
+    assert server.resolve('/../' + full) == full
+
+
+@pytest.mark.parametrize('byte_range, status, content', [
+    ('bytes=2-4', 206, b'234'),
+    ('bytes=7-', 206, b'789'),
+    ('bytes=-2', 206, b'89'),
+    ('bytes=8-100', 206, b'89'),
+    ('bytes=0-1,4-5', 200, b'0123456789'),
+    # last < first 的区间无效, 忽略 Range
+    ('bytes=4-2', 200, b'0123456789'),
+])
+def test_read_file_range(files_root, byte_range, status, content):
+    resp = client.get('/files/a.txt', headers={'Range': byte_range})
+    assert resp.status_code == status
+    assert resp.content == content
+    if status == 206:
+        assert resp.headers['content-range'].endswith('/10')
+
+    resp = client.get('/files/a.txt', headers={'Range': 'bytes=10-'})
+    assert resp.status_code == 416
+    assert resp.headers['content-range'] == 'bytes */10'
+
+
+def test_read_file_etag(files_root):
+    resp = client.get('/files/a.txt')
+    etag = resp.headers['etag']
+    resp = client.get('/files/a.txt', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.content == b''
+    resp = client.get('/files/a.txt', headers={'If-None-Match': '"other"'})
+    assert resp.status_code == 200
 
 
 def test_read_file_without_path():
@@ -173,3 +855,178 @@ def test_read_file_without_path():
     resp = client.get(f'not_path/{path}')
     assert resp.status_code == 200
     assert resp.json() == {'file_path': '~'}
+
+
+def test_radix_router_static_first():
+    """使用 RadixRouter 时, 静态段优先于参数段, 与声明顺序无关"""
+    radix_app = FastAPI()
+    use_radix_router(radix_app)
+
+    @radix_app.get('/users/{user_id}')
+    async def read_user(user_id: str):
+        return {'user_id': user_id}
+
+    @radix_app.get('/users/me')
+    async def read_user_me():
+        return {'user_id': 'the current user'}
+
+    @radix_app.get('/orders/{order_id:int}')
+    async def read_order(order_id: int):
+        return {'order_id': order_id}
+
+    @radix_app.get('/orders/{order_name}')
+    async def read_order_by_name(order_name: str):
+        return {'order_name': order_name}
+
+    radix_client = TestClient(radix_app)
+    assert radix_client.get('/users/me').json() == {'user_id': 'the current user'}
+    assert radix_client.get('/users/leo').json() == {'user_id': 'leo'}
+    assert radix_client.get('/orders/42').json() == {'order_id': 42}
+    assert radix_client.get('/orders/latest').json() == {'order_name': 'latest'}
+    assert radix_client.post('/orders/42').status_code == 405
+    assert radix_client.get('/orders/').status_code == 404
+    rv = radix_client.get('/orders/42/')
+    assert [r.status_code for r in rv.history] == [307]
+    assert rv.json() == {'order_id': 42}
+
+
+def test_radix_router_rebuild():
+    """替换或删除路由后, 即使路由数量不变, 下次请求也按新的路由表查找"""
+    radix_app = FastAPI()
+    router = use_radix_router(radix_app)
+
+    @radix_app.get('/items/{item_id}')
+    async def read_item(item_id: str):
+        return {'item_id': item_id}
+
+    radix_client = TestClient(radix_app)
+    assert radix_client.get('/items/1').json() == {'item_id': '1'}
+
+    @radix_app.get('/things/{thing_id}')
+    async def read_thing(thing_id: str):
+        return {'thing_id': thing_id}
+
+    index = next(i for i, r in enumerate(router.routes) if getattr(r, 'path', None) == '/items/{item_id}')
+    router.routes[index] = router.routes.pop()
+    assert radix_client.get('/items/1').status_code == 404
+    assert radix_client.get('/things/1').json() == {'thing_id': '1'}
+
+    router.routes = [r for r in router.routes if getattr(r, 'path', None) != '/things/{thing_id}']
+    assert radix_client.get('/things/1').status_code == 404
+
+
+def bench_router(sizes=(10, 100, 1000, 10000), repeat=2000):
+    """不同路由数量下, 默认的逐个匹配与前缀树的查找耗时"""
+    for size in sizes:
+        linear = Router()
+        radix = RadixRouter()
+        for router in (linear, radix):
+            for i in range(size // 2):
+                router.add_route(f'/svc{i}/items/{{item_id:int}}', read_user)
+                router.add_route(f'/svc{i}/files/{{file_path:path}}', read_file_path)
+        # 最后声明的路由, 对逐个匹配来说是最坏情况
+        scope = {'type': 'http', 'path': f'/svc{size // 2 - 1}/files/a/b.txt', 'method': 'GET'}
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for route in linear.routes:
+                if route.matches(scope)[0] == Match.FULL:
+                    break
+        linear_cost = (time.perf_counter() - start) / repeat
+
+        radix.lookup(scope)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            radix.lookup(scope)
+        radix_cost = (time.perf_counter() - start) / repeat
+        print(f'{size:>6} routes  linear: {linear_cost * 1e6:10.2f}us  radix: {radix_cost * 1e6:6.2f}us')
+
+
+def bench_file_server(sizes=(64 * 1024, 4 * 1024 * 1024, 64 * 1024 * 1024), repeat=10):
+    """经由 socketpair 发送文件的吞吐量: 整个读入内存, mmap 分块, sendfile (zerocopysend)"""
+    async def run(scope, response_app, sock):
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                sock.sendall(message['body'])
+            elif message['type'] == 'http.response.zerocopysend':
+                offset, count = message['offset'], message['count']
+                while count:
+                    sent = os.sendfile(sock.fileno(), message['file'].fileno(), offset, count)
+                    offset, count = offset + sent, count - sent
+
+        await response_app(scope, receive, send)
+
+    def drain(sock, total):
+        while total > 0:
+            total -= len(sock.recv(1 << 20))
+
+    with tempfile.TemporaryDirectory() as root:
+        server = FileServer(root)
+        for size in sizes:
+            with open(os.path.join(root, 'data.bin'), 'wb') as f:
+                f.write(os.urandom(size))
+            file = asyncio.run(server.stat('data.bin'))
+
+            def read_into_memory():
+                with open(file.path, 'rb') as f:
+                    return Response(f.read())
+
+            cases = (
+                ('memory', read_into_memory, {}),
+                ('mmap', lambda: FileRangeResponse(file, 0, size, 200, {}), {}),
+                ('sendfile', lambda: FileRangeResponse(file, 0, size, 200, {}), {'http.response.zerocopysend': {}}),
+            )
+            line = [f'{size / 1024 / 1024:8.2f}MB']
+            for name, make_response, extensions in cases:
+                a, b = socket.socketpair()
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    reader = threading.Thread(target=drain, args=(b, size))
+                    reader.start()
+                    asyncio.run(run({'type': 'http', 'extensions': extensions}, make_response(), a))
+                    reader.join()
+                elapsed = time.perf_counter() - start
+                a.close()
+                b.close()
+                line.append(f'{name}: {size * repeat / elapsed / 1024 / 1024:8.1f}MB/s')
+            print('  '.join(line))
+
+
+def bench_model_registry(sizes_mb=(8, 64, 256), requests=2000):
+    """不同大小的模型第一次请求 (加载) 与之后命中的耗时, 以及加载期间其他请求的延迟"""
+    from loadgen import Endpoint, asgi_request
+
+    global model_registry
+    with tempfile.TemporaryDirectory() as root:
+        for size_mb in sizes_mb:
+            width = int((size_mb * 2 ** 20 / 4 / 4) ** 0.5)
+            make_synthetic_model(os.path.join(root, 'resnet.npz'), [(width, width)] * 4)
+            model_registry = ModelRegistry(root, memory_budget=2 * size_mb * 2 ** 20)
+
+            async def run():
+                probes = []
+                loading = asyncio.ensure_future(asgi_request(app, Endpoint('GET', '/models/resnet')))
+                while not loading.done():
+                    start = time.perf_counter()
+                    await asgi_request(app, Endpoint('GET', '/users/me'))
+                    probes.append(time.perf_counter() - start)
+                    # 没有真正的 IO, 不主动让出时加载的请求无法继续
+                    await asyncio.sleep(0.001)
+                start = time.perf_counter()
+                for _ in range(requests):
+                    await asgi_request(app, Endpoint('GET', '/models/resnet'))
+                return max(probes, default=0.0), (time.perf_counter() - start) / requests
+
+            worst_probe, hit = asyncio.run(run())
+            load_ms = model_registry.stats()['models']['resnet']['load_ms']
+            print(f'{size_mb:>5}MB  load {load_ms:8.1f}ms  hit {hit * 1e6:7.1f}us  '
+                  f'worst /users/me while loading {worst_probe * 1e3:6.2f}ms')
+
+
+if __name__ == '__main__':
+    bench_router()
+    bench_file_server()
+    bench_model_registry()
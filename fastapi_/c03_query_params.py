@@ -9,11 +9,19 @@
 
 3. 查询参数若要声明为必选, 可不为其指定默认值. 或使用下一节的 `Query(...)`
 
+4. `skip/limit` 是偏移量分页, 数据量大时深分页代价随 skip 增长, 且翻页期间有增删时会重复或遗漏.
+   `/cursor_items/` 使用有序索引 + 不透明游标 (keyset 分页), 每页代价只与 limit 有关.
+
 """
-from typing import Optional
+import base64
+import binascii
+import bisect
+import itertools
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import pytest
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.testclient import TestClient
 
 app = FastAPI()
@@ -21,6 +29,62 @@ app = FastAPI()
 fake_items_db = [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"}]
 
 
+class ItemStore:
+    """按 key 有序的条目存储
+
+    `_keys` 为有序的 key 列表, 作为索引; `_items` 为 key 到条目的映射.
+    游标即上一页最后一个 key, 翻页时二分查找其位置, 因此与页的深度无关,
+    翻页期间的插入/删除也不会导致重复或遗漏.
+    """
+
+    def __init__(self, items: Iterable[Tuple[int, Dict[str, Any]]] = ()):
+        self._items: Dict[int, Dict[str, Any]] = dict(items)
+        self._keys: List[int] = sorted(self._items)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def put(self, key: int, item: Dict[str, Any]):
+        if key not in self._items:
+            # 自增 key 直接追加, 否则二分插入
+            if not self._keys or key > self._keys[-1]:
+                self._keys.append(key)
+            else:
+                bisect.insort(self._keys, key)
+        self._items[key] = item
+
+    def delete(self, key: int):
+        if self._items.pop(key, None) is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def page_after(self, after: Optional[int], limit: int) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """返回 key 大于 after 的至多 limit 个条目, 以及下一页的起始 key (没有下一页时为 None)"""
+        start = 0 if after is None else bisect.bisect_right(self._keys, after)
+        keys = self._keys[start: start + limit]
+        last = keys[-1] if keys and start + limit < len(self._keys) else None
+        return [self._items[k] for k in keys], last
+
+    def page_offset(self, skip: int, limit: int) -> List[Dict[str, Any]]:
+        """与数据库的 OFFSET 相同, 逐个跳过前 skip 个条目, 仅用于对比"""
+        keys = itertools.islice(iter(self._keys), skip, skip + limit)
+        return [self._items[k] for k in keys]
+
+
+def encode_cursor(key: int) -> str:
+    return base64.urlsafe_b64encode(str(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+item_store = ItemStore(enumerate(fake_items_db))
+
+
 @app.get('/items/')
 async def read_item(skip: int = 0, limit: int = 10):
     """以下四者等价:
@@ -36,6 +100,17 @@ async def read_item(skip: int = 0, limit: int = 10):
     return fake_items_db[skip: skip + limit]
 
 
+@app.get('/cursor_items/')
+async def read_item_by_cursor(after: Optional[str] = None, limit: int = Query(10, gt=0, le=1000)):
+    """游标分页:
+    1. GET /cursor_items/?limit=2 返回第一页及 `next`
+    2. GET /cursor_items/?after=<next>&limit=2 返回下一页, 最后一页的 `next` 为 None
+    """
+    key = None if after is None else decode_cursor(after)
+    items, last = item_store.page_after(key, limit)
+    return {'items': items, 'next': None if last is None else encode_cursor(last)}
+
+
 @app.get('/items/{item_id}')
 async def read_item_by_id(item_id: str, q: Optional[str] = None, short: bool = None):
     item = {'item_id': item_id}
@@ -70,3 +145,51 @@ def test_read_item_by_id_bool_no(short):
     """short 作为布尔型, 以上值作为 False"""
     resp = client.get(f'/items/42?short={short}')
     assert 'description' in resp.json()
+
+
+def test_cursor_pagination():
+    """按游标依次翻页可以取到全部条目"""
+    resp = client.get('/cursor_items/?limit=2')
+    assert resp.json() == {'items': fake_items_db[:2], 'next': encode_cursor(1)}
+
+    resp = client.get(f"/cursor_items/?after={resp.json()['next']}&limit=2")
+    assert resp.json() == {'items': fake_items_db[2:], 'next': None}
+
+
+def test_cursor_pagination_bad_cursor():
+    resp = client.get('/cursor_items/?after=!!!')
+    assert resp.status_code == 400
+    assert resp.json() == {'detail': 'Invalid cursor'}
+
+
+def test_item_store_stable_under_insert():
+    """翻页期间在已读过的位置插入条目, 不会导致下一页重复"""
+    store = ItemStore((i * 10, {'id': i * 10}) for i in range(6))
+    items, last = store.page_after(None, 3)
+    assert [i['id'] for i in items] == [0, 10, 20]
+    store.put(5, {'id': 5})
+    store.delete(30)
+    items, last = store.page_after(last, 3)
+    assert [i['id'] for i in items] == [40, 50]
+    assert last is None
+
+
+def bench_pagination(n=1_000_000, limit=100, repeat=20):
+    """对比深分页时 OFFSET 与游标的耗时"""
+    store = ItemStore((i, {'item_name': f'item-{i}'}) for i in range(n))
+    for skip in (0, 10_000, 100_000, n - limit):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            store.page_offset(skip, limit)
+        offset_cost = (time.perf_counter() - start) / repeat
+
+        after = skip - 1 if skip else None
+        start = time.perf_counter()
+        for _ in range(repeat):
+            store.page_after(after, limit)
+        cursor_cost = (time.perf_counter() - start) / repeat
+        print(f'skip={skip:>8}  offset: {offset_cost * 1e6:10.1f}us  cursor: {cursor_cost * 1e6:8.1f}us')
+
+
+if __name__ == '__main__':
+    bench_pagination()
@@ -14,12 +14,32 @@
     2. 为单一类型(如 int, float, str, bool等), 作为查询参数;
     3. 为 Pydantic 模型, 作为请求体.
 
+5. `/items/bulk/` 一次创建多个 Item, 请求体为 JSON 数组, 或 `application/x-ndjson` 每行一个 Item.
+   按 chunk_size 分块逐行校验, 校验通过的行按列 (NumPy 数组) 计算 price_with_tax,
+   每行返回 `{'index', 'item'}` 或 `{'index', 'errors'}`, 某行出错不影响其他行.
+   price 与 tax 为 NaN 或无穷大 (如 `"nan"`) 时作为该行的错误, 无法编码为 JSON 的值不会写出.
+   JSON 数组返回汇总后的结果, 请求体不是合法的 UTF-8 或 JSON 时返回 422.
+   NDJSON 边接收边处理, 不需要先读入整个请求体, 每块处理完即编码为结果行写出, 返回的也是 NDJSON.
+
 """
-from typing import Optional
+import asyncio
+import json
+import math
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, Optional
 
-from fastapi import FastAPI
+import numpy as np
+import pytest
+from fastapi import FastAPI, Query, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.testclient import TestClient
-from pydantic import BaseModel
+from pydantic import BaseConfig, BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import ListError, PydanticValueError
+from pydantic.fields import ModelField, Required
+from starlette.responses import JSONResponse
+
+from serialization import ChunkedResponse, ndjson_media_type
 
 
 class Item(BaseModel):
@@ -48,6 +68,104 @@ async def create_item_by_put(item_id: int, item: Item, q: Optional[str] = None):
     return rv
 
 
+class NotFiniteError(PydanticValueError):
+    """同 pydantic 1.10 的 NumberNotFiniteError"""
+    code = 'number.not_finite_number'
+    msg_template = 'ensure this value is a finite number'
+
+
+item_field = ModelField.infer(
+    name='item', value=Required, annotation=Item, class_validators=None, config=BaseConfig
+)
+
+
+def create_items_chunk(rows: List[Any], start: int = 0) -> List[Dict[str, Any]]:
+    """校验一块数据, 行号从 start 开始; 解析失败的行传入对应的异常"""
+    results = []
+    items = []
+    dicts = []
+    for index, row in enumerate(rows, start):
+        if isinstance(row, Exception):
+            error = ErrorWrapper(row, ('body', index))
+        else:
+            item, error = item_field.validate(row, {}, loc=('body', index))
+            if not error:
+                # float 字段接受 "nan", "inf" 等, 无法计算税后价格, 也无法编码为 JSON
+                error = [ErrorWrapper(NotFiniteError(), ('body', index, name)) for name in ('price', 'tax')
+                         if getattr(item, name) is not None and not math.isfinite(getattr(item, name))]
+        if error:
+            results.append({'index': index, 'errors': ValidationError([error], Item).errors()})
+            continue
+        dic = item.dict()
+        results.append({'index': index, 'item': dic})
+        items.append(item)
+        dicts.append(dic)
+
+    if items:
+        # 与 create_item 相同: tax 为 None 或 0 时不计算
+        price = np.fromiter((item.price for item in items), dtype=np.float64, count=len(items))
+        tax = np.fromiter((item.tax or 0.0 for item in items), dtype=np.float64, count=len(items))
+        price_with_tax = (price + tax).tolist()
+        for i in np.flatnonzero(tax != 0).tolist():
+            dicts[i]['price_with_tax'] = price_with_tax[i]
+    return results
+
+
+def _parse_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        return e
+
+
+async def create_items_ndjson(chunks: AsyncIterable[bytes], chunk_size: int) -> AsyncIterator[bytes]:
+    """逐行读取 NDJSON, 每凑满 chunk_size 行校验一次并写出结果, 空行忽略"""
+    rest = b''
+    rows = []
+    index = 0
+    async for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        rows += [_parse_line(line) for line in lines if line.strip()]
+        while len(rows) >= chunk_size:
+            results = create_items_chunk(rows[:chunk_size], index)
+            rows, index = rows[chunk_size:], index + chunk_size
+            yield _ndjson_lines(results)
+    if rest.strip():
+        rows.append(_parse_line(rest))
+    if rows:
+        yield _ndjson_lines(create_items_chunk(rows, index))
+
+
+def _ndjson_lines(results: List[Dict[str, Any]]) -> bytes:
+    return b''.join(json.dumps(r, allow_nan=False).encode() + b'\n' for r in results)
+
+
+@app.post('/items/bulk/')
+async def create_items(request: Request, chunk_size: int = Query(1000, gt=0, le=10_000)):
+    if request.headers.get('content-type', '').startswith(ndjson_media_type):
+        # 写出结果时仍在读取请求体, 不能再另外监听断开连接
+        return ChunkedResponse(create_items_ndjson(request.stream(), chunk_size), media_type=ndjson_media_type,
+                               watch_disconnect=False)
+
+    body = await request.body()
+    try:
+        rows = json.loads(body)
+    except json.JSONDecodeError as e:
+        raise RequestValidationError([ErrorWrapper(e, ('body', e.pos))], body=e.doc)
+    except UnicodeDecodeError as e:
+        raise RequestValidationError([ErrorWrapper(e, ('body',))])
+    if not isinstance(rows, list):
+        raise RequestValidationError([ErrorWrapper(ListError(), loc=('body',))])
+
+    results = []
+    for start in range(0, len(rows), chunk_size):
+        results += create_items_chunk(rows[start: start + chunk_size], start)
+    created = sum('item' in r for r in results)
+    # 结果只含基本类型, 直接编码, 不再经过 jsonable_encoder
+    return JSONResponse({'created': created, 'failed': len(results) - created, 'results': results})
+
+
 client = TestClient(app)
 
 
@@ -60,3 +178,149 @@ def test_item():
     }
     item = Item(**dic)
     assert item.dict() == dic
+
+
+bulk_rows = [
+    {'name': 'coca cola', 'price': 2.99, 'tax': 0.9},
+    {'name': 'pepsi', 'price': 'cheap'},
+    {'name': 'sprite', 'description': 'lemon', 'price': 1.5},
+    {'name': 'fanta', 'price': 1.2, 'tax': 0},
+]
+
+
+def test_bulk_json():
+    resp = client.post('/items/bulk/?chunk_size=3', json=bulk_rows)
+    assert resp.status_code == 200
+    data = resp.json()
+    assert (data['created'], data['failed']) == (3, 1)
+    results = data['results']
+    for i in (0, 2, 3):
+        assert results[i] == {'index': i, 'item': client.post('/items/', json=bulk_rows[i]).json()}
+    assert results[1] == {'index': 1, 'errors': [
+        {'loc': ['body', 1, 'price'], 'msg': 'value is not a valid float', 'type': 'type_error.float'}
+    ]}
+
+    resp = client.post('/items/bulk/', json={'name': 'foo'})
+    assert resp.status_code == 422
+    assert resp.json()['detail'] == [{'loc': ['body'], 'msg': 'value is not a valid list', 'type': 'type_error.list'}]
+
+
+def test_bulk_not_finite():
+    """NaN 与无穷大只使该行失败, 其他行照常创建"""
+    rows = [bulk_rows[0], {'name': 'nan', 'price': 'nan'}, {'name': 'inf', 'price': 1.0, 'tax': 'inf'}, bulk_rows[2]]
+    error = {'msg': 'ensure this value is a finite number', 'type': 'value_error.number.not_finite_number'}
+    resp = client.post('/items/bulk/', json=rows)
+    assert resp.status_code == 200
+    data = resp.json()
+    assert (data['created'], data['failed']) == (2, 2)
+    assert data['results'][1] == {'index': 1, 'errors': [{'loc': ['body', 1, 'price'], **error}]}
+    assert data['results'][2] == {'index': 2, 'errors': [{'loc': ['body', 2, 'tax'], **error}]}
+
+    body = b'\n'.join(json.dumps(row).encode() for row in rows) + b'\n{"name": "n", "price": NaN}'
+    resp = client.post('/items/bulk/', data=body, headers={'content-type': ndjson_media_type})
+    # 每行都是合法的 JSON (不含 NaN)
+    results = [json.loads(line, parse_constant=lambda c: pytest.fail(c)) for line in resp.content.splitlines()]
+    assert results[:4] == data['results']
+    assert results[4]['errors'] == [{'loc': ['body', 4, 'price'], **error}]
+
+
+def test_bulk_bad_encoding():
+    resp = client.post('/items/bulk/', data=b'[{"name": "\xff"}]', headers={'content-type': 'application/json'})
+    assert resp.status_code == 422
+    assert resp.json()['detail'][0]['loc'] == ['body']
+    assert resp.json()['detail'][0]['type'] == 'value_error.unicodedecode'
+
+
+def test_bulk_ndjson():
+    body = b'\n'.join(json.dumps(row).encode() for row in bulk_rows) + b'\n\n{"name": \n'
+    resp = client.post('/items/bulk/?chunk_size=2', data=body, headers={'content-type': ndjson_media_type})
+    assert resp.headers['content-type'] == ndjson_media_type
+    results = [json.loads(line) for line in resp.content.splitlines()]
+    assert [r['index'] for r in results] == [0, 1, 2, 3, 4]
+    assert results[:4] == client.post('/items/bulk/', json=bulk_rows).json()['results']
+    assert results[4]['errors'][0]['type'] == 'value_error.jsondecode'
+
+    # 行被拆分到多个数据块中
+    async def chunks():
+        for i in range(0, len(body), 7):
+            yield body[i: i + 7]
+
+    async def collect():
+        return b''.join([chunk async for chunk in create_items_ndjson(chunks(), 3)])
+
+    assert asyncio.run(collect()) == resp.content
+
+
+def test_bulk_ndjson_streaming():
+    """每块的结果处理完即写出, 不等请求体全部到达"""
+    first = b''.join(json.dumps(row).encode() + b'\n' for row in bulk_rows[:2])
+    last = json.dumps(bulk_rows[2]).encode()
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': 'POST', 'scheme': 'http', 'path': '/items/bulk/',
+        'root_path': '', 'query_string': b'chunk_size=2', 'server': ('testserver', 80), 'client': ('testclient', 1),
+        'headers': [(b'content-type', ndjson_media_type.encode())],
+    }
+    bodies = []
+
+    async def main():
+        more = asyncio.Event()
+        first_result = asyncio.Event()
+        messages = [{'type': 'http.request', 'body': first, 'more_body': True}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await more.wait()
+            return {'type': 'http.request', 'body': last, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and message.get('body'):
+                bodies.append(message['body'])
+                first_result.set()
+
+        task = asyncio.ensure_future(app(scope, receive, send))
+        await asyncio.wait_for(first_result.wait(), 5)
+        assert len(bodies) == 1
+        more.set()
+        await task
+
+    asyncio.run(main())
+    assert [[r['index'] for r in map(json.loads, body.splitlines())] for body in bodies] == [[0, 1], [2]]
+
+
+def bench_bulk(rows=100_000, single=2000, chunk_size=1000):
+    """单条接口与批量接口每秒处理的行数"""
+    from loadgen import Endpoint, asgi_request
+
+    data = [{'name': f'item{i}', 'description': 'bulk', 'price': i * 0.01, 'tax': (i % 3) * 0.1} for i in range(rows)]
+
+    async def run_single():
+        for row in data[:single]:
+            await asgi_request(app, Endpoint('POST', '/items/', json=row))
+
+    start = time.perf_counter()
+    asyncio.run(run_single())
+    print(f'single:        {single / (time.perf_counter() - start):10.0f} rows/s')
+
+    start = time.perf_counter()
+    status, _ = asyncio.run(asgi_request(app, Endpoint('POST', '/items/bulk/', {'chunk_size': chunk_size}, json=data)))
+    assert status == 200
+    print(f'bulk json:     {rows / (time.perf_counter() - start):10.0f} rows/s')
+
+    body = b'\n'.join(json.dumps(row).encode() for row in data)
+
+    async def run_ndjson():
+        async def chunks():
+            for i in range(0, len(body), 64 * 1024):
+                yield body[i: i + 64 * 1024]
+
+        async for _ in create_items_ndjson(chunks(), chunk_size):
+            pass
+
+    start = time.perf_counter()
+    asyncio.run(run_ndjson())
+    print(f'bulk ndjson:   {rows / (time.perf_counter() - start):10.0f} rows/s')
+
+
+if __name__ == '__main__':
+    bench_bulk()
@@ -14,16 +14,113 @@
 5. Query 可指定 title, description, deprecated 等元数据用于生成文档;
 
 6. Query 可指定 alias 用于在 url 中查找参数值; 指定 min_length, ge, regex 等进行长度, 大小, 正则匹配等验证条件.
+
+7. `/search/` 使用倒排索引在条目中搜索, 以 `*` 结尾的 q 为前缀匹配, 多个 q 由 op 指定 and/or 组合.
+   每个 q 按与条目相同的方式分词, 含多个词的 q 相当于多个 q.
+   `POST /items/` 添加的条目会立即加入索引. 查询耗时只与命中的倒排列表大小有关, 与条目总数无关.
 """
 
-from typing import Optional, List
+import bisect
+import heapq
+import itertools
+import random
+import re
+import time
+from typing import Dict, Iterable, Optional, List, Set
 
 from fastapi import FastAPI, Query
 from fastapi.testclient import TestClient
+from pydantic import BaseModel
 
 app = FastAPI()
 
 
+class InvertedIndex:
+    """词项到条目 id 集合的倒排索引
+
+    `_vocabulary` 为有序的词项列表, 用于二分查找前缀匹配的词项
+    """
+
+    token_regex = re.compile(r'\w+')
+
+    def __init__(self):
+        self._postings: Dict[str, Set[int]] = {}
+        self._vocabulary: List[str] = []
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.token_regex.findall(text.lower())
+
+    def add(self, doc_id: int, text: str):
+        for token in self.tokenize(text):
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                bisect.insort(self._vocabulary, token)
+            postings.add(doc_id)
+
+    def remove(self, doc_id: int, text: str):
+        for token in self.tokenize(text):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.discard(doc_id)
+
+    def _prefix_tokens(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        end = bisect.bisect_left(self._vocabulary, prefix + '\U0010ffff', start)
+        return self._vocabulary[start: end]
+
+    def query_terms(self, terms: Iterable[str]) -> List[str]:
+        """按条目的分词方式拆分查询词, 以 `*` 结尾时最后一个词为前缀匹配"""
+        rv = []
+        for term in terms:
+            tokens = self.tokenize(term)
+            if tokens and term.endswith('*'):
+                tokens[-1] += '*'
+            rv.extend(tokens)
+        return rv
+
+    def match(self, term: str) -> Set[int]:
+        """`foo` 为精确匹配, `foo*` 为前缀匹配"""
+        if term.endswith('*'):
+            prefix = term[:-1].lower()
+            return set().union(*(self._postings[t] for t in self._prefix_tokens(prefix))) if prefix else set()
+        return self._postings.get(term.lower(), set())
+
+    def search(self, terms: Iterable[str], op: str = 'and') -> Set[int]:
+        matches = sorted((self.match(term) for term in self.query_terms(terms)), key=len)
+        if not matches:
+            return set()
+        if op == 'or':
+            return set().union(*matches)
+        # 从最小的集合开始求交集
+        rv = set(matches[0])
+        for m in matches[1:]:
+            if not rv:
+                break
+            rv &= m
+        return rv
+
+
+class Item(BaseModel):
+    name: str
+    description: Optional[str] = None
+
+
+items_db: List[dict] = []
+item_index = InvertedIndex()
+
+
+def add_item(item: Item) -> dict:
+    doc = {'id': len(items_db), **item.dict()}
+    items_db.append(doc)
+    item_index.add(doc['id'], f"{item.name} {item.description or ''}")
+    return doc
+
+
+for _name, _description in [('Foo', 'The pretender'), ('Bar', 'The bartender'), ('Baz', 'There goes my hero')]:
+    add_item(Item(name=_name, description=_description))
+
+
 @app.get('/items/')
 async def read_items(q: Optional[str] = Query(default=None, max_length=5)):
     rv = {}
@@ -37,6 +134,21 @@ async def multi_q(q: Optional[List[str]] = Query(None)):
     return {'q': q}
 
 
+@app.post('/items/')
+async def create_item(item: Item):
+    return add_item(item)
+
+
+@app.get('/search/')
+async def search_items(
+        q: List[str] = Query(...),
+        op: str = Query('and', regex='^(and|or)$'),
+        limit: int = Query(10, gt=0, le=100),
+):
+    ids = heapq.nsmallest(limit, item_index.search(q, op))
+    return [items_db[i] for i in ids]
+
+
 client = TestClient(app)
 
 
@@ -73,3 +185,78 @@ def test_optional_multi_q():
 
     resp = client.get('/multi_q/?q=four&q=five')
     assert resp.json() == {'q': ['four', 'five']}
+
+
+def test_search():
+    def names(resp):
+        return [item['name'] for item in resp.json()]
+
+    assert names(client.get('/search/?q=the')) == ['Foo', 'Bar']
+    assert names(client.get('/search/?q=the*')) == ['Foo', 'Bar', 'Baz']
+    assert names(client.get('/search/?q=the*&q=hero')) == ['Baz']
+    assert names(client.get('/search/?q=pretender&q=bartender&op=or')) == ['Foo', 'Bar']
+    assert names(client.get('/search/?q=pretender&q=bartender')) == []
+    # 与条目相同的分词方式
+    assert names(client.get('/search/?q=the hero')) == []
+    assert names(client.get('/search/?q=goes my HERO')) == ['Baz']
+    assert names(client.get('/search/?q=goes-he*')) == ['Baz']
+    assert names(client.get('/search/?q=pretender bartender&op=or')) == ['Foo', 'Bar']
+    assert names(client.get('/search/?q=*')) == []
+    assert names(client.get('/search/?q=the*&limit=2')) == ['Foo', 'Bar']
+
+    resp = client.get('/search/?q=x&op=xor')
+    assert resp.status_code == 422
+
+
+def test_search_incremental():
+    """添加的条目立即可以被搜索到"""
+    resp = client.post('/items/', json={'name': 'Qux', 'description': 'a pretender too'})
+    assert resp.status_code == 200
+    doc_id = resp.json()['id']
+    try:
+        assert [item['name'] for item in client.get('/search/?q=pretender').json()] == ['Foo', 'Qux']
+    finally:
+        item_index.remove(doc_id, 'Qux a pretender too')
+        items_db.pop(doc_id)
+    assert [item['name'] for item in client.get('/search/?q=pretender').json()] == ['Foo']
+
+
+def bench_search(n=1_000_000, vocabulary=20_000, words=8, repeat=20):
+    """n 个随机条目上, 倒排索引与逐个扫描的查询耗时"""
+    rng = random.Random(0)
+    vocab = [f'w{i}' for i in range(vocabulary)]
+    # 按 Zipf 分布取词, 接近真实文本
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(vocabulary)))
+    docs = [' '.join(rng.choices(vocab, cum_weights=cum_weights, k=words)) for _ in range(n)]
+
+    start = time.perf_counter()
+    index = InvertedIndex()
+    for i, doc in enumerate(docs):
+        index.add(i, doc)
+    print(f'index {n} items in {time.perf_counter() - start:.1f}s')
+    tokenized = [set(doc.split()) for doc in docs]
+
+    queries = [
+        (['w1'], 'and'), (['w1', 'w2'], 'and'), (['w50', 'w999'], 'or'), (['w1234*'], 'and'), (['w5000', 'w7'], 'and'),
+    ]
+    for terms, op in queries:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            hits = index.search(terms, op)
+        indexed = (time.perf_counter() - start) / repeat
+
+        combine = all if op == 'and' else any
+        start = time.perf_counter()
+        scanned = [
+            i for i, tokens in enumerate(tokenized)
+            if combine(any(t.startswith(term[:-1]) for t in tokens) if term.endswith('*') else term in tokens
+                       for term in terms)
+        ]
+        linear = time.perf_counter() - start
+        assert sorted(hits) == scanned
+        print(f'{" ".join(terms) + " " + op:<20} {len(hits):>8} hits  index: {indexed * 1e3:8.2f}ms  '
+              f'scan: {linear * 1e3:8.1f}ms')
+
+
+if __name__ == '__main__':
+    bench_search()
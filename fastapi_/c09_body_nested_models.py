@@ -13,13 +13,40 @@
 4. 简单类型即使不使用 Pydantic 的 BaseModel, 如声明为 `Dict[int, float]`, 仍会进行转换.
    所有支持的类型见 https://pydantic-docs.helpmanual.io/usage/types/
 
+5. 请求体默认会被完整读入, 解析为字典树后再整体校验, 对于数 MB 的 Offer 内存占用是请求体的数倍.
+   `/offers/stream/` 边接收边解析, `items` 中的每个 Item 读完即校验, 只缓存尚未解析完的部分,
+   超出上限时返回 413. 校验失败时的 422 与 `/offers/` 相同 (如 `['body', 'items', i, ...]`).
+
+6. 数十万项的 `Dict[int, float]` 经 JSON 解析后再逐项检查代价很高. `/index-weights/binary/` 接收
+   小端 int64 键与 float64 值 (`application/octet-stream` 为 n 个键后接 n 个值,
+   `application/x-npy` 为含 key, value 字段的结构化数组), 直接在请求体上以 NumPy 数组零拷贝解码,
+   并向量化地校验, 返回结果与 `/index-weights/` 相同.
+
+7. `/images/multiple/` 使用 serialization.py 中的 `stream_response`, 逐个校验并写出列表元素.
+
 """
 
-from typing import List, Optional, Set, Dict
+import asyncio
+import codecs
+import io
+import json
+import math
+import re
+import time
+import tracemalloc
+from typing import Any, AsyncIterable, AsyncIterator, List, Optional, Set, Dict
 
-from fastapi import FastAPI
+import numpy as np
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.testclient import TestClient
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseConfig, BaseModel, HttpUrl, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import MissingError
+from pydantic.fields import ModelField, Required
+
+from serialization import stream_response
 
 app = FastAPI()
 
@@ -50,13 +77,208 @@ async def create_offer(offer: Offer):
     return offer
 
 
-@app.post("/images/multiple/")
+offer_field = ModelField.infer(
+    name='offer', value=Required, annotation=Offer, class_validators=None, config=BaseConfig
+)
+item_field = ModelField.infer(
+    name='item', value=Required, annotation=Item, class_validators=None, config=BaseConfig
+)
+
+
+class _StreamReader:
+    """在请求体的字节流上逐个读取 JSON 值, 已读取的部分会被丢弃
+
+    读取一个值时先扫描括号与字符串的边界 (只扫描新读入的部分), 值完整后才交给 json 解析一次,
+    因此分成很多块到达的大元素不会被反复解析, 格式错误也在该值结束时即可发现.
+    """
+
+    whitespace = ' \t\n\r'
+    structural = re.compile(r'["{}\[\]]')
+    string_special = re.compile(r'["\\]')
+    scalar_end = re.compile(r'[\s,:\]}]')
+
+    def __init__(self, chunks: AsyncIterable[bytes], max_buffer: int):
+        self._chunks: AsyncIterator[bytes] = chunks.__aiter__()
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self.max_buffer = max_buffer
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+        # 当前值已扫描的长度 (相对于 pos), 及扫描到该处时的嵌套深度与是否在字符串中
+        self._scanned = 0
+        self._depth = 0
+        self._in_string = False
+
+    async def fill(self) -> bool:
+        """读入下一块数据, 已到结尾时返回 False"""
+        if self.eof:
+            return False
+        try:
+            chunk = await self._chunks.__anext__()
+            text = self._decoder.decode(chunk)
+        except StopAsyncIteration:
+            text = self._decoder.decode(b'', final=True)
+            self.eof = True
+        if self.pos:
+            self.offset += self.pos
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += text
+        if len(self.buf) > self.max_buffer:
+            raise HTTPException(status_code=413, detail='Request body element too large')
+        return True
+
+    def error(self, msg: str, pos: Optional[int] = None) -> RequestValidationError:
+        e = json.JSONDecodeError(msg, self.buf, self.pos if pos is None else pos)
+        return RequestValidationError([ErrorWrapper(e, ('body', self.offset + e.pos))])
+
+    async def peek(self) -> str:
+        """跳过空白, 返回下一个字符, 到结尾时返回空串"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf) or not await self.fill():
+                return self.buf[self.pos: self.pos + 1]
+
+    async def expect(self, chars: str) -> str:
+        char = await self.peek()
+        if not char or char not in chars:
+            raise self.error(f'Expecting {chars!r} delimiter')
+        self.pos += 1
+        return char
+
+    def _value_end(self) -> Optional[int]:
+        """pos 处的值已完整读入时返回其结尾位置, 否则记录扫描状态并返回 None"""
+        buf, start = self.buf, self.pos
+        n = len(buf)
+        i = start + self._scanned
+        if buf[start] not in '{["':
+            # 数字与 true/false/null 到分隔符为止, 结尾处的数字可能被截断, 如 "12" 实为 "123"
+            match = self.scalar_end.search(buf, max(i, start + 1))
+            if match is not None:
+                return match.start()
+            self._scanned = n - start
+            return None
+        depth, in_string = self._depth, self._in_string
+        while True:
+            if in_string:
+                match = self.string_special.search(buf, i)
+                if match is None:
+                    i = n
+                    break
+                i = match.start()
+                if buf[i] == '\\':
+                    if i + 1 >= n:
+                        break
+                    i += 2
+                    continue
+                in_string = False
+                i += 1
+                if depth == 0:
+                    return i
+            else:
+                match = self.structural.search(buf, i)
+                if match is None:
+                    i = n
+                    break
+                i = match.end()
+                char = match.group()
+                if char == '"':
+                    in_string = True
+                elif char in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth <= 0:
+                        return i
+        self._scanned, self._depth, self._in_string = i - start, depth, in_string
+        return None
+
+    async def value(self) -> Any:
+        await self.peek()
+        self._scanned, self._depth, self._in_string = 0, 0, False
+        while (self.pos == len(self.buf) or self._value_end() is None) and await self.fill():
+            pass
+        try:
+            obj, end = self._json.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError as e:
+            raise self.error(e.msg, e.pos)
+        self.pos = end
+        return obj
+
+
+async def parse_offer_stream(chunks: AsyncIterable[bytes], max_buffer: int = 1 << 20) -> Offer:
+    """增量解析 Offer, max_buffer 为缓存中尚未解析的字符数上限"""
+    reader = _StreamReader(chunks, max_buffer)
+    char = await reader.peek()
+    if not char:
+        raise RequestValidationError([ErrorWrapper(MissingError(), loc=('body',))])
+    if char != '{':
+        # 不是对象时按常规方式整体校验, 以得到相同的错误信息
+        _, error = offer_field.validate(await reader.value(), {}, loc=('body',))
+        raise RequestValidationError([error])
+
+    reader.pos += 1
+    fields = {}
+    items: Optional[List[Item]] = None
+    item_errors = []
+    if await reader.peek() == '}':
+        reader.pos += 1
+    else:
+        while True:
+            if await reader.peek() != '"':
+                raise reader.error('Expecting property name enclosed in double quotes')
+            key = await reader.value()
+            await reader.expect(':')
+            if key == 'items' and await reader.peek() == '[':
+                reader.pos += 1
+                fields['items'], items, item_errors = [], [], []
+                if await reader.peek() == ']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        item, error = item_field.validate(await reader.value(), {}, loc=('items', len(items)))
+                        items.append(item)
+                        if error:
+                            item_errors.append(error)
+                        if await reader.expect(',]') == ']':
+                            break
+            else:
+                fields[key] = await reader.value()
+                if key == 'items':
+                    items, item_errors = None, []
+            if await reader.expect(',}') == '}':
+                break
+    if await reader.peek():
+        raise reader.error('Extra data')
+
+    offer, error = offer_field.validate(fields, {}, loc=('body',))
+    if error or item_errors:
+        errors = error.exc.raw_errors if error else []
+        raise RequestValidationError([ErrorWrapper(ValidationError(errors + item_errors, Offer), loc=('body',))])
+    if items is not None:
+        offer.items = items
+    return offer
+
+
+@app.post("/offers/stream/")
+async def create_offer_streaming(request: Request):
+    return await parse_offer_stream(request.stream())
+
+
+@app.post("/images/multiple/", response_model=List[Image])
+@stream_response(Image)
 async def create_multiple_images(images: List[Image]):
     return images
 
 
 @app.post("/index-weights/")
 async def create_index_weights(weights: Dict[int, float]):
+    # NaN 与 inf 无法编码为 JSON 响应, 与二进制方式一样返回 422
+    if not all(math.isfinite(v) for v in weights.values()):
+        raise HTTPException(status_code=422, detail='Weights must be finite numbers')
     return {
         'data': weights,
         'all_keys_int': all(isinstance(k, int) for k in weights.keys()),
@@ -64,6 +286,73 @@ async def create_index_weights(weights: Dict[int, float]):
     }
 
 
+weights_dtype = np.dtype([('key', '<i8'), ('value', '<f8')])
+
+
+def decode_raw_weights(body: bytes):
+    """n 个 int64 键后接 n 个 float64 值, 返回的数组均为 body 上的视图"""
+    if len(body) % 16:
+        raise HTTPException(status_code=422, detail='Body length must be a multiple of 16 bytes')
+    n = len(body) // 16
+    return np.frombuffer(body, dtype='<i8', count=n), np.frombuffer(body, dtype='<f8', count=n, offset=n * 8)
+
+
+def decode_npy_weights(body: bytes):
+    """`.npy` 格式的结构化数组, 只解析头部, 数据部分同样为视图"""
+    header = io.BytesIO(body)
+    try:
+        version = np.lib.format.read_magic(header)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(header)
+        elif version == (2, 0):
+            shape, _, dtype = np.lib.format.read_array_header_2_0(header)
+        else:
+            # 3.0 只用于字段名无法以 latin-1 编码的 dtype, weights_dtype 不会用到
+            raise ValueError(f'unsupported format version {version}')
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f'Invalid npy body: {e}')
+    if dtype != weights_dtype or len(shape) != 1:
+        raise HTTPException(status_code=422, detail=f'Expecting a 1-d npy array of dtype {weights_dtype.descr}')
+    count = shape[0]
+    if len(body) - header.tell() != count * weights_dtype.itemsize:
+        raise HTTPException(status_code=422, detail='Invalid npy body: data size does not match header')
+    array = np.frombuffer(body, dtype=weights_dtype, count=count, offset=header.tell())
+    return array['key'], array['value']
+
+
+weights_decoders = {
+    'application/octet-stream': decode_raw_weights,
+    'application/x-npy': decode_npy_weights,
+}
+
+
+def aggregate_weights(keys: np.ndarray, values: np.ndarray) -> Dict[int, float]:
+    """与 dict 相同, 重复的键以最后一次出现的值为准"""
+    if not np.isfinite(values).all():
+        raise HTTPException(status_code=422, detail='Weights must be finite numbers')
+    if len(keys) > 1 and not (keys[1:] > keys[:-1]).all():
+        # 键无序或有重复时, 只保留每个键最后一次出现的位置, 并按首次出现的顺序排列
+        _, last = np.unique(keys[::-1], return_index=True)
+        _, first = np.unique(keys, return_index=True)
+        index = (len(keys) - 1 - last)[np.argsort(first)]
+        keys, values = keys[index], values[index]
+    return dict(zip(keys.tolist(), values.tolist()))
+
+
+@app.post("/index-weights/binary/")
+async def create_index_weights_binary(request: Request):
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    decode = weights_decoders.get(content_type)
+    if decode is None:
+        raise HTTPException(status_code=415, detail=f'Unsupported content type, use one of {list(weights_decoders)}')
+    keys, values = decode(await request.body())
+    return {
+        'data': aggregate_weights(keys, values),
+        'all_keys_int': keys.dtype.kind == 'i',
+        'all_values_float': values.dtype.kind == 'f',
+    }
+
+
 client = TestClient(app)
 
 
@@ -100,6 +389,82 @@ def test_nested_model():
     assert resp.status_code == 200
 
 
+def test_nested_model_streaming():
+    data = {
+        'name': 'some offer',
+        'price': 9.9,
+        'items': [
+            {'name': 'Foo', 'price': 42.0, 'tags': ['rock'],
+             'images': [{'url': 'http://example.com/baz.jpg', 'name': 'The Foo live'}]},
+            {'name': 'Bar', 'price': 1},
+        ]
+    }
+    resp = client.post('/offers/stream/', json=data)
+    assert resp.status_code == 200
+    assert resp.json() == client.post('/offers/', json=data).json()
+
+
+@pytest.mark.parametrize('data', [
+    {'name': 'offer', 'items': [{'name': 'Foo', 'price': 'x'}, {'price': 1, 'images': [{'url': 'bad'}]}]},
+    {'name': 'offer', 'price': 1, 'items': 'nope'},
+    {'items': [1, {}]},
+    [1],
+])
+def test_nested_model_streaming_errors(data):
+    """校验失败时与常规方式的 422 完全一致"""
+    resp = client.post('/offers/stream/', json=data)
+    assert resp.status_code == 422
+    assert resp.json() == client.post('/offers/', json=data).json()
+
+
+def test_nested_model_streaming_limit():
+    async def chunks():
+        yield b'{"name": "offer", "price": 1, "items": ['
+        for _ in range(1000):
+            yield b'{"name": "Foo", "price": 1, "tags": ["rock"]},'
+        yield b'{"name": "' + b'x' * 2048 + b'", "price": 1}]}'
+
+    offer = asyncio.run(parse_offer_stream(chunks(), max_buffer=4096))
+    assert len(offer.items) == 1001
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(parse_offer_stream(chunks(), max_buffer=1024))
+    assert e.value.status_code == 413
+
+
+def test_nested_model_streaming_fail_fast():
+    """格式错误的元素结束时即返回 422, 不会继续读到结尾"""
+    received = 0
+
+    async def chunks():
+        nonlocal received
+        yield b'{"name": "offer", "price": 1, "items": [{"name": "Foo", "price": 1}, {"name": Foo'
+        for _ in range(10000):
+            received += 1
+            yield b', "price": 1, "tags": ["x"]}, {"name": "Bar", "price": 1}'
+        yield b']}'
+
+    with pytest.raises(RequestValidationError) as e:
+        asyncio.run(parse_offer_stream(chunks()))
+    assert received == 1
+    assert e.value.errors()[0]['msg'].startswith('Expecting value')
+
+
+def test_nested_model_streaming_small_chunks():
+    """大元素分成很多小块到达时与一次到达的结果相同"""
+    data = {'name': 'offer', 'price': 1, 'items': [
+        {'name': 'x\\"y' * 5000, 'price': 1, 'tags': ['a', '{[', ']}'] * 1000}, {'name': 'Bar', 'price': 1.5e3},
+    ]}
+    body = json.dumps(data).encode()
+
+    async def chunks(size):
+        for i in range(0, len(body), size):
+            yield body[i: i + size]
+
+    expected = Offer.parse_obj(data)
+    for size in (1, 7, 4096):
+        assert asyncio.run(parse_offer_stream(chunks(size))) == expected
+
+
 def test_model_list():
     images = [
         {
@@ -131,3 +496,126 @@ def test_dict():
         'all_keys_int': True,
         'all_values_float': True
     }
+
+
+def encode_raw_weights(weights: Dict[int, float]) -> bytes:
+    keys = np.fromiter(weights.keys(), dtype='<i8', count=len(weights))
+    values = np.fromiter(weights.values(), dtype='<f8', count=len(weights))
+    return keys.tobytes() + values.tobytes()
+
+
+def encode_npy_weights(weights: Dict[int, float]) -> bytes:
+    array = np.fromiter(weights.items(), dtype=weights_dtype, count=len(weights))
+    buf = io.BytesIO()
+    np.save(buf, array)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize('content_type, encode', [
+    ('application/octet-stream', encode_raw_weights),
+    ('application/x-npy', encode_npy_weights),
+])
+def test_dict_binary(content_type, encode):
+    """二进制与 JSON 方式的返回结果相同"""
+    weights = {3: 5.5, 1: 2.0, -7: 0.25}
+    resp = client.post('/index-weights/binary/', data=encode(weights), headers={'content-type': content_type})
+    assert resp.status_code == 200
+    assert resp.json() == client.post('/index-weights/', json=weights).json()
+
+    # 非有限值两种方式都返回 422
+    weights[1] = float('nan')
+    resp = client.post('/index-weights/binary/', data=encode(weights), headers={'content-type': content_type})
+    assert resp.status_code == 422
+    resp = client.post('/index-weights/', data=json.dumps(weights).encode(),
+                       headers={'content-type': 'application/json'})
+    assert resp.status_code == 422
+
+
+def test_dict_binary_bad_body():
+    resp = client.post('/index-weights/binary/', data=b'x' * 15,
+                       headers={'content-type': 'application/octet-stream'})
+    assert resp.status_code == 422
+
+    resp = client.post('/index-weights/binary/', data=b'{}', headers={'content-type': 'application/json'})
+    assert resp.status_code == 415
+
+    # 不支持的 npy 版本
+    body = bytearray(encode_npy_weights({1: 1.0}))
+    body[6] = 3
+    resp = client.post('/index-weights/binary/', data=bytes(body), headers={'content-type': 'application/x-npy'})
+    assert resp.status_code == 422
+    assert 'version' in resp.json()['detail']
+
+
+def test_aggregate_weights_duplicated_keys():
+    keys = np.array([5, 1, 5, 3, 1], dtype='<i8')
+    values = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+    assert aggregate_weights(keys, values) == dict(zip(keys.tolist(), values.tolist()))
+
+
+def bench_index_weights(n=200_000, repeat=5):
+    """JSON 与二进制方式的解码+校验耗时, 以及经过完整路由的耗时"""
+    rng = np.random.default_rng(0)
+    weights = dict(zip(rng.permutation(n * 2)[:n].tolist(), rng.random(n).tolist()))
+    json_body = json.dumps(weights).encode()
+    raw_body = encode_raw_weights(weights)
+
+    def timeit(func):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1e3
+
+    weights_field = ModelField.infer(
+        name='weights', value=Required, annotation=Dict[int, float], class_validators=None, config=BaseConfig
+    )
+
+    def parse_json():
+        value, _ = weights_field.validate(json.loads(json_body), {}, loc=('body',))
+        return all(isinstance(k, int) for k in value.keys()), all(isinstance(v, float) for v in value.values())
+
+    json_ms = timeit(parse_json)
+    binary_ms = timeit(lambda: aggregate_weights(*decode_raw_weights(raw_body)))
+    print(f'n={n}  decode+validate  json: {json_ms:8.1f}ms  binary: {binary_ms:8.1f}ms')
+
+    json_ms = timeit(lambda: client.post('/index-weights/', data=json_body,
+                                         headers={'content-type': 'application/json'}))
+    binary_ms = timeit(lambda: client.post('/index-weights/binary/', data=raw_body,
+                                           headers={'content-type': 'application/octet-stream'}))
+    print(f'n={n}  full route       json: {json_ms:8.1f}ms  binary: {binary_ms:8.1f}ms')
+
+
+def bench_offer_ingestion(chunk_size=64 * 1024):
+    """不同请求体大小下, 常规方式与增量方式的内存峰值和耗时"""
+    item = {
+        'name': 'Foo', 'description': 'The pretender', 'price': 42.0, 'tax': 3.2, 'tags': ['rock', 'metal'],
+        'images': [{'url': 'http://example.com/baz.jpg', 'name': 'The Foo live'}] * 4,
+    }
+
+    async def buffered(body: bytes):
+        chunks = [body[i: i + chunk_size] for i in range(0, len(body), chunk_size)]
+        return Offer.parse_obj(json.loads(b''.join(chunks)))
+
+    async def streaming(body: bytes):
+        async def chunks():
+            for i in range(0, len(body), chunk_size):
+                yield body[i: i + chunk_size]
+        return await parse_offer_stream(chunks())
+
+    for n in (100, 1000, 10000):
+        body = json.dumps({'name': 'offer', 'price': 1, 'items': [item] * n}).encode()
+        line = [f'{len(body) / 1024 / 1024:6.2f}MB']
+        for name, parse in (('buffered', buffered), ('streaming', streaming)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            asyncio.run(parse(body))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            line.append(f'{name}: peak {peak / 1024 / 1024:7.2f}MB {elapsed * 1e3:8.1f}ms')
+        print('  '.join(line))
+
+
+if __name__ == '__main__':
+    bench_offer_ingestion()
+    bench_index_weights()
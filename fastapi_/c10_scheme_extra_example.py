@@ -17,12 +17,37 @@ https://pydantic-docs.helpmanual.io/usage/schema/#schema-customization
 
 
 以上三者等价
+
+`/openapi.json` 默认在第一次请求时才生成, 大型应用可能需要数秒, 且返回未压缩的完整内容.
+`use_cached_openapi(app, path)` 在启动时生成 (path 存在时直接读取) 序列化并预先 gzip 压缩的结果,
+带 ETag, 请求头 If-None-Match 匹配时返回 304, Accept-Encoding 接受 gzip 时直接返回压缩后的内容.
+构建时可以先写入文件, 启动时读取:
+
+    python c10_scheme_extra_example.py --app c10_scheme_extra_example:app --output openapi.cache
+
+文件首行为生成时路由表的哈希 (路径, 方法, 视图函数, 各参数及依赖, 请求体和响应模型的 schema 等), 之后为压缩后的 schema;
+启动时路由表的哈希不同则忽略该文件, 重新生成.
 """
 
-from typing import Optional
+import argparse
+import gzip
+import hashlib
+import importlib
+import json
+import os
+from typing import Any, NamedTuple, Optional
+
+from fastapi import FastAPI, Body, Query, Request
+from fastapi.dependencies.utils import get_flat_dependant
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from pydantic import BaseModel, Field, create_model
+from pydantic.fields import ModelField
+from pydantic.utils import lenient_issubclass
+from starlette.responses import Response
+from starlette.routing import Route
 
-from fastapi import FastAPI, Body
-from pydantic import BaseModel, Field
+from compression import negotiate_encoding
 
 app = FastAPI()
 
@@ -78,3 +103,206 @@ async def patch_item(item_id: int, item: Item = Body(..., example=item_example))
         'item': item
     }
     return rv
+
+
+class OpenAPIBlob(NamedTuple):
+    body: bytes
+    gzip_body: bytes
+    etag: str
+
+    @classmethod
+    def from_body(cls, body: bytes, gzip_body: Optional[bytes] = None) -> 'OpenAPIBlob':
+        if gzip_body is None:
+            # mtime 固定为 0, 相同的 schema 得到相同的文件
+            gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+        return cls(body, gzip_body, '"%s"' % hashlib.sha256(body).hexdigest()[:32])
+
+
+def build_openapi_blob(app: FastAPI) -> OpenAPIBlob:
+    body = json.dumps(app.openapi(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return OpenAPIBlob.from_body(body)
+
+
+def _schema_input(obj: Any) -> Any:
+    """模型类取其 schema, 其他对象取 repr"""
+    if lenient_issubclass(obj, BaseModel):
+        return obj.schema()
+    return repr(obj)
+
+
+def _field_input(field: Optional[ModelField]) -> Any:
+    if field is None:
+        return None
+    field_info = dict(field.field_info.__repr_args__(), **getattr(field.field_info, '__dict__', {}))
+    return [field.name, field.alias, field.required, field.default, field.outer_type_, field.type_, field_info]
+
+
+def route_table_hash(app: FastAPI) -> str:
+    """生成 schema 所用输入的哈希, 用于判断保存的 schema 是否过期
+
+    包括应用信息, 以及每个路由的路径, 方法, 视图函数, 参数 (含依赖中的参数) 及安全方案, 请求体和响应模型的 schema 等
+    """
+    inputs = [app.title, app.version, app.description, app.openapi_url, app.openapi_tags]
+    for route in app.routes:
+        if isinstance(route, APIRoute) and route.include_in_schema:
+            dependant = get_flat_dependant(route.dependant, skip_repeats=True)
+            params = dependant.path_params + dependant.query_params + dependant.header_params + \
+                dependant.cookie_params + dependant.body_params
+            security = [(req.security_scheme.model.dict(), req.scopes) for req in dependant.security_requirements]
+            endpoint = route.endpoint
+            inputs.append([
+                route.path, sorted(route.methods), f'{endpoint.__module__}.{endpoint.__qualname__}',
+                route.operation_id, route.summary, route.description, route.response_description, route.tags,
+                route.deprecated, route.status_code, route.responses, security,
+                [_field_input(field) for field in params],
+                _field_input(route.body_field), _field_input(route.response_field),
+            ])
+    blob = json.dumps(inputs, sort_keys=True, default=_schema_input)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def save_openapi_blob(blob: OpenAPIBlob, path: str, key: str):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(key.encode('ascii') + b'\n')
+        f.write(blob.gzip_body)
+    os.replace(tmp, path)
+
+
+def load_openapi_blob(path: str, key: str) -> Optional[OpenAPIBlob]:
+    """key 与保存时不同, 即路由表已变化时返回 None"""
+    with open(path, 'rb') as f:
+        saved_key = f.readline().rstrip(b'\n')
+        if saved_key != key.encode('ascii'):
+            return None
+        gzip_body = f.read()
+    return OpenAPIBlob.from_body(gzip.decompress(gzip_body), gzip_body)
+
+
+def use_cached_openapi(app: FastAPI, path: Optional[str] = None):
+    """用预先生成并压缩的结果替换 app 的 openapi_url 路由, path 为 save_openapi_blob 写入的文件"""
+    blob: Optional[OpenAPIBlob] = None
+
+    def get_blob() -> OpenAPIBlob:
+        nonlocal blob
+        if blob is None:
+            if path and os.path.exists(path):
+                blob = load_openapi_blob(path, route_table_hash(app))
+                if blob is not None:
+                    app.openapi_schema = json.loads(blob.body)
+            if blob is None:
+                blob = build_openapi_blob(app)
+        return blob
+
+    async def openapi(request: Request) -> Response:
+        blob_ = get_blob()
+        headers = {'etag': blob_.etag, 'vary': 'Accept-Encoding', 'cache-control': 'no-cache'}
+        if_none_match = request.headers.get('if-none-match', '')
+        if blob_.etag in (tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*':
+            return Response(status_code=304, headers=headers)
+        if negotiate_encoding(request.headers.get('accept-encoding', ''), ('gzip',)):
+            return Response(blob_.gzip_body, media_type='application/json',
+                            headers={**headers, 'content-encoding': 'gzip'})
+        return Response(blob_.body, media_type='application/json', headers=headers)
+
+    for i, route in enumerate(app.router.routes):
+        if isinstance(route, Route) and route.path == app.openapi_url:
+            app.router.routes[i] = Route(app.openapi_url, openapi, include_in_schema=False)
+            break
+    else:
+        app.add_route(app.openapi_url, openapi, include_in_schema=False)
+    app.add_event_handler('startup', get_blob)
+
+
+use_cached_openapi(app, os.environ.get('C10_OPENAPI_PATH'))
+
+client = TestClient(app)
+
+
+def test_cached_openapi(tmp_path):
+    resp = client.get('/openapi.json', headers={'accept-encoding': 'identity'})
+    assert resp.status_code == 200
+    assert 'content-encoding' not in resp.headers
+    assert resp.json() == app.openapi()
+    etag = resp.headers['etag']
+
+    resp = client.get('/openapi.json', headers={'accept-encoding': 'gzip, deflate'})
+    assert resp.headers['content-encoding'] == 'gzip'
+    assert resp.json() == app.openapi()
+
+    resp = client.get('/openapi.json', headers={'if-none-match': etag})
+    assert resp.status_code == 304
+    assert resp.content == b''
+
+    path = str(tmp_path / 'openapi.cache')
+    blob = build_openapi_blob(app)
+    save_openapi_blob(blob, path, route_table_hash(app))
+    assert load_openapi_blob(path, route_table_hash(app)) == blob
+
+    # 路由表相同, 直接使用保存的 schema
+    other = FastAPI()
+    other.include_router(app.router)
+    use_cached_openapi(other, path)
+    with TestClient(other) as other_client:
+        resp = other_client.get('/openapi.json')
+        assert resp.headers['etag'] == etag
+        assert resp.json() == app.openapi()
+
+
+def test_cached_openapi_stale(tmp_path):
+    """路由表变化后, 保存的 schema 不再使用"""
+    path = str(tmp_path / 'openapi.cache')
+    save_openapi_blob(build_openapi_blob(app), path, route_table_hash(app))
+
+    other = FastAPI()
+    other.include_router(app.router)
+
+    @other.get('/items/')
+    async def read_items():
+        return []
+
+    assert load_openapi_blob(path, route_table_hash(other)) is None
+    use_cached_openapi(other, path)
+    with TestClient(other) as other_client:
+        schema = other_client.get('/openapi.json').json()
+        assert '/items/' in schema['paths']
+        assert schema == other.openapi()
+
+
+def test_route_table_hash():
+    """参数, 请求体和响应模型的变化都会改变哈希"""
+
+    # 同名模型, 只多一个字段
+    Tag = create_model('Tag', name=(str, ...))
+    TagV2 = create_model('Tag', name=(str, ...), color=(Optional[str], None))
+
+    def tag_app(model, description: Optional[str] = None) -> FastAPI:
+        other = FastAPI()
+
+        @other.put('/tags/{tag_id}', response_model=model)
+        async def update_tag(tag_id: int, tag: model, q: Optional[str] = Query(None, description=description)):
+            return tag
+
+        return other
+
+    key = route_table_hash(tag_app(Tag))
+    assert route_table_hash(tag_app(Tag)) == key
+    assert route_table_hash(tag_app(TagV2)) != key
+    assert route_table_hash(tag_app(Tag, description='query string')) != key
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成 OpenAPI schema 并写入缓存文件')
+    parser.add_argument('--app', default='c10_scheme_extra_example:app', help='module:attribute')
+    parser.add_argument('--output', default='openapi.cache', help='输出文件, 启动时由 use_cached_openapi 读取')
+    args = parser.parse_args()
+
+    module, _, attr = args.app.partition(':')
+    target = getattr(importlib.import_module(module), attr or 'app')
+    blob = build_openapi_blob(target)
+    save_openapi_blob(blob, args.output, route_table_hash(target))
+    print(f'{args.output}: {len(blob.body)} bytes, gzip {len(blob.gzip_body)} bytes, etag {blob.etag}')
+
+
+if __name__ == '__main__':
+    main()
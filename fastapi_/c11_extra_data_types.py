@@ -9,13 +9,30 @@
 参见页面上的简单说明, 若要查看 Pydantic 支持的所有数据类型, 参见:
 https://pydantic-docs.helpmanual.io/usage/types
 
+`/items/batch/` 一次计算多个条目, 请求体为条目的数组, 每个条目的字段与 `PUT /items/{item_id}` 相同,
+时间解析为 NumPy 的 `datetime64`/`timedelta64` 数组后向量化计算, 每个条目的输出也与其相同.
+为了能交给 NumPy 解析, 字段格式比单个计算时更严格:
+
+- 时间只接受不带时区的 `YYYY-MM-DD[T ]HH:MM[:SS[.ffffff]]`, 带时区, 时间戳与 `NaT` 等均返回 422
+- process_after 只接受有限的秒数
+
 """
 
+import asyncio
+import uuid
 from datetime import datetime, time, timedelta
-from typing import Optional
+from time import perf_counter
+from typing import List, Optional
 from uuid import UUID
 
+import numpy as np
+import pytest
 from fastapi import Body, FastAPI
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+from pydantic import BaseModel, constr, validator
+from pydantic.error_wrappers import ErrorWrapper
 
 app = FastAPI()
 
@@ -39,3 +56,146 @@ async def read_items(
         "start_process": start_process,
         "duration": duration,
     }
+
+
+naive_datetime = constr(regex=r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?$')
+
+
+class ScheduleEntry(BaseModel):
+    item_id: UUID
+    start_datetime: naive_datetime
+    end_datetime: naive_datetime
+    process_after: float
+    repeat_at: Optional[time] = None
+
+    @validator('process_after')
+    def check_process_after(cls, v):
+        # 与 timedelta 的取值范围相同, 也排除了 NaN
+        if not abs(v) <= timedelta.max.total_seconds():
+            raise ValueError('process_after is out of range')
+        return v
+
+
+def parse_datetimes(entries: List[ScheduleEntry], field: str) -> np.ndarray:
+    values = [getattr(entry, field) for entry in entries]
+    try:
+        return np.array(values, dtype='datetime64[us]')
+    except ValueError:
+        pass
+    # 格式正确但日期无效 (如 13 月), 逐个解析找到出错的条目
+    for i, value in enumerate(values):
+        try:
+            np.datetime64(value, 'us')
+        except ValueError as e:
+            raise RequestValidationError([ErrorWrapper(e, ('body', i, field))])
+    raise AssertionError('unreachable')
+
+
+def format_datetimes(values: np.ndarray) -> List[str]:
+    """与 `datetime.isoformat` 相同, 微秒为 0 时不输出小数部分"""
+    whole = values.astype('datetime64[s]') == values
+    return np.where(
+        whole, np.datetime_as_string(values, unit='s'), np.datetime_as_string(values, unit='us')
+    ).tolist()
+
+
+def seconds(values: np.ndarray) -> List[float]:
+    """与 `timedelta.total_seconds` 相同"""
+    return (values.astype('int64') / 10 ** 6).tolist()
+
+
+@app.post('/items/batch/')
+async def read_items_batch(entries: List[ScheduleEntry]):
+    start = parse_datetimes(entries, 'start_datetime')
+    end = parse_datetimes(entries, 'end_datetime')
+    process_after = np.round(np.array([e.process_after for e in entries]) * 10 ** 6).astype('timedelta64[us]')
+    start_process = start + process_after
+    duration = end - start_process
+
+    rows = zip(
+        [str(e.item_id) for e in entries], format_datetimes(start), format_datetimes(end),
+        [None if e.repeat_at is None else e.repeat_at.isoformat() for e in entries], seconds(process_after),
+        format_datetimes(start_process), seconds(duration),
+    )
+    keys = ('item_id', 'start_datetime', 'end_datetime', 'repeat_at', 'process_after', 'start_process', 'duration')
+    # 内容已全部是 JSON 原生类型, 跳过 jsonable_encoder
+    return JSONResponse([dict(zip(keys, row)) for row in rows])
+
+
+client = TestClient(app)
+
+
+def test_read_items_batch():
+    """批量计算的每个条目与单个计算的结果相同"""
+    entries = [
+        {'item_id': '1a5f8e5c-3b5e-4a4c-9b6e-8f0e5d2b2c11', 'start_datetime': '2021-03-15T10:00:00',
+         'end_datetime': '2021-03-15T12:00:00', 'process_after': 600, 'repeat_at': '08:00:00'},
+        {'item_id': '2b6f8e5c-3b5e-4a4c-9b6e-8f0e5d2b2c12', 'start_datetime': '2021-03-15 23:59:59.5',
+         'end_datetime': '2021-03-17T01:00', 'process_after': 90.25},
+    ]
+    resp = client.post('/items/batch/', json=entries)
+    assert resp.status_code == 200
+    expected = [
+        client.put(f'/items/{entry["item_id"]}', json={k: v for k, v in entry.items() if k != 'item_id'}).json()
+        for entry in entries
+    ]
+    assert resp.json() == expected
+
+    resp = client.post('/items/batch/', json=[])
+    assert resp.json() == []
+
+
+@pytest.mark.parametrize('field, value', [
+    ('start_datetime', 'not a time'),
+    ('start_datetime', 'NaT'),
+    ('start_datetime', '2021-03-15T10:00:00+08:00'),
+    ('end_datetime', '2021-03-15T12:00:00Z'),
+    ('start_datetime', '1615802400'),
+    ('end_datetime', '2021-13-15T12:00:00'),
+    ('process_after', 'P1D'),
+    ('process_after', 'nan'),
+    ('process_after', 1e300),
+])
+def test_read_items_batch_bad_entry(field, value):
+    """无法交给 NumPy 解析的格式返回 422, 并指出出错的条目"""
+    entry = {
+        'item_id': str(uuid.uuid4()), 'start_datetime': '2021-03-15T10:00:00',
+        'end_datetime': '2021-03-15T12:00:00', 'process_after': 1,
+    }
+    resp = client.post('/items/batch/', json=[entry, {**entry, field: value}])
+    assert resp.status_code == 422
+    assert resp.json()['detail'][0]['loc'] == ['body', 1, field]
+
+
+def bench_batch(sizes=(10, 100, 1000, 10000)):
+    """逐个请求与一次批量请求的总耗时"""
+    from loadgen import Endpoint, asgi_request
+
+    async def main():
+        for size in sizes:
+            ids = [str(uuid.uuid4()) for _ in range(size)]
+            starts = [f'2021-03-15T{i % 24:02d}:00:00' for i in range(size)]
+            ends = [f'2021-03-16T{i % 24:02d}:30:00' for i in range(size)]
+            afters = [float(i % 3600) for i in range(size)]
+
+            start = perf_counter()
+            for i in range(size):
+                await asgi_request(app, Endpoint('PUT', f'/items/{ids[i]}', json={
+                    'start_datetime': starts[i], 'end_datetime': ends[i], 'process_after': afters[i],
+                }))
+            single = perf_counter() - start
+
+            start = perf_counter()
+            await asgi_request(app, Endpoint('POST', '/items/batch/', json=[
+                {'item_id': ids[i], 'start_datetime': starts[i], 'end_datetime': ends[i], 'process_after': afters[i]}
+                for i in range(size)
+            ]))
+            batch = perf_counter() - start
+            print(f'{size:>6} items  single: {single * 1e3:9.1f}ms  batch: {batch * 1e3:7.1f}ms  '
+                  f'({single / batch:.0f}x)')
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    bench_batch()
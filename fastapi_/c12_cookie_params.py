@@ -5,17 +5,219 @@
 
 可以像定义 Query 参数和 Path 参数一样来定义 Cookie 参数.
 
+1. 实际使用中 ads_id 需要调用较慢的后端才能得到广告画像, 且少数热门 id 的请求量很大.
+   `AsyncTTLCache` 作为依赖项使用: LRU 限制条目数, 每个条目有过期时间, 后端返回 None 时也缓存
+   (过期时间更短), 同一个 key 同时未命中时只调用一次后端, 其余请求等待同一个结果.
+   hits/misses/coalesced 分别统计命中, 未命中 (即后端调用次数), 合并到进行中调用的次数.
 
 """
 
-from typing import Optional
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from fastapi import Cookie, Depends, FastAPI
+from fastapi.testclient import TestClient
+
+
+class AsyncTTLCache:
+    """异步加载的 TTL + LRU 缓存, 同一个 key 的并发未命中只加载一次"""
+
+    def __init__(self, loader: Callable[[Hashable], Awaitable[Any]], maxsize: int = 1024,
+                 ttl: float = 60.0, negative_ttl: float = 5.0, clock: Callable[[], float] = time.monotonic):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key))
+            self._inflight[key] = task
+        # 某个等待者被取消时不影响加载本身和其他等待者
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable) -> Any:
+        try:
+            value = await self.loader(key)
+        finally:
+            del self._inflight[key]
+        # 加载失败时不缓存, 异常传给所有等待者
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._entries[key] = (self.clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+
+fake_ads_db = {
+    'abc': {'segment': 'sports', 'bid': 0.5},
+    'def': {'segment': 'music', 'bid': 0.3},
+}
+
+
+async def fake_fetch_ad_profile(ads_id: str) -> Optional[Dict[str, Any]]:
+    """模拟较慢的后端, 未知的 id 返回 None"""
+    await asyncio.sleep(0.05)
+    return fake_ads_db.get(ads_id)
+
+
+ad_profiles = AsyncTTLCache(fake_fetch_ad_profile, maxsize=10_000, ttl=60.0, negative_ttl=5.0)
+
+
+async def ad_profile(ads_id: Optional[str] = Cookie(None)) -> Optional[Dict[str, Any]]:
+    if ads_id is None:
+        return None
+    return await ad_profiles.get(ads_id)
 
-from fastapi import Cookie, FastAPI
 
 app = FastAPI()
 
 
 @app.get("/items/")
-async def read_items(ads_id: Optional[str] = Cookie(None)):
-    return {"ads_id": ads_id}
+async def read_items(ads_id: Optional[str] = Cookie(None), profile: Optional[dict] = Depends(ad_profile)):
+    return {"ads_id": ads_id, "profile": profile}
+
+
+@app.get("/ads-cache/stats")
+async def read_ads_cache_stats():
+    return ad_profiles.stats()
+
+
+client = TestClient(app)
+
+
+def test_read_items():
+    resp = client.get('/items/', cookies={'ads_id': 'abc'})
+    assert resp.json() == {'ads_id': 'abc', 'profile': fake_ads_db['abc']}
+    assert client.get('/items/').json() == {'ads_id': None, 'profile': None}
+    assert client.get('/ads-cache/stats').json()['size'] >= 1
+
+
+def test_cache():
+    now = [0.0]
+    calls = []
+
+    async def slow_backend(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        if key == 'boom':
+            raise RuntimeError(key)
+        return fake_ads_db.get(key)
+
+    async def main():
+        cache = AsyncTTLCache(slow_backend, maxsize=2, ttl=10, negative_ttl=1, clock=lambda: now[0])
+
+        # 并发未命中只调用一次后端
+        results = await asyncio.gather(*(cache.get('abc') for _ in range(100)))
+        assert results == [fake_ads_db['abc']] * 100
+        assert calls == ['abc']
+        assert (cache.misses, cache.coalesced, cache.hits) == (1, 99, 0)
+        assert await cache.get('abc') == fake_ads_db['abc']
+        assert cache.hits == 1
+
+        # 负缓存的过期时间更短
+        assert await cache.get('missing') is None
+        assert await cache.get('missing') is None
+        assert calls == ['abc', 'missing']
+        now[0] = 2
+        assert await cache.get('missing') is None
+        assert await cache.get('abc') == fake_ads_db['abc']
+        assert calls == ['abc', 'missing', 'missing']
+        now[0] = 11
+        await cache.get('abc')
+        assert calls[-1] == 'abc'
+
+        # LRU: 最久未使用的 missing 被淘汰
+        await cache.get('def')
+        assert list(cache._entries) == ['abc', 'def']
+
+        # 异常传给所有等待者, 且不缓存
+        results = await asyncio.gather(*(cache.get('boom') for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert calls.count('boom') == 1
+        assert cache.stats()['inflight'] == 0
+        await asyncio.gather(cache.get('boom'), return_exceptions=True)
+        assert calls.count('boom') == 2
+
+        # 等待者被取消不影响其他等待者
+        first = asyncio.ensure_future(cache.get('xyz'))
+        second = asyncio.ensure_future(cache.get('xyz'))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second is None
+
+    asyncio.run(main())
+
+
+def bench_cache(requests=100_000, concurrency=1000, hot_ids=100):
+    """模拟热门 id 的大量请求, 对比有无缓存时的后端调用次数与耗时"""
+    import random
+
+    ids = [f'ad{random.randrange(hot_ids)}' for _ in range(requests)]
+
+    async def run(get):
+        queue = iter(ids)
+
+        async def worker():
+            for ads_id in queue:
+                await get(ads_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+    calls = 0
+
+    async def backend(ads_id):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.005)
+        return {'segment': ads_id}
+
+    elapsed = asyncio.run(run(backend))
+    print(f'no cache: {requests / elapsed:9.0f} req/s  backend calls: {calls}')
+    calls = 0
+    cache = AsyncTTLCache(backend)
+    elapsed = asyncio.run(run(cache.get))
+    print(f'cached:   {requests / elapsed:9.0f} req/s  backend calls: {calls}  {cache.stats()}')
+
 
+if __name__ == '__main__':
+    bench_cache()
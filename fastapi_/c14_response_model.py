@@ -23,15 +23,36 @@ FastAPI 将使用此 response_model 来：
 
 参见 Pydantic 文档: https://pydantic-docs.helpmanual.io/usage/exporting_models/#modeldict
 
+使用 response_model 时, 返回值每次都会先按模型重新校验一遍, 再经 `jsonable_encoder` 转为字典后编码.
+`ResponseSerializer` (见 serialization.py) 在启动时按模型和 include/exclude 等参数预先确定输出字段,
+直接从返回的对象生成 JSON 字节; 对可信的视图函数可指定 `trusted=True` 跳过重新校验.
+视图函数 (async 或 def) 用 `serialize_response()` 装饰器标记, 应用的路由类为 `SerializedRoute`,
+序列化器按路由的 `response_model` 与 `response_model_include` 等参数生成, 不需要重复指定:
+状态码, 注入的 `Response` 上设置的响应头与 cookie, 以及后台任务与 FastAPI 的处理相同.
+
+`response_model` 为 `List[...]` 时, 整个列表需要先生成, 校验并编码为一个 JSON 文档后才能发出第一个字节.
+`stream_response` 装饰器允许视图函数返回 (异步) 迭代器, 每个元素产生后即校验并写出:
+请求头 `Accept` 包含 `application/x-ndjson` 时每行一个 JSON, 否则为分块发送的 JSON 数组.
+注意响应开始后元素校验失败只能中断连接, 无法再返回 500.
+
 """
 
-from typing import Optional
+import asyncio
+import json
+import time
+from typing import Callable, List, Optional
 
-from fastapi import FastAPI
+import pytest
+from fastapi import BackgroundTasks, FastAPI
+from fastapi.routing import APIRoute, request_response
+from fastapi.routing import serialize_response as fastapi_serialize_response
 from fastapi.testclient import TestClient
+from fastapi.utils import create_response_field
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
 
-app = FastAPI()
+from serialization import ResponseSerializer, ndjson_media_type, stream_response
 
 
 class UserIn(BaseModel):
@@ -47,16 +68,100 @@ class UserOut(BaseModel):
     full_name: Optional[str] = None
 
 
+def serialize_response(trusted: bool = False):
+    """标记视图函数使用预编译的序列化器, 需配合 SerializedRoute 使用; trusted 为 True 时跳过重新校验"""
+
+    def decorator(func):
+        func.serialize_trusted = trusted
+        return func
+
+    return decorator
+
+
+class SerializedRoute(APIRoute):
+    """视图函数带有 serialize_response 标记时, 按路由的 response_model 等参数生成 serializer,
+    替换 dependant.call, 由 serializer 直接生成响应
+
+    FastAPI 对返回的 Response 不再做处理 (后台任务除外), 因此这里合并子响应的状态码与响应头.
+    视图函数未声明 `Response` 参数时, 以 `_sub_response` 为名取得子响应.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, endpoint, **kwargs)
+        trusted: Optional[bool] = getattr(endpoint, 'serialize_trusted', None)
+        self.serializer: Optional[ResponseSerializer] = None
+        if trusted is None:
+            return
+        self.serializer = serializer = self.build_serializer(trusted)
+        dependant = self.dependant
+        declared = dependant.response_param_name is not None
+        if not declared:
+            dependant.response_param_name = '_sub_response'
+        response_param = dependant.response_param_name
+        status_code = self.status_code or 200
+        is_coroutine = asyncio.iscoroutinefunction(endpoint)
+
+        async def call(**values):
+            sub_response = values[response_param] if declared else values.pop(response_param)
+            if is_coroutine:
+                obj = await endpoint(**values)
+            else:
+                obj = await run_in_threadpool(endpoint, **values)
+            if isinstance(obj, Response):
+                return obj
+            response = serializer.response(obj, sub_response.status_code or status_code)
+            response.headers.raw.extend(sub_response.headers.raw)
+            return response
+
+        dependant.call = call
+        self.app = request_response(self.get_route_handler())
+
+    def build_serializer(self, trusted: bool) -> ResponseSerializer:
+        """ResponseSerializer 不支持的参数组合直接报错, 避免与 FastAPI 的输出不一致"""
+        model = self.response_model
+        if not (isinstance(model, type) and issubclass(model, BaseModel)):
+            raise TypeError(f'{self.path}: serialize_response requires a pydantic model as response_model')
+        include, exclude = self.response_model_include, self.response_model_exclude
+        if isinstance(include, dict) or isinstance(exclude, dict):
+            raise TypeError(f'{self.path}: serialize_response only supports sets of field names in include/exclude')
+        if not self.response_model_by_alias or self.response_model_exclude_defaults:
+            raise TypeError(f'{self.path}: serialize_response does not support by_alias=False or exclude_defaults')
+        return ResponseSerializer(
+            model, include=include and set(include), exclude=exclude and set(exclude),
+            exclude_unset=self.response_model_exclude_unset, exclude_none=self.response_model_exclude_none,
+            trusted=trusted,
+        )
+
+
+app = FastAPI()
+app.router.route_class = SerializedRoute
+
+
 @app.post("/users/", response_model=UserOut)
+@serialize_response()
 async def create_user(user: UserIn):
     return user
 
 
 @app.put('/users/', response_model=UserIn, response_model_exclude={'password'})
+@serialize_response(trusted=True)
 async def put_user(user: UserIn):
     return user
 
 
+signups: List[str] = []
+
+
+@app.post('/users/signup/', response_model=UserOut, status_code=201)
+@serialize_response()
+def signup(user: UserIn, response: Response, background_tasks: BackgroundTasks):
+    """def 视图函数同样在线程池中执行, 注入的 Response 与后台任务照常生效"""
+    response.headers['location'] = f'/users/{user.user_name}'
+    response.set_cookie('signed_up', '1')
+    background_tasks.add_task(signups.append, user.user_name)
+    return user
+
+
 client = TestClient(app)
 
 
@@ -72,3 +177,107 @@ def test_user_out():
 
     rv = client.put('/users/', json=user)
     assert rv.json() == user_without_password
+
+
+def test_serialized_route():
+    """状态码, 响应头, cookie 与后台任务都与 FastAPI 的处理相同"""
+    user = {'user_name': 'leo', 'email': 'leo@github.com', 'full_name': None, 'password': 'pass_w0rd'}
+    rv = client.post('/users/signup/', json=user)
+    assert rv.status_code == 201
+    assert rv.json() == {k: v for k, v in user.items() if k != 'password'}
+    assert rv.headers['location'] == '/users/leo'
+    assert rv.cookies['signed_up'] == '1'
+    assert signups[-1] == 'leo'
+    assert int(rv.headers['content-length']) == len(rv.content)
+
+
+def test_serializer_from_route():
+    """serializer 由路由的 response_model 与 response_model_exclude 等参数生成"""
+    route = next(route for route in app.routes if getattr(route, 'endpoint', None) is put_user)
+    assert route.serializer.model is UserIn and route.serializer.trusted
+    assert [name for name, _, _ in route.serializer.fields] == ['user_name', 'email', 'full_name']
+
+    other = FastAPI()
+    other.router.route_class = SerializedRoute
+    for kwargs in ({'response_model': List[UserOut]}, {'response_model': UserOut, 'response_model_by_alias': False},
+                   {'response_model': UserIn, 'response_model_exclude': {'password': ...}}):
+        with pytest.raises(TypeError):
+            other.get('/users/', **kwargs)(serialize_response()(lambda: []))
+
+
+def test_serializer_same_as_fastapi():
+    """各种参数下与 FastAPI 的输出相同"""
+    user = UserIn(user_name='leo', password='pass_w0rd', email='leo@github.com')
+    cases = [
+        (UserOut, {}),
+        (UserIn, {'exclude': {'password'}}),
+        (UserIn, {'include': {'user_name', 'full_name'}}),
+        (UserOut, {'exclude_none': True}),
+        (UserOut, {'exclude_unset': True}),
+    ]
+    for model, kwargs in cases:
+        field = create_response_field(name='response', type_=model)
+        expected = JSONResponse(asyncio.run(fastapi_serialize_response(
+            field=field, response_content=user, **kwargs
+        ))).body
+        assert ResponseSerializer(model, **kwargs).render(user) == expected
+        if model is UserIn:
+            assert ResponseSerializer(model, trusted=True, **kwargs).render(user) == expected
+
+
+@app.get('/users/', response_model=List[UserOut])
+@stream_response(UserOut)
+async def list_users(count: int = 3):
+    for i in range(count):
+        await asyncio.sleep(0)
+        yield UserIn(user_name=f'user{i}', password='pass_w0rd', email=f'user{i}@github.com')
+
+
+def test_stream_response():
+    """默认为 JSON 数组, 与整体返回时相同; 指定 Accept 时为 NDJSON"""
+    users = [
+        {'user_name': f'user{i}', 'email': f'user{i}@github.com', 'full_name': None}
+        for i in range(3)
+    ]
+    # 异步生成器在事件循环中迭代, 不交给线程池
+    assert asyncio.iscoroutinefunction(list_users)
+    rv = client.get('/users/')
+    assert rv.headers['content-type'] == 'application/json'
+    assert rv.json() == users
+
+    rv = client.get('/users/?count=0')
+    assert rv.json() == []
+
+    rv = client.get('/users/', headers={'Accept': ndjson_media_type})
+    assert rv.headers['content-type'] == ndjson_media_type
+    assert [json.loads(line) for line in rv.text.splitlines()] == users
+
+
+def bench_serializer(repeat=100_000):
+    """每次响应的序列化耗时: FastAPI 默认方式, 预编译 (校验), 预编译 (可信)"""
+    user = UserIn(user_name='leo', password='pass_w0rd', email='leo@github.com', full_name='leo leo')
+    field = create_response_field(name='response', type_=UserIn)
+
+    async def fastapi_path():
+        content = await fastapi_serialize_response(field=field, response_content=user, exclude={'password'})
+        return JSONResponse(content).body
+
+    validated = ResponseSerializer(UserIn, exclude={'password'})
+    trusted = ResponseSerializer(UserIn, exclude={'password'}, trusted=True)
+
+    async def main():
+        for name, render in (('fastapi', fastapi_path), ('compiled', validated.render), ('trusted', trusted.render)):
+            is_coroutine = asyncio.iscoroutinefunction(render)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                if is_coroutine:
+                    await render()
+                else:
+                    render(user)
+            print(f'{name:>9}: {(time.perf_counter() - start) / repeat * 1e6:6.2f}us per response')
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    bench_serializer()
@@ -11,13 +11,42 @@
 另外, response_model 支持使用 Union 来指定多个其中的一个,
 支持使用 List 来指定一个列表, 支持使用非 Pydantic 模型指定任意输出.
 
+真实的密码散列 (如 `hashlib.scrypt`) 单次需要数十毫秒的 CPU, 在 `async def` 中直接调用会阻塞事件循环,
+拖慢所有路由. `PasswordHasher` 将其放到有界的进程池中执行, 并限制同时排队的数量.
+
+`UserWriter` 为写后 (write-behind) 持久化: 将 `UserInDB` 放入队列, 按条数或时间窗口
+合并为一个 SQLite 事务提交, 提交完成后各调用方的 future 才返回, 从而避免每个请求一次 fsync.
+
+`patch_users` 使用 serialization.py 中的 `stream_response`, 逐个校验并写出列表元素.
+
+同步的 `put_user` 与 `patch_users` 在独立的线程池 `user_pool` 中执行, 不与其他同步路由争用默认线程池,
+其排队时间等统计见 `/debug/pools` 及 metrics.
+
+`read_keyword_weights` 的响应缓存在 `response_cache` 中 (带 ETag), `PUT /keyword-weights/` 修改后清除.
+
 """
 
-from typing import Optional, Union, List, Dict
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Union, List, Dict, Tuple
 
-from fastapi import FastAPI
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
 from pydantic import BaseModel, EmailStr
 
+from compression import compression_level
+from response_cache import ResponseCache, cached, invalidates, use_response_cache
+from serialization import ndjson_media_type, stream_response
+from thread_pools import ThreadPool, run_in_pool
+
 app = FastAPI()
 
 
@@ -43,29 +72,433 @@ def fake_password_hasher(raw_password: str):
     return "supersecret" + raw_password
 
 
-def fake_save_user(user_in: UserIn):
-    hashed_password = fake_password_hasher(user_in.password)
+def scrypt_hash(raw_password: str, salt: bytes, n: int, r: int, p: int) -> str:
+    """在子进程中执行, 因此需要是模块级函数"""
+    digest = hashlib.scrypt(raw_password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r)
+    return f'scrypt${n}${r}${p}${salt.hex()}${digest.hex()}'
+
+
+class HasherBusy(Exception):
+    """排队中的散列任务已达上限"""
+
+
+class PasswordHasher:
+    """基于进程池的 scrypt 散列服务
+
+    - n, r, p 为 scrypt 的工作因子, n 必须是 2 的幂
+    - max_workers 为进程数, max_pending 为允许同时提交 (含执行中) 的任务数, 超出时抛出 HasherBusy
+    - 进程池在首次使用时才创建
+    """
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1,
+                 max_workers: Optional[int] = None, max_pending: int = 64):
+        self.n, self.r, self.p = n, r, p
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def _run(self, raw_password: str, salt: bytes, n: int, r: int, p: int) -> str:
+        if self.pending >= self.max_pending:
+            raise HasherBusy()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, scrypt_hash, raw_password, salt, n, r, p)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, raw_password: str) -> str:
+        return await self._run(raw_password, os.urandom(16), self.n, self.r, self.p)
+
+    async def verify(self, raw_password: str, hashed_password: str) -> bool:
+        _, n, r, p, salt, _ = hashed_password.split('$')
+        rehashed = await self._run(raw_password, bytes.fromhex(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(rehashed, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
+
+
+def fake_save_user(user_in: UserIn, hashed_password: Optional[str] = None):
+    if hashed_password is None:
+        hashed_password = fake_password_hasher(user_in.password)
     user_in_db = UserInDB(**user_in.dict(), hashed_password=hashed_password)
     print("User saved! ..not really")
     return user_in_db
 
 
+class UserExists(Exception):
+    pass
+
+
+class UserWriter:
+    """批量写入 SQLite 的写后队列
+
+    - max_batch 为单个事务的最大条数, max_delay 为收到首条记录后最多等待的秒数
+    - 提交在单独的线程中执行, 不阻塞事件循环
+    - username 已存在的记录不会覆盖原有的行, 其调用方得到 UserExists, 同一批次的其他记录照常提交
+    - 有待写入的记录时才启动后台任务, 写完即退出, 不会在事件循环上留下常驻任务
+    - `close()` 关闭连接并结束提交线程, 之后再次写入时重新创建
+    """
+
+    def __init__(self, path: str, max_batch: int = 256, max_delay: float = 0.005):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.records = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Tuple[UserInDB, asyncio.Future]] = []
+        self._full: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=FULL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'username TEXT PRIMARY KEY, email TEXT NOT NULL, full_name TEXT, hashed_password TEXT NOT NULL)'
+            )
+        return self._conn
+
+    def _commit(self, users: List[UserInDB]) -> List[bool]:
+        """返回每条记录是否写入, False 表示 username 已存在"""
+        conn = self._connect()
+        with conn:
+            return [
+                conn.execute(
+                    'INSERT INTO users VALUES (?, ?, ?, ?) ON CONFLICT (username) DO NOTHING',
+                    (u.username, u.email, u.full_name, u.hashed_password)
+                ).rowcount == 1
+                for u in users
+            ]
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            if len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                inserted = await loop.run_in_executor(self.executor, self._commit, [u for u, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.batches += 1
+                self.records += sum(inserted)
+                for (user, future), ok in zip(batch, inserted):
+                    if future.done():
+                        continue
+                    if ok:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(UserExists(user.username))
+
+    async def save(self, user: UserInDB) -> UserInDB:
+        """提交所在批次后返回"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user, future))
+        if self._flusher is None or self._flusher.done():
+            self._full = asyncio.Event()
+            self._flusher = loop.create_task(self._flush())
+        elif len(self._pending) >= self.max_batch:
+            self._full.set()
+        await future
+        return user
+
+    async def close(self):
+        if self._flusher is not None:
+            await self._flusher
+            self._flusher = None
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+user_writer = UserWriter(os.environ.get('C15_USER_DB', os.path.join(tempfile.gettempdir(), 'c15_users.db')))
+user_pool = ThreadPool('c15-users', max_workers=8, max_queue=256)
+response_cache = ResponseCache(max_bytes=4 * 2 ** 20, ttl=60.0)
+keyword_weights = {"foo": 2.3, "bar": 3.4}
+
+
+@app.on_event('shutdown')
+async def shutdown_services():
+    password_hasher.shutdown()
+    user_pool.shutdown()
+    await user_writer.close()
+
+
 @app.post("/user/", response_model=UserOut)
 async def create_user(user_in: UserIn):
-    user_saved = fake_save_user(user_in)
-    return user_saved
+    try:
+        hashed_password = await password_hasher.hash(user_in.password)
+    except HasherBusy:
+        raise HTTPException(status_code=503, detail='Too many signups, retry later')
+    user_saved = fake_save_user(user_in, hashed_password)
+    try:
+        return await user_writer.save(user_saved)
+    except UserExists:
+        raise HTTPException(status_code=409, detail='Username already exists')
 
 
 @app.put("/user/", response_model=Union[UserInDB, UserOut])
+@run_in_pool(user_pool)
 def put_user(user_in: UserIn):
     return user_in
 
 
 @app.patch("/users/", response_model=List[UserOut])
+@compression_level(1)
+@run_in_pool(user_pool)
+@stream_response(UserOut)
 def patch_users(user_in: UserIn):
     return [user_in, ] * 3
 
 
 @app.get("/keyword-weights/", response_model=Dict[str, float])
+@cached(ttl=60.0)
 async def read_keyword_weights():
-    return {"foo": 2.3, "bar": 3.4}
+    return keyword_weights
+
+
+@app.put("/keyword-weights/", response_model=Dict[str, float])
+@invalidates(response_cache, read_keyword_weights)
+async def put_keyword_weights(weights: Dict[str, float]):
+    keyword_weights.update(weights)
+    return keyword_weights
+
+
+@app.get("/debug/pools", include_in_schema=False)
+async def read_pools():
+    return user_pool.stats()
+
+
+use_response_cache(app, response_cache)
+
+client = TestClient(app)
+
+user = {
+    'username': 'leo',
+    'email': 'leo@github.com',
+    'full_name': 'leo leo',
+    'password': 'pass_w0rd',
+}
+
+
+@pytest.fixture
+def users_db(tmp_path, monkeypatch):
+    """测试写入临时目录中的数据库, 不影响默认的数据库文件"""
+    writer = UserWriter(str(tmp_path / 'users.db'))
+    monkeypatch.setitem(globals(), 'user_writer', writer)
+    yield writer
+    asyncio.run(writer.close())
+    assert writer._executor is None
+
+
+def test_create_user(users_db):
+    resp = client.post('/user/', json=user)
+    assert resp.status_code == 200
+    assert resp.json() == {k: v for k, v in user.items() if k != 'password'}
+    # 已存在的用户名不覆盖
+    resp = client.post('/user/', json={**user, 'email': 'other@github.com'})
+    assert resp.status_code == 409
+    with sqlite3.connect(users_db.path) as conn:
+        assert conn.execute('SELECT email FROM users').fetchall() == [(user['email'],)]
+
+
+def test_patch_users():
+    """逐个写出的 JSON 数组与整体返回时相同, 也可以按 NDJSON 返回"""
+    user_out = {k: v for k, v in user.items() if k != 'password'}
+    resp = client.patch('/users/', json=user)
+    assert resp.json() == [user_out] * 3
+
+    resp = client.patch('/users/', json=user, headers={'Accept': ndjson_media_type})
+    assert resp.text.splitlines() == [json.dumps(user_out, separators=(',', ':'))] * 3
+
+
+def test_user_pool():
+    completed = user_pool.completed
+    assert client.put('/user/', json=user).status_code == 200
+    client.patch('/users/', json=user)
+    stats = client.get('/debug/pools').json()
+    assert stats['completed'] == completed + 2
+    assert (stats['active'], stats['queued']) == (0, 0)
+
+
+def test_keyword_weights_cache():
+    resp = client.get('/keyword-weights/')
+    assert resp.json() == keyword_weights
+    etag = resp.headers['etag']
+    hits = response_cache.hits
+    assert client.get('/keyword-weights/', headers={'if-none-match': etag}).status_code == 304
+    assert response_cache.hits == hits + 1
+
+    new_weights = {**keyword_weights, 'baz': 1.0}
+    assert client.put('/keyword-weights/', json={'baz': 1.0}).json() == new_weights
+    resp = client.get('/keyword-weights/', headers={'if-none-match': etag})
+    assert resp.status_code == 200
+    assert resp.json() == new_weights
+    del keyword_weights['baz']
+    response_cache.invalidate(read_keyword_weights)
+
+
+def test_password_hasher():
+    hasher = PasswordHasher(n=2 ** 10, max_workers=1)
+
+    async def main():
+        hashed = await hasher.hash('pass_w0rd')
+        assert hashed.startswith('scrypt$1024$8$1$')
+        assert await hasher.verify('pass_w0rd', hashed)
+        assert not await hasher.verify('pass_word', hashed)
+
+    try:
+        asyncio.run(main())
+    finally:
+        hasher.shutdown()
+
+
+def test_password_hasher_busy():
+    """超出 max_pending 时直接拒绝, 而不是无限排队"""
+    hasher = PasswordHasher(n=2 ** 10, max_workers=1, max_pending=0)
+    try:
+        with pytest.raises(HasherBusy):
+            asyncio.run(hasher.hash('pass_w0rd'))
+    finally:
+        hasher.shutdown()
+
+
+def test_user_writer_batches(tmp_path):
+    """并发保存的记录合并为少量事务提交, 提交后可从数据库中读出"""
+    writer = UserWriter(str(tmp_path / 'users.db'), max_batch=8, max_delay=0.05)
+    users = [UserInDB(**{**user, 'username': f'user{i}'}, hashed_password='x') for i in range(20)]
+
+    async def main():
+        await asyncio.gather(*(writer.save(u) for u in users))
+        await writer.close()
+
+    asyncio.run(main())
+    assert writer.records == 20
+    assert writer.batches == 3
+    # 同一批次中重复的用户名只写入第一条, 其他记录不受影响
+    duplicate = UserInDB(**{**user, 'username': 'user0', 'email': 'other@github.com'}, hashed_password='y')
+    new = UserInDB(**{**user, 'username': 'user20'}, hashed_password='x')
+
+    async def save_again():
+        results = await asyncio.gather(writer.save(duplicate), writer.save(new), return_exceptions=True)
+        await writer.close()
+        return results
+
+    results = asyncio.run(save_again())
+    assert isinstance(results[0], UserExists)
+    assert results[1] == new
+    assert writer.records == 21
+    with sqlite3.connect(writer.path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM users').fetchone() == (21,)
+
+
+def bench_write_behind(total=5000, concurrency=500):
+    """不同时间窗口下的写入吞吐量, 窗口为 0 时基本退化为逐条提交"""
+    user_in_db = UserInDB(**user, hashed_password='x')
+
+    async def run(writer):
+        sem = asyncio.Semaphore(concurrency)
+
+        async def save(i):
+            async with sem:
+                await writer.save(user_in_db.copy(update={'username': f'user{i}'}))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(save(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+        await writer.close()
+        return elapsed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for window in (0, 0.001, 0.005, 0.02):
+            writer = UserWriter(os.path.join(tmp, f'{window}.db'), max_batch=1 if window == 0 else 512,
+                                max_delay=window)
+            elapsed = asyncio.run(run(writer))
+            print(f'window={window * 1e3:5.1f}ms  {total / elapsed:10.0f} records/s  '
+                  f'{writer.batches} batches, avg {writer.records / writer.batches:.1f}')
+
+
+def bench_signup_load(signups=64, probe_interval=0.005):
+    """并发注册时, 其他路由 (read_keyword_weights) 的延迟
+
+    inline 为在事件循环中直接计算 scrypt, pool 为使用进程池
+    """
+    user_in = UserIn(**user)
+
+    async def inline_signup():
+        salt = os.urandom(16)
+        hashed = scrypt_hash(user_in.password, salt, password_hasher.n, password_hasher.r, password_hasher.p)
+        return UserInDB(**user_in.dict(), hashed_password=hashed)
+
+    async def pool_signup():
+        return UserInDB(**user_in.dict(), hashed_password=await password_hasher.hash(user_in.password))
+
+    async def run(signup):
+        latencies = []
+        done = asyncio.Event()
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.create_task(read_keyword_weights())
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(probe_interval)
+
+        async def burst():
+            await asyncio.gather(*(signup() for _ in range(signups)))
+            done.set()
+
+        start = time.perf_counter()
+        await asyncio.gather(probe(), burst())
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if len(latencies) > 1 else latencies[-1]
+        return elapsed, len(latencies), p99, latencies[-1]
+
+    for name, signup in (('inline', inline_signup), ('pool', pool_signup)):
+        # 预热进程池, 避免将进程启动时间计入
+        asyncio.run(pool_signup())
+        elapsed, probes, p99, worst = asyncio.run(run(signup))
+        print(f'{name:>6}: {signups} signups in {elapsed:.2f}s, '
+              f'{probes} probes, p99 {p99 * 1e3:.2f}ms, max {worst * 1e3:.2f}ms')
+    password_hasher.shutdown()
+
+
+if __name__ == '__main__':
+    bench_signup_load()
+    bench_write_behind()
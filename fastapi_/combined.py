@@ -0,0 +1,201 @@
+# coding: utf-8
+
+"""将所有章节的应用挂载到同一个应用下
+
+各章节模块 `cNN_*.py` 挂载在 `/cNN` 下, 如 `/c01/`, `/c15/user/`. 响应经 `CompressionMiddleware` 压缩.
+章节模块在收到第一个请求时才导入 (在线程池中执行, 不阻塞其他章节的请求), 随后运行其 startup 事件,
+应用关闭时运行已加载章节的 shutdown 事件. `/chapters` 列出各章节是否已加载及加载耗时,
+`/metrics` 为各路由 (如 `/c02/items/{item_id}`) 的延迟统计, `/debug/loop-stalls` 为事件循环被阻塞的记录.
+各章节仍与单独运行时一样在导入时创建 `client = TestClient(app)`, 这部分开销随章节的首次请求产生,
+计入下面 `--import-times` 中该章节的耗时.
+
+    uvicorn combined:app
+
+`--import-times` 在独立的进程中以 `-X importtime` 逐个导入各章节, 给出每个章节冷启动的导入耗时:
+先导入 fastapi, 因此结果不含各章节共用的部分, 另列出每个章节自身最耗时的几个导入.
+
+    python combined.py --import-times --top 3
+"""
+
+import argparse
+import asyncio
+import glob
+import importlib
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from compression import CompressionMiddleware
+from metrics import instrument_routes, use_metrics
+from watchdog import use_watchdog
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def chapter_modules() -> List[str]:
+    return sorted(os.path.basename(path)[:-3] for path in glob.glob(os.path.join(here, 'c[0-9][0-9]_*.py')))
+
+
+class LazyChapter:
+    """第一次请求时导入章节模块, 之后直接转发给其中的 app"""
+
+    def __init__(self, module: str):
+        self.module = module
+        self.app: Optional[ASGIApp] = None
+        self.load_seconds: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def load(self) -> ASGIApp:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.app is None:
+                start = time.perf_counter()
+                app = (await run_in_threadpool(importlib.import_module, self.module)).app
+                instrument_routes(app)
+                await app.router.startup()
+                self.load_seconds = time.perf_counter() - start
+                self.app = app
+        return self.app
+
+    async def shutdown(self):
+        if self.app is not None:
+            await self.app.router.shutdown()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        app = self.app or await self.load()
+        await app(scope, receive, send)
+
+
+chapters: Dict[str, LazyChapter] = {
+    '/' + module.split('_')[0]: LazyChapter(module) for module in chapter_modules()
+}
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, minimum_size=1024, level=6)
+
+for prefix, chapter in chapters.items():
+    app.mount(prefix, chapter)
+
+
+@app.get('/chapters')
+async def read_chapters():
+    return [
+        {
+            'prefix': prefix,
+            'module': chapter.module,
+            'loaded': chapter.app is not None,
+            'load_ms': None if chapter.load_seconds is None else chapter.load_seconds * 1e3,
+        }
+        for prefix, chapter in chapters.items()
+    ]
+
+
+@app.on_event('shutdown')
+async def shutdown_chapters():
+    for chapter in chapters.values():
+        await chapter.shutdown()
+
+
+watchdog = use_watchdog(app, threshold=0.1)
+use_metrics(app)
+
+
+class ImportTime(NamedTuple):
+    name: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse_importtime(output: str) -> List[ImportTime]:
+    """解析 `-X importtime` 的输出, depth 为缩进层级, 0 表示被直接导入"""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        stripped = name.lstrip(' ')
+        rows.append(ImportTime(stripped, int(self_us), int(cumulative_us), (len(name) - len(stripped) - 1) // 2))
+    return rows
+
+
+def import_times(module: str, preload: str = 'fastapi') -> List[ImportTime]:
+    """在新的进程中导入 module, 返回 module 自身及其导入的 (preload 中未导入过的) 各模块的耗时"""
+    code = f'import {preload}; import {module}' if preload else f'import {module}'
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=here, capture_output=True, text=True, check=True
+    )
+    rows = parse_importtime(proc.stderr)
+    # 输出按导入完成的顺序排列, module 本身在最后, 其前面直到上一个顶层导入为其依赖
+    end = max(i for i, row in enumerate(rows) if row.depth == 0 and row.name == module)
+    start = max((i for i, row in enumerate(rows[:end]) if row.depth == 0), default=-1) + 1
+    return rows[start: end + 1]
+
+
+def import_report(modules: List[str], top: int = 3) -> str:
+    baseline = import_times('fastapi', preload='')[-1]
+    lines = [f'{"fastapi (shared)":<40} {baseline.cumulative_us / 1e3:8.1f}ms']
+    for module in modules:
+        rows = import_times(module)
+        total = rows[-1]
+        heaviest = sorted(rows[:-1], key=lambda row: row.self_us, reverse=True)[:top]
+        detail = ', '.join(f'{row.name} {row.self_us / 1e3:.1f}ms' for row in heaviest)
+        lines.append(f'{module:<40} {total.cumulative_us / 1e3:8.1f}ms  self {total.self_us / 1e3:6.1f}ms  {detail}')
+    return '\n'.join(lines)
+
+
+@pytest.fixture
+def current_loop():
+    """starlette 0.13 的 TestClient 进入时使用当前线程的事件循环, 而之前测试中的 asyncio.run 结束时会将其清除"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def test_lazy_chapters(current_loop):
+    with TestClient(app) as client:
+        assert client.get('/c01/').json() == {'message': 'hello world'}
+        assert client.get('/c13/items/', headers={'user-agent': 'combined'}).json() == {'User-Agent': 'combined'}
+        rows = {row['prefix']: row for row in client.get('/chapters').json()}
+        assert set(rows) == set(chapters)
+        assert rows['/c01']['loaded'] and rows['/c01']['load_ms'] >= 0
+        assert 'http_request_duration_seconds_count{route="/c13/items/",method="GET",status="200"}' in \
+            client.get('/metrics').text
+        assert client.get('/debug/loop-stalls').json()['threshold'] == watchdog.threshold
+
+
+def test_import_times():
+    rows = import_times('c01_first_steps')
+    assert rows[-1].name == 'c01_first_steps'
+    assert rows[-1].depth == 0
+    assert 'fastapi' not in {row.name for row in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='所有章节的合并应用')
+    parser.add_argument('--import-times', action='store_true', help='输出各章节的导入耗时')
+    parser.add_argument('--only', nargs='*', help='模块名前缀, 如 c02 c03')
+    parser.add_argument('--top', type=int, default=3, help='每个章节列出的最耗时的导入数')
+    args = parser.parse_args()
+
+    if args.import_times:
+        modules = [m for m in chapter_modules() if not args.only or any(m.startswith(p) for p in args.only)]
+        print(import_report(modules, args.top))
+    else:
+        import uvicorn
+        uvicorn.run(app)
+
+
+if __name__ == '__main__':
+    main()
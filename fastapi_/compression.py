@@ -0,0 +1,380 @@
+# coding: utf-8
+
+"""基于 zlib 的流式 gzip/deflate 压缩中间件
+
+1. 按请求头 Accept-Encoding (含 q 值) 选择 gzip 或 deflate, 都不接受时原样返回
+
+2. 响应体小于 minimum_size 时不压缩; 已设置 Content-Encoding, 或媒体类型本身已压缩 (图片, 视频, zip 等) 时也不压缩
+
+3. 流式响应 (如 serialization.py 的 `stream_response`) 逐块压缩, 每块以 Z_SYNC_FLUSH 结束, 客户端可以立即解压已收到的部分,
+   不会缓存整个响应体; 开头不足 minimum_size 的部分会先缓存, 以判断是否需要压缩.
+   压缩后的 Content-Length: 一次发送的响应体设为压缩后的长度, 流式响应则去掉
+
+4. 压缩后的响应体与原响应体不再逐字节相同, 因此其 ETag 改为弱 ETag (`W/"..."`), 判断 If-None-Match 时
+   需按弱比较 (去掉 `W/` 后比较). 经过压缩的路由返回的 304 同样改为弱 ETag, 并带 `Vary: Accept-Encoding`
+
+5. 视图函数上的 `compression_level(level)` 可以单独指定该路由的压缩级别, 0 表示不压缩.
+   需放在其他装饰器的外层 (即最上方的 `@app.xxx` 之下)
+
+    app.add_middleware(CompressionMiddleware, minimum_size=1024, level=6)
+
+    python compression.py
+"""
+
+import asyncio
+import gzip
+import json
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from serialization import ChunkedResponse
+
+# 已压缩的格式再压缩几乎没有收益
+incompressible_types = ('image/', 'video/', 'audio/', 'application/zip', 'application/gzip', 'application/x-gzip')
+
+
+def accept_encoding_qualities(accept_encoding: str) -> Dict[str, float]:
+    """解析 Accept-Encoding 请求头, 返回 {编码: q 值}, 未写 q 值时为 1"""
+    qualities = {}
+    for coding in accept_encoding.lower().split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip()
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            qualities[name] = q
+    return qualities
+
+
+def negotiate_encoding(accept_encoding: str, encodings: Tuple[str, ...] = ('gzip', 'deflate')) -> Optional[str]:
+    """从 encodings 中选出客户端接受且 q 值最高的编码, 都不接受时返回 None
+
+    明确列出的编码优先于 `*`, 如 `*;q=0, gzip` 接受 gzip, `gzip;q=0, *` 不接受; q 值相同时优先排在前面的编码
+    """
+    qualities = accept_encoding_qualities(accept_encoding)
+    star = qualities.get('*', 0.0)
+    best = max(encodings, key=lambda name: (qualities.get(name, star), -encodings.index(name)))
+    return best if qualities.get(best, star) > 0 else None
+
+
+def weaken_etag(headers: MutableHeaders):
+    etag = headers.get('etag')
+    if etag is not None and not etag.startswith('W/'):
+        headers['etag'] = 'W/' + etag
+
+
+def compression_level(level: int) -> Callable:
+    """指定路由的压缩级别 (0-9), 0 表示不压缩"""
+
+    def decorator(func: Callable) -> Callable:
+        func.compression_level = level
+        return func
+
+    return decorator
+
+
+def compressor(encoding: str, level: int):
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, level: int = 6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressionResponder(self, scope, encoding, send)(receive)
+
+
+class CompressionResponder:
+    """处理单个响应: 先缓存 start 消息, 根据状态码, 响应头和开头的数据决定是否压缩"""
+
+    def __init__(self, middleware: CompressionMiddleware, scope: Scope, encoding: str, send: Send):
+        self.middleware = middleware
+        self.scope = scope
+        self.encoding = encoding
+        self.send = send
+        self.start: Optional[Message] = None
+        self.pending: List[bytes] = []
+        self.pending_size = 0
+        # None: 尚未决定; True: 压缩; False: 原样转发
+        self.compress: Optional[bool] = None
+        self.compressobj = None
+
+    async def __call__(self, receive: Receive):
+        await self.middleware.app(self.scope, receive, self.send_wrapper)
+
+    def level(self) -> int:
+        # 路由匹配后 scope 中有 endpoint
+        return getattr(self.scope.get('endpoint'), 'compression_level', self.middleware.level)
+
+    async def send_wrapper(self, message: Message):
+        if message['type'] == 'http.response.start':
+            self.start = message
+            headers = Headers(raw=message['headers'])
+            content_length = headers.get('content-length')
+            if message['status'] == 304 and self.level() != 0:
+                # 与可能已被压缩的 200 响应保持一致
+                headers = MutableHeaders(raw=list(message['headers']))
+                headers.add_vary_header('Accept-Encoding')
+                weaken_etag(headers)
+                message = {**message, 'headers': headers.raw}
+            if (message['status'] < 200 or message['status'] in (204, 304) or self.scope['method'] == 'HEAD'
+                    or 'content-encoding' in headers
+                    or headers.get('content-type', '').startswith(incompressible_types)
+                    or (content_length is not None and int(content_length) < self.middleware.minimum_size)
+                    or self.level() == 0):
+                self.compress = False
+                await self.send(message)
+            return
+
+        if message['type'] != 'http.response.body' or self.compress is False:
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.compress is None:
+            self.pending.append(body)
+            self.pending_size += len(body)
+            if self.pending_size < self.middleware.minimum_size:
+                if more_body:
+                    return
+                # 整个响应体都小于阈值
+                self.compress = False
+                await self.send(self.start)
+                await self.send({'type': 'http.response.body', 'body': b''.join(self.pending)})
+                return
+            self.compress = True
+            self.compressobj = compressor(self.encoding, self.level())
+            body = b''.join(self.pending)
+            self.pending = []
+            data = self.compress_chunk(body, more_body)
+            await self.start_compression(None if more_body else len(data))
+        else:
+            data = self.compress_chunk(body, more_body)
+        await self.send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+    def compress_chunk(self, body: bytes, more_body: bool) -> bytes:
+        data = self.compressobj.compress(body)
+        return data + self.compressobj.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+
+    async def start_compression(self, content_length: Optional[int]):
+        """content_length 为压缩后的长度, 流式响应为 None"""
+        headers = MutableHeaders(raw=list(self.start['headers']))
+        headers['content-encoding'] = self.encoding
+        headers.add_vary_header('Accept-Encoding')
+        weaken_etag(headers)
+        if content_length is None:
+            if 'content-length' in headers:
+                del headers['content-length']
+        else:
+            headers['content-length'] = str(content_length)
+        await self.send({**self.start, 'headers': headers.raw})
+
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+
+@app.get('/small')
+async def small():
+    return {'message': 'hello'}
+
+
+@app.get('/large')
+async def large():
+    return {'items': list(range(1000))}
+
+
+@app.get('/fast')
+@compression_level(1)
+async def fast():
+    return {'items': list(range(1000))}
+
+
+@app.get('/raw')
+@compression_level(0)
+async def raw():
+    return {'items': list(range(1000))}
+
+
+@app.get('/encoded')
+async def encoded():
+    return Response(gzip.compress(b'x' * 1000), headers={'content-encoding': 'gzip'})
+
+
+@app.get('/stream')
+async def stream():
+    async def lines():
+        for i in range(100):
+            yield json.dumps({'i': i, 'text': 'x' * 20}).encode() + b'\n'
+
+    return ChunkedResponse(lines(), media_type='application/x-ndjson')
+
+
+@app.get('/tagged')
+async def tagged(request: Request):
+    etag = '"items-v1"'
+    tags = [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]
+    if etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags):
+        return Response(status_code=304, headers={'etag': etag})
+    return JSONResponse({'items': list(range(1000))}, headers={'etag': etag})
+
+
+client = TestClient(app)
+
+
+def asgi_call(app: ASGIApp, path: str, accept_encoding: Optional[str]) -> List[Message]:
+    headers = [] if accept_encoding is None else [(b'accept-encoding', accept_encoding.encode())]
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+             'query_string': b'', 'headers': headers, 'scheme': 'http', 'server': ('test', 80),
+             'http_version': '1.1', 'asgi': {'version': '3.0'}}
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding('gzip, deflate, br') == 'gzip'
+    assert negotiate_encoding('deflate, gzip;q=0.5') == 'deflate'
+    assert negotiate_encoding('gzip;q=0, deflate') == 'deflate'
+    assert negotiate_encoding('*') == 'gzip'
+    assert negotiate_encoding('br, identity') is None
+    assert negotiate_encoding('') is None
+    assert negotiate_encoding('gzip;level=1;q=0, deflate;q=0.1') == 'deflate'
+    # 明确列出的编码优先于 *
+    assert negotiate_encoding('*;q=0, gzip', ('gzip',)) == 'gzip'
+    assert negotiate_encoding('*, gzip;q=0', ('gzip',)) is None
+    assert negotiate_encoding('identity;q=1, *;q=0.5', ('gzip',)) == 'gzip'
+
+
+def test_compression():
+    expected = json.dumps({'items': list(range(1000))}, separators=(',', ':')).encode()
+
+    resp = client.get('/small', headers={'accept-encoding': 'gzip'})
+    assert 'content-encoding' not in resp.headers
+
+    for path in ('/large', '/fast'):
+        resp = client.get(path, headers={'accept-encoding': 'gzip'})
+        assert resp.headers['content-encoding'] == 'gzip'
+        assert resp.headers['vary'] == 'Accept-Encoding'
+        assert resp.content == expected
+
+    # /fast 使用级别 1
+    for path, level in (('/large', 6), ('/fast', 1)):
+        c = compressor('gzip', level)
+        assert asgi_call(app, path, 'gzip')[1]['body'] == c.compress(expected) + c.flush()
+
+    messages = asgi_call(app, '/large', 'deflate')
+    assert zlib.decompress(messages[1]['body']) == expected
+
+    # Content-Length 为压缩后实际发送的长度
+    for encoding in ('gzip', 'deflate'):
+        messages = asgi_call(app, '/large', encoding)
+        headers = Headers(raw=messages[0]['headers'])
+        assert int(headers['content-length']) == len(messages[1]['body']) < len(expected)
+
+    assert 'content-encoding' not in client.get('/raw', headers={'accept-encoding': 'gzip'}).headers
+    assert 'content-encoding' not in client.get('/large', headers={'accept-encoding': 'identity'}).headers
+    assert client.get('/encoded', headers={'accept-encoding': 'gzip'}).content == b'x' * 1000
+
+
+def test_compression_etag():
+    resp = client.get('/tagged', headers={'accept-encoding': 'identity'})
+    assert resp.headers['etag'] == '"items-v1"'
+
+    # 压缩后的响应体与原响应体不同, 只能是弱 ETag
+    resp = client.get('/tagged', headers={'accept-encoding': 'gzip'})
+    assert resp.headers['content-encoding'] == 'gzip'
+    etag = resp.headers['etag']
+    assert etag == 'W/"items-v1"'
+
+    resp = client.get('/tagged', headers={'accept-encoding': 'gzip', 'if-none-match': etag})
+    assert resp.status_code == 304
+    assert resp.headers['etag'] == etag
+    assert resp.headers['vary'] == 'Accept-Encoding'
+
+
+def test_streaming_compression():
+    messages = asgi_call(app, '/stream', 'gzip')
+    headers = Headers(raw=messages[0]['headers'])
+    assert headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in headers
+
+    # 每块都可以立即解压, 不需要等待后续数据
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    bodies = [m['body'] for m in messages[1:]]
+    assert len(bodies) > 10
+    lines = []
+    for body in bodies:
+        lines += decompressor.decompress(body).splitlines()
+    assert [json.loads(line)['i'] for line in lines] == list(range(100))
+
+
+def bench_compression(sizes=(1024, 16 * 1024, 256 * 1024, 4 * 1024 * 1024), levels=(1, 6, 9), repeat=20):
+    """不同大小的 JSON 响应在各压缩级别下的 CPU 耗时与节省的字节数"""
+    for size in sizes:
+        offer = {'name': 'offer', 'price': 9.9, 'items': []}
+        while len(json.dumps(offer)) < size:
+            i = len(offer['items'])
+            offer['items'].append({'name': f'item{i}', 'description': 'A very nice Item', 'price': i * 0.1,
+                                   'tax': 0.5, 'tags': ['rock', 'metal'], 'images': None})
+        payload = json.dumps(offer).encode()
+
+        async def endpoint(scope, receive, send):
+            await Response(payload, media_type='application/json')(scope, receive, send)
+
+        def run(app, accept_encoding):
+            start = time.process_time()
+            for _ in range(repeat):
+                messages = asgi_call(app, '/', accept_encoding)
+            return (time.process_time() - start) / repeat, sum(len(m.get('body', b'')) for m in messages)
+
+        base, _ = run(endpoint, None)
+        print(f'{len(payload):>9} bytes  identity  cpu {base * 1e3:8.3f}ms')
+        for level in levels:
+            cpu, sent = run(CompressionMiddleware(endpoint, minimum_size=0, level=level), 'gzip')
+            extra = max(cpu - base, 0)
+            # 很小的响应压缩耗时在误差范围内
+            rate = f'{(len(payload) - sent) / extra / 2 ** 20:8.1f} MB saved per cpu-second' if extra > 1e-5 else ''
+            print(f'{"":>9}        gzip-{level}    cpu {cpu * 1e3:8.3f}ms  (+{extra * 1e3:7.3f}ms)  '
+                  f'sent {sent:>9}  saved {1 - sent / len(payload):6.1%}  {rate}')
+
+
+if __name__ == '__main__':
+    bench_compression()
@@ -0,0 +1,300 @@
+# coding: utf-8
+
+"""可替换的 JSON 编解码
+ref: https://fastapi.tiangolo.com/zh/advanced/custom-request-and-route/
+
+默认每个请求体用 `json.loads` 解析, 返回值先经 `jsonable_encoder` 转为只含基本类型的字典,
+再由 `json.dumps` 编码. 使用路由类 `CodecRoute` 的路由 (`app.router.route_class = CodecRoute`,
+或在所有路由注册后调用 `use_fast_json(app)` 替换已有的路由):
+
+1. 请求体由 `loads` 解析, 响应由 `CodecJSONResponse` 以 `dumps` 编码.
+   安装了 orjson 时使用 orjson, 否则使用标准库 json.
+
+2. 不再经过 `jsonable_encoder`: 视图函数的返回值仍按 response_model 校验并处理 include/exclude 等参数,
+   但 `UUID`, `datetime`, `timedelta`, `Decimal` 等直接交给编码器处理, 输出与原来相同.
+   orjson 会将 NaN/Infinity 编码为 null, 标准库则报错; 超过 64 位的整数 orjson 不支持, 交给标准库编码.
+
+只有使用 CodecRoute 的路由受影响, FastAPI 本身与其他应用不变.
+
+    python fast_json.py
+"""
+
+import asyncio
+import json
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Callable, Coroutine, Dict, List, Optional
+from uuid import UUID
+
+import fastapi.routing
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute, _prepare_response_content, request_response
+from fastapi.testclient import TestClient
+from pydantic import BaseModel, Field, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.json import pydantic_encoder
+from starlette.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def default(obj: Any) -> Any:
+    """编码器不支持的类型, 与 jsonable_encoder 的结果相同"""
+    if isinstance(obj, BaseModel):
+        return obj.dict(by_alias=True)
+    return pydantic_encoder(obj)
+
+
+def json_dumps(obj: Any) -> bytes:
+    return json.dumps(
+        obj, default=default, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def orjson_dumps(obj: Any) -> bytes:
+    try:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # 如超过 64 位的整数, 交给标准库编码 (或报出与标准库相同的错误)
+        return json_dumps(obj)
+
+
+backends = {'json': (json_dumps, json.loads)}
+if orjson is not None:
+    backends['orjson'] = (orjson_dumps, orjson.loads)
+
+backend = 'orjson' if orjson is not None else 'json'
+dumps, loads = backends[backend]
+
+
+def set_backend(name: str):
+    global backend, dumps, loads
+    dumps, loads = backends[name]
+    backend = name
+
+
+class CodecJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class CodecRequest(Request):
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            # orjson.JSONDecodeError 是 json.JSONDecodeError 的子类, FastAPI 仍返回 422
+            self._json = loads(await self.body())
+        return self._json
+
+
+def _to_content(value: Any, **kwargs) -> Any:
+    if isinstance(value, BaseModel):
+        return value.dict(**kwargs)
+    if isinstance(value, (list, tuple)):
+        return [_to_content(v, **kwargs) for v in value]
+    if isinstance(value, dict) and not (kwargs['include'] or kwargs['exclude']):
+        return {k: _to_content(v, **kwargs) for k, v in value.items()}
+    return value
+
+
+async def serialize_response(*, field=None, response_content: Any, include=None, exclude=None,
+                             by_alias: bool = True, exclude_unset: bool = False,
+                             exclude_defaults: bool = False, exclude_none: bool = False,
+                             is_coroutine: bool = True) -> Any:
+    """与 fastapi.routing.serialize_response 相同, 但校验后直接返回模型或原始值"""
+    kwargs = dict(include=include, exclude=exclude, by_alias=by_alias, exclude_unset=exclude_unset,
+                  exclude_defaults=exclude_defaults, exclude_none=exclude_none)
+    if not field:
+        return response_content
+
+    response_content = _prepare_response_content(
+        response_content, exclude_unset=exclude_unset, exclude_defaults=exclude_defaults, exclude_none=exclude_none
+    )
+    if is_coroutine:
+        value, errors_ = field.validate(response_content, {}, loc=("response",))
+    else:
+        value, errors_ = await run_in_threadpool(field.validate, response_content, {}, loc=("response",))
+    errors = [errors_] if isinstance(errors_, ErrorWrapper) else errors_ or []
+    if errors:
+        raise ValidationError(errors, field.type_)
+    if isinstance(value, dict) and (include or exclude):
+        # 字典的 include/exclude 作用于键, 交给 jsonable_encoder 处理
+        return jsonable_encoder(value, **kwargs)
+    return _to_content(value, **kwargs)
+
+
+class CodecRoute(APIRoute):
+    """请求体由 loads 解析; 响应类为 JSONResponse 时, 替换 dependant.call, 由返回值直接生成 CodecJSONResponse
+
+    与 c14 的 SerializedRoute 相同, FastAPI 对返回的 Response 不再做处理 (后台任务除外),
+    因此这里合并子响应的状态码与响应头. 视图函数未声明 `Response` 参数时, 以 `_sub_response` 为名取得子响应.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        response_class = self.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+        if response_class in (JSONResponse, CodecJSONResponse):
+            self._encode_in_call()
+        handler = super().get_route_handler()
+
+        async def codec_route_handler(request: Request) -> Response:
+            return await handler(CodecRequest(request.scope, request.receive))
+
+        return codec_route_handler
+
+    def _encode_in_call(self):
+        dependant = self.dependant
+        # 重新生成处理函数时不重复包装
+        endpoint = getattr(dependant.call, 'codec_endpoint', dependant.call)
+        declared = dependant.response_param_name not in (None, '_sub_response')
+        if not declared:
+            dependant.response_param_name = '_sub_response'
+        response_param = dependant.response_param_name
+        status_code = self.status_code or 200
+        is_coroutine = asyncio.iscoroutinefunction(endpoint)
+        field = self.secure_cloned_response_field
+        kwargs = dict(
+            include=self.response_model_include, exclude=self.response_model_exclude,
+            by_alias=self.response_model_by_alias, exclude_unset=self.response_model_exclude_unset,
+            exclude_defaults=self.response_model_exclude_defaults, exclude_none=self.response_model_exclude_none,
+        )
+
+        async def call(**values):
+            sub_response = values[response_param] if declared else values.pop(response_param)
+            if is_coroutine:
+                obj = await endpoint(**values)
+            else:
+                obj = await run_in_threadpool(endpoint, **values)
+            if isinstance(obj, Response):
+                return obj
+            content = await serialize_response(field=field, response_content=obj, is_coroutine=is_coroutine, **kwargs)
+            response = CodecJSONResponse(content, status_code=sub_response.status_code or status_code)
+            response.headers.raw.extend(sub_response.headers.raw)
+            return response
+
+        call.codec_endpoint = endpoint
+        dependant.call = call
+
+
+def use_fast_json(app: FastAPI):
+    """将 app 中已有的 APIRoute 替换为 CodecRoute, 之后注册的路由也使用 CodecRoute"""
+    app.router.route_class = CodecRoute
+    for route in app.routes:
+        if type(route) is not APIRoute:
+            continue
+        route.__class__ = CodecRoute
+        route.app = request_response(route.get_route_handler())
+
+
+class Color(str, Enum):
+    red = 'red'
+
+
+class Item(BaseModel):
+    item_id: UUID
+    name: str
+    price: Decimal
+    start: datetime
+    day: date
+    duration: timedelta
+    color: Color = Color.red
+    tags: List[str] = []
+    note: Optional[str] = None
+
+
+class ItemOut(Item):
+    alias_name: str = Field('x', alias='aliasName')
+
+
+router = APIRouter()
+
+
+@router.post('/items/', response_model=ItemOut, response_model_exclude={'tags'}, status_code=201)
+async def create_item(item: Item, response: Response):
+    response.headers['location'] = f'/items/{item.item_id}'
+    return item
+
+
+@router.post('/items/bulk/', response_model=List[Item], response_model_exclude_unset=True)
+def create_items(items: List[Item]):
+    return items
+
+
+@router.post('/raw/')
+async def raw(payload: Dict[str, Any]):
+    return {'payload': payload, 'weights': {1: 0.5, 2: 1.0}, 'set': {1}, 'item': Item(**payload),
+            'when': datetime(2021, 3, 15, 10, 0, 0, 123456), 'money': Decimal('1.10'), 'text': '你好',
+            'big': 2 ** 70}
+
+
+app = FastAPI()
+app.include_router(router)
+use_fast_json(app)
+
+# 对照: 相同的路由使用 FastAPI 默认的编解码
+plain_app = FastAPI()
+plain_app.include_router(router)
+
+client = TestClient(app)
+plain_client = TestClient(plain_app)
+
+
+item = {
+    'item_id': '1a5f8e5c-3b5e-4a4c-9b6e-8f0e5d2b2c11', 'name': 'Foo', 'price': '9.90',
+    'start': '2021-03-15T10:00:00+08:00', 'day': '2021-03-15', 'duration': 600.5,
+}
+
+
+def test_same_as_fastapi():
+    requests = [
+        ('/items/', item), ('/items/', {**item, 'tags': ['a'], 'note': 'n'}), ('/items/bulk/', [item, item]),
+        ('/raw/', item), ('/items/', {**item, 'price': 'x'}),
+    ]
+    for name in backends:
+        set_backend(name)
+        try:
+            for path, body in requests:
+                expected = plain_client.post(path, json=body)
+                resp = client.post(path, json=body)
+                assert resp.status_code == expected.status_code
+                assert resp.content == expected.content, (name, path)
+                assert resp.headers.get('location') == expected.headers.get('location')
+            resp = client.post('/items/', headers={'content-type': 'application/json'}, data=b'{"name": ')
+            assert resp.status_code == 422
+        finally:
+            set_backend('orjson' if orjson is not None else 'json')
+
+
+def test_scoped_to_codec_routes():
+    """FastAPI 本身不被修改, 未使用 CodecRoute 的路由照常处理"""
+    assert all(type(route) is APIRoute for route in plain_app.routes if isinstance(route, APIRoute))
+    assert plain_client.post('/items/', json=item).headers['content-length']
+    assert fastapi.routing.serialize_response is not serialize_response
+
+
+def bench_chapters(requests=2000, concurrency=50):
+    """各章节应用替换编解码前后的 RPS 与 p50"""
+    import importlib
+
+    from loadgen import endpoints, run
+
+    modules = list(endpoints)
+    before = asyncio.run(run(modules, requests, concurrency))
+    for name in modules:
+        use_fast_json(importlib.import_module(name).app)
+    after = asyncio.run(run(modules, requests, concurrency))
+    print(f'backend: {backend}')
+    for key, result in before.items():
+        print(f'{key:<70} rps {result["rps"]:7.0f} -> {after[key]["rps"]:7.0f}  '
+              f'p50 {result["p50_ms"]:6.2f}ms -> {after[key]["p50_ms"]:6.2f}ms')
+
+
+if __name__ == '__main__':
+    bench_chapters()
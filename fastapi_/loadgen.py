@@ -0,0 +1,357 @@
+# coding: utf-8
+
+"""各章节应用的进程内压测
+
+不经过 socket, 直接以 ASGI 协议调用各章节模块中的 `app`, 由多个协程并发发送请求,
+统计每个接口的 RPS, p50/p95/p99 延迟, 以及单个请求的内存分配峰值 (tracemalloc).
+状态码不是 2xx 的响应记为 errors, 不计入 RPS 与延迟. 会写入数据文件的模块 (如 c15 的用户数据库)
+压测期间改为写入临时目录, 见 `isolated_state`.
+
+1. 请求样例见 `endpoints`, 以模块名分组
+
+2. `--save-baseline` 将结果保存为基线, `--baseline` 与基线对比,
+   RPS 下降, p99 上升超过 `--tolerance`, 或 errors 增加时输出 REGRESSION 并以非零状态退出
+
+    python loadgen.py --only c02 c03 --save-baseline baseline.json
+    python loadgen.py --only c02 c03 --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import ModuleType
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlencode
+
+from starlette.types import ASGIApp
+
+
+class Endpoint(NamedTuple):
+    method: str
+    path: str
+    query: Optional[Dict[str, Any]] = None
+    # 为函数时每个请求调用一次, 用于需要唯一值的请求体 (如注册用户)
+    json: Any = None
+    headers: Optional[Dict[str, str]] = None
+    # 单个请求很重时可以减少请求数, 为相对 `--requests` 的比例
+    weight: float = 1.0
+
+
+item = {'name': 'Foo', 'description': 'The pretender', 'price': 42.0, 'tax': 3.2}
+user = {'username': 'dave', 'full_name': 'Dave Grohl'}
+image = {'url': 'http://example.com/baz.jpg', 'name': 'The Foo live'}
+user_in = {'username': 'leo', 'email': 'leo@github.com', 'full_name': 'leo leo', 'password': 'pass_w0rd'}
+signups = itertools.count()
+
+
+def new_user_in() -> Dict[str, Any]:
+    """用户名已存在时返回 409, 每次注册使用新的用户名"""
+    return {**user_in, 'username': f'loadgen-{os.getpid()}-{time.time_ns()}-{next(signups)}'}
+
+
+endpoints: Dict[str, List[Endpoint]] = {
+    'c01_first_steps': [
+        Endpoint('GET', '/'),
+    ],
+    'c02_path_params': [
+        Endpoint('GET', '/items/3'),
+        Endpoint('POST', '/items/3'),
+        Endpoint('GET', '/users/me'),
+        Endpoint('GET', '/users/leo'),
+        Endpoint('GET', '/models/alexnet'),
+        Endpoint('GET', '/not_path/a.txt'),
+    ],
+    'c03_query_params': [
+        Endpoint('GET', '/items/', {'skip': 0, 'limit': 2}),
+        Endpoint('GET', '/cursor_items/', {'limit': 2}),
+        Endpoint('GET', '/items/42', {'q': 'query'}),
+    ],
+    'c04_body': [
+        Endpoint('POST', '/items/', json=item),
+        Endpoint('PUT', '/items/42', {'q': 'query'}, json=item),
+    ],
+    'c05_query_params_str_validations': [
+        Endpoint('GET', '/items/', {'q': 'four'}),
+        Endpoint('GET', '/multi_q/', [('q', 'four'), ('q', 'five')]),
+    ],
+    'c06_path_params_numeric_validations': [
+        Endpoint('GET', '/items/42', {'item-query': 'query', 'size': 1}),
+    ],
+    'c07_body_multiple_params': [
+        Endpoint('POST', '/multi_body/42', json={'item': item, 'user': user}),
+        Endpoint('POST', '/body_mark/42', json={'item': item, 'user': user, 'importance': 5}),
+        Endpoint('POST', '/body_embed/42', json={'item': item}),
+    ],
+    'c08_body_fields': [
+        Endpoint('PUT', '/items/42', json={'item': item}),
+    ],
+    'c09_body_nested_models': [
+        Endpoint('POST', '/offers/', json={'name': 'offer', 'price': 9.9, 'items': [{**item, 'images': [image]}]}),
+        Endpoint('POST', '/offers/stream/', json={'name': 'offer', 'price': 9.9, 'items': [{**item, 'images': [image]}]}),
+        Endpoint('POST', '/images/multiple/', json=[image] * 2),
+        Endpoint('POST', '/index-weights/', json={'1': 5.5, '2': 2}),
+    ],
+    'c10_scheme_extra_example': [
+        Endpoint('PUT', '/items/42', json=item),
+        Endpoint('POST', '/items/42', json=item),
+        Endpoint('PATCH', '/items/42', json=item),
+    ],
+    'c11_extra_data_types': [
+        Endpoint('PUT', '/items/1a5f8e5c-3b5e-4a4c-9b6e-8f0e5d2b2c11', json={
+            'start_datetime': '2021-03-15T10:00:00', 'end_datetime': '2021-03-15T12:00:00',
+            'repeat_at': '08:00:00', 'process_after': 600,
+        }),
+    ],
+    'c12_cookie_params': [
+        Endpoint('GET', '/items/', headers={'cookie': 'ads_id=abc'}),
+    ],
+    'c13_header_params': [
+        Endpoint('GET', '/items/', headers={'user-agent': 'loadgen'}),
+        Endpoint('POST', '/items/', headers={'User_Agent': 'loadgen'}),
+        Endpoint('PATCH', '/items/', headers={'user-agent': 'loadgen'}),
+    ],
+    'c14_response_model': [
+        Endpoint('POST', '/users/', json={'user_name': 'leo', 'password': 'pass_w0rd', 'email': 'leo@github.com'}),
+        Endpoint('PUT', '/users/', json={'user_name': 'leo', 'password': 'pass_w0rd', 'email': 'leo@github.com'}),
+        Endpoint('GET', '/users/', {'count': 10}),
+    ],
+    'c15_extra_models': [
+        Endpoint('POST', '/user/', json=new_user_in, weight=0.05),
+        Endpoint('PUT', '/user/', json=user_in),
+        Endpoint('PATCH', '/users/', json=user_in),
+        Endpoint('GET', '/keyword-weights/'),
+    ],
+}
+
+
+def _temporary_user_db(module: ModuleType, tmp: str) -> Callable[[], None]:
+    original = module.user_writer
+    module.user_writer = module.UserWriter(os.path.join(tmp, 'users.db'))
+    return lambda: setattr(module, 'user_writer', original)
+
+
+# 压测期间将数据写入临时目录 tmp, 返回恢复原状的函数
+isolated_state: Dict[str, Callable[[ModuleType, str], Callable[[], None]]] = {
+    'c15_extra_models': _temporary_user_db,
+}
+
+
+async def asgi_request(app: ASGIApp, endpoint: Endpoint) -> Tuple[int, bytes]:
+    """直接调用 ASGI 应用, 返回状态码与响应体"""
+    payload = endpoint.json() if callable(endpoint.json) else endpoint.json
+    body = b'' if payload is None else json.dumps(payload).encode()
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in (endpoint.headers or {}).items()]
+    if endpoint.json is not None:
+        headers += [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': endpoint.method, 'scheme': 'http', 'server': ('loadgen', 80), 'client': ('127.0.0.1', 0),
+        'root_path': '', 'path': endpoint.path, 'raw_path': endpoint.path.encode(),
+        'query_string': urlencode(endpoint.query or {}).encode(), 'headers': headers,
+    }
+    status = 0
+    chunks = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # 请求体已读完, 之后的 receive 一直挂起, 直到响应结束
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return status, b''.join(chunks)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+async def measure(app: ASGIApp, endpoint: Endpoint, requests: int, concurrency: int) -> Dict[str, float]:
+    status, body = await asgi_request(app, endpoint)
+    if status >= 400:
+        raise RuntimeError(f'{endpoint.method} {endpoint.path} returned {status}: {body[:200]!r}')
+
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            status, _ = await asgi_request(app, endpoint)
+            if 200 <= status < 300:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        raise RuntimeError(f'{endpoint.method} {endpoint.path}: all {errors} requests failed')
+    latencies.sort()
+
+    # 单独串行执行若干次, 统计每个请求的内存分配峰值
+    samples = max(requests // 20, 1)
+    tracemalloc.start()
+    peak = 0
+    for _ in range(samples):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        await asgi_request(app, endpoint)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1e3,
+        'p95_ms': percentile(latencies, 0.95) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'alloc_peak_kb': peak / 1024,
+    }
+
+
+async def run(modules: List[str], requests: int, concurrency: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name in modules:
+        module = importlib.import_module(name)
+        app = module.app
+        with tempfile.TemporaryDirectory() as tmp:
+            restore = isolated_state[name](module, tmp) if name in isolated_state else None
+            await app.router.startup()
+            try:
+                for endpoint in endpoints[name]:
+                    key = f'{name} {endpoint.method} {endpoint.path}'
+                    count = max(int(requests * endpoint.weight), concurrency)
+                    results[key] = await measure(app, endpoint, count, concurrency)
+                    print(format_result(key, results[key]), file=sys.stderr)
+            finally:
+                await app.router.shutdown()
+                if restore is not None:
+                    restore()
+    return results
+
+
+def format_result(key: str, result: Dict[str, float]) -> str:
+    return (f'{key:<70} {result["rps"]:9.0f} rps  p50 {result["p50_ms"]:7.2f}ms  '
+            f'p95 {result["p95_ms"]:7.2f}ms  p99 {result["p99_ms"]:7.2f}ms  alloc {result["alloc_peak_kb"]:8.1f}KB'
+            + (f'  errors {result["errors"]}' if result.get('errors') else ''))
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """返回超出容差的回归项"""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f'{key}: rps {base["rps"]:.0f} -> {result["rps"]:.0f}')
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f'{key}: p99 {base["p99_ms"]:.2f}ms -> {result["p99_ms"]:.2f}ms')
+        if result.get('errors', 0) > base.get('errors', 0):
+            regressions.append(f'{key}: errors {base.get("errors", 0)} -> {result["errors"]}')
+    return regressions
+
+
+def test_asgi_request():
+    import c01_first_steps
+    status, body = asyncio.run(asgi_request(c01_first_steps.app, Endpoint('GET', '/')))
+    assert status == 200
+    assert json.loads(body) == {'message': 'hello world'}
+
+
+def test_json_factory():
+    """json 为函数时每个请求生成新的请求体"""
+    import c14_response_model
+    assert new_user_in()['username'] != new_user_in()['username']
+    users = iter(['leo', 'dave'])
+    endpoint = Endpoint('POST', '/users/', json=lambda: {'user_name': next(users), 'password': 'p', 'email': 'e'})
+    for name in ('leo', 'dave'):
+        status, body = asyncio.run(asgi_request(c14_response_model.app, endpoint))
+        assert status == 200
+        assert json.loads(body)['user_name'] == name
+
+
+def test_measure_errors():
+    """非 2xx 的响应单独计数, 不计入 RPS 与延迟"""
+    statuses = itertools.cycle([200, 503])
+
+    async def flaky(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': next(statuses), 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    result = asyncio.run(measure(flaky, Endpoint('GET', '/'), 10, 2))
+    assert (result['requests'], result['errors']) == (5, 5)
+    assert compare({'flaky': result}, {'flaky': {**result, 'errors': 0}}, 0.2) == ['flaky: errors 0 -> 5']
+
+
+def test_isolated_state():
+    """c15 的注册写入临时数据库, 压测后恢复原来的 user_writer"""
+    import c15_extra_models
+    writer = c15_extra_models.user_writer
+    results = asyncio.run(run(['c15_extra_models'], requests=20, concurrency=2))
+    assert results['c15_extra_models POST /user/']['errors'] == 0
+    assert c15_extra_models.user_writer is writer
+    assert writer.records == 0
+
+
+def test_run_and_compare():
+    results = asyncio.run(run(['c01_first_steps'], requests=50, concurrency=5))
+    result = results['c01_first_steps GET /']
+    assert result['requests'] == 50
+    assert result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+
+    assert compare(results, results, 0.2) == []
+    slower = {key: {**r, 'rps': r['rps'] / 2, 'p99_ms': r['p99_ms'] * 2} for key, r in results.items()}
+    assert len(compare(slower, results, 0.2)) == 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='进程内压测各章节应用')
+    parser.add_argument('--only', nargs='*', help='模块名前缀, 如 c02 c03')
+    parser.add_argument('--requests', type=int, default=2000, help='每个接口的请求数')
+    parser.add_argument('--concurrency', type=int, default=50, help='并发协程数')
+    parser.add_argument('--baseline', help='与该基线文件对比')
+    parser.add_argument('--save-baseline', help='将结果保存为基线文件')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的相对变化, 默认 0.2')
+    args = parser.parse_args()
+
+    modules = [m for m in endpoints if not args.only or any(m.startswith(prefix) for prefix in args.only)]
+    results = asyncio.run(run(modules, args.requests, args.concurrency))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+# coding: utf-8
+
+"""按路由统计的延迟直方图, 以 Prometheus 文本格式在 `/metrics` 输出
+
+`use_metrics(app)` 为 app 添加 `MetricsMiddleware` 并替换其路由, 之后:
+
+1. `http_request_duration_seconds`: 每个请求的总耗时 (含响应体发送), 标签为路由模板 (如 `/items/{item_id}`,
+   而不是实际路径, 避免标签数量无限增长), 方法和状态码. 没有匹配到路由的请求, 路由记为 `<unmatched>`
+
+2. `http_request_phase_seconds`: 路由内各阶段的耗时, phase 为
+   body (读取请求体), validation (解析请求体, 依赖项与参数校验), handler (视图函数), serialization (响应模型校验与编码)
+
+3. `http_requests_in_flight`: 各路由正在处理的请求数
+
+直方图的桶固定为 100us 起按 2 倍递增的 17 个上界 (约 6.5s), 加上 +Inf. 记录一次只需一次二分查找和两次加法.
+
+阶段的划分由路由类 `MetricsRouteMixin` 实现: 先读取请求体 (FastAPI 之后直接使用已读取的内容),
+并包装路由的 `dependant.call`, 在视图函数前后记录时间点; 不影响其他应用的路由.
+路由类本身在 `dependant.call` 中生成响应时 (如 c14 的 SerializedRoute, fast_json 的 CodecRoute), 编码计入 handler.
+
+    python metrics.py
+"""
+
+import asyncio
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request, params
+from fastapi.routing import APIRoute, request_response
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+buckets = tuple(0.0001 * 2 ** i for i in range(17))
+phases = ('body', 'validation', 'handler', 'serialization')
+route_key = 'metrics.route'
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # 最后一个为 +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    def __init__(self):
+        self.durations: Dict[Tuple[str, str, int], Histogram] = {}
+        self.phases: Dict[Tuple[str, str, str], Histogram] = {}
+        self.in_flight: Dict[Tuple[str, str], int] = {}
+        # 其他模块 (如 thread_pools) 注册的输出函数, 返回 Prometheus 文本
+        self.collectors: List[Callable[[], str]] = []
+
+    def observe(self, table: Dict[Tuple, Histogram], key: Tuple, value: float):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram()
+        histogram.observe(value)
+
+    def render(self) -> str:
+        lines = []
+        render_histogram(lines, 'http_request_duration_seconds', 'Request latency by route template.',
+                         ('route', 'method', 'status'), self.durations)
+        render_histogram(lines, 'http_request_phase_seconds', 'Time spent in each phase of a route.',
+                         ('route', 'method', 'phase'), self.phases)
+        lines.append('# HELP http_requests_in_flight Requests currently being handled by a route.')
+        lines.append('# TYPE http_requests_in_flight gauge')
+        for key, value in sorted(self.in_flight.items()):
+            lines.append(f'http_requests_in_flight{{{format_labels(("route", "method"), key)}}} {value}')
+        return '\n'.join(lines) + '\n' + ''.join(collector() for collector in self.collectors)
+
+
+def render_histogram(lines: List[str], name: str, help_: str, label_names: Tuple[str, ...],
+                     table: Dict[Tuple, Histogram]):
+    lines.append(f'# HELP {name} {help_}')
+    lines.append(f'# TYPE {name} histogram')
+    for key, histogram in sorted(table.items()):
+        labels = format_labels(label_names, key)
+        total = 0
+        for bound, count in zip(buckets + (float('inf'),), histogram.counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(round(bound, 7))
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {total}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.sum!r}')
+        lines.append(f'{name}_count{{{labels}}} {total}')
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    def escape(value: Any) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+metrics = Metrics()
+
+# 当前请求在路由内各阶段的时间点, 不在统计中时为 None
+marks_var: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar('metrics_marks', default=None)
+perf_counter = time.perf_counter
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp, metrics: Metrics = metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.observe(self.metrics.durations,
+                                 (scope.get(route_key, '<unmatched>'), scope['method'], status),
+                                 perf_counter() - start)
+
+
+class MetricsRouteMixin(APIRoute):
+    """在路由的处理函数外记录各阶段的时间点与正在处理的请求数
+
+    放在其他路由类之后 (见 `instrument_routes`), 其他路由类包装的请求与 dependant.call 在外层
+    """
+
+    metrics: Metrics = metrics
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        self._time_endpoint()
+        handler = super().get_route_handler()
+        path_format = self.path_format
+        metrics_ = self.metrics
+        in_flight = metrics_.in_flight
+        # 表单由 FastAPI 解析, 不预先读取
+        read_body = self.body_field is not None and not isinstance(self.body_field.field_info, params.Form)
+        # (root_path, method) -> (路由模板, 各阶段的直方图), 避免每个请求拼接字符串和查找标签
+        cache: Dict[Tuple[str, str], Tuple[str, Tuple[Histogram, ...]]] = {}
+
+        def histograms(root_path: str, method: str) -> Tuple[str, Tuple[Histogram, ...]]:
+            route = root_path + path_format
+            table = metrics_.phases
+            for phase in phases:
+                table.setdefault((route, method, phase), Histogram())
+            cache[root_path, method] = route, tuple(table[route, method, phase] for phase in phases)
+            return cache[root_path, method]
+
+        async def metrics_route_handler(request: Request) -> Response:
+            scope = request.scope
+            method = scope['method']
+            root_path = scope.get('root_path', '')
+            route, phase_histograms = cache.get((root_path, method)) or histograms(root_path, method)
+            scope[route_key] = route
+            key = (route, method)
+            in_flight[key] = in_flight.get(key, 0) + 1
+            marks = [perf_counter()]
+            token = marks_var.set(marks)
+            try:
+                if read_body:
+                    try:
+                        await request.body()
+                    except Exception:
+                        # 由 FastAPI 再次读取时按原来的方式返回错误
+                        pass
+                marks.append(perf_counter())
+                return await handler(request)
+            finally:
+                marks.append(perf_counter())
+                marks_var.reset(token)
+                in_flight[key] -= 1
+                # marks 依次为开始, 读取请求体, 调用视图函数, 视图函数返回, 结束;
+                # 出错时 (如参数校验失败) 中间的时间点不全, 只记录已完成的阶段
+                for histogram, begin, end in zip(phase_histograms, marks, marks[1:]):
+                    histogram.observe(end - begin)
+
+        return metrics_route_handler
+
+    def _time_endpoint(self):
+        dependant = self.dependant
+        # 重新生成处理函数时不重复包装
+        call = getattr(dependant.call, 'metrics_endpoint', dependant.call)
+        is_coroutine = asyncio.iscoroutinefunction(call)
+
+        @functools.wraps(call)
+        async def timed_call(**values):
+            marks = marks_var.get()
+            if marks is not None:
+                marks.append(perf_counter())
+            try:
+                if is_coroutine:
+                    return await call(**values)
+                return await run_in_threadpool(call, **values)
+            finally:
+                if marks is not None:
+                    marks.append(perf_counter())
+
+        timed_call.metrics_endpoint = call
+        dependant.call = timed_call
+
+
+_route_classes: Dict[type, type] = {}
+
+
+def instrument_routes(app: FastAPI, metrics_: Metrics = metrics):
+    """替换 app 中已有的 APIRoute (含其子类, 如 fast_json 的 CodecRoute)"""
+    for route in app.routes:
+        if not isinstance(route, APIRoute) or isinstance(route, MetricsRouteMixin):
+            continue
+        cls = type(route)
+        if cls not in _route_classes:
+            bases = (MetricsRouteMixin,) if cls is APIRoute else (cls, MetricsRouteMixin)
+            _route_classes[cls] = type(f'Metrics{cls.__name__}', bases, {})
+        route.__class__ = _route_classes[cls]
+        route.metrics = metrics_
+        route.app = request_response(route.get_route_handler())
+
+
+def use_metrics(app: FastAPI, metrics_: Metrics = metrics, path: str = '/metrics'):
+    """在所有路由注册之后调用"""
+    instrument_routes(app, metrics_)
+    app.add_middleware(MetricsMiddleware, metrics=metrics_)
+
+    async def read_metrics(request: Request) -> Response:
+        return Response(metrics_.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+    app.add_route(path, read_metrics, include_in_schema=False)
+
+
+class Item(BaseModel):
+    name: str
+    price: float
+
+
+app = FastAPI()
+
+
+@app.get('/items/{item_id}')
+async def read_item(item_id: int):
+    return {'item_id': item_id}
+
+
+@app.post('/items/', response_model=Item)
+def create_item(item: Item):
+    time.sleep(0.002)
+    return item
+
+
+app_metrics = Metrics()
+use_metrics(app, app_metrics)
+client = TestClient(app)
+
+
+def test_metrics():
+    for i in range(3):
+        assert client.get(f'/items/{i}').status_code == 200
+    assert client.get('/items/x').status_code == 422
+    assert client.post('/items/', json={'name': 'foo', 'price': 1.5}).status_code == 200
+    assert client.get('/nothing').status_code == 404
+
+    assert app_metrics.durations[('/items/{item_id}', 'GET', 200)].counts[-1] == 0
+    assert sum(app_metrics.durations[('/items/{item_id}', 'GET', 200)].counts) == 3
+    assert sum(app_metrics.durations[('/items/{item_id}', 'GET', 422)].counts) == 1
+    assert sum(app_metrics.durations[('<unmatched>', 'GET', 404)].counts) == 1
+    for phase in phases:
+        assert sum(app_metrics.phases[('/items/', 'POST', phase)].counts) == 1
+    # 同步视图函数中的 sleep 计入 handler
+    assert app_metrics.phases[('/items/', 'POST', 'handler')].sum >= 0.002
+    # 校验失败的请求没有 handler 阶段
+    assert sum(app_metrics.phases[('/items/{item_id}', 'GET', 'validation')].counts) == 4
+    assert sum(app_metrics.phases[('/items/{item_id}', 'GET', 'handler')].counts) == 3
+    assert app_metrics.in_flight == {('/items/{item_id}', 'GET'): 0, ('/items/', 'POST'): 0}
+
+    text = client.get('/metrics').text
+    assert '# TYPE http_request_duration_seconds histogram' in text
+    assert 'http_request_duration_seconds_count{route="/items/{item_id}",method="GET",status="200"} 3' in text
+    assert 'http_request_phase_seconds_bucket{route="/items/",method="POST",phase="handler",le="+Inf"} 1' in text
+    assert 'http_requests_in_flight{route="/items/",method="POST"} 0' in text
+
+
+def test_metrics_scoped():
+    """重新生成处理函数时不重复包装; 未加统计的应用不受影响"""
+    route = next(route for route in app.routes if getattr(route, 'path', None) == '/items/')
+    route.app = request_response(route.get_route_handler())
+    assert route.dependant.call.metrics_endpoint is create_item
+    handler = app_metrics.phases[('/items/', 'POST', 'handler')]
+    count = sum(handler.counts)
+    assert client.post('/items/', json={'name': 'foo', 'price': 1.5}).status_code == 200
+    assert sum(handler.counts) == count + 1
+
+    plain = FastAPI()
+    plain.post('/items/', response_model=Item)(create_item)
+    assert TestClient(plain).post('/items/', json={'name': 'foo', 'price': 1.5}).status_code == 200
+    assert sum(handler.counts) == count + 1
+    assert plain.routes[-1].dependant.call is create_item
+
+
+def bench_overhead(repeat=20_000, rounds=5):
+    """统计本身的开销: 端到端对比同一个应用加上统计前后的耗时, 另单独测量中间件与路由包装的开销"""
+    from loadgen import Endpoint, asgi_request
+
+    def make_app():
+        app = FastAPI()
+
+        @app.get('/items/{item_id}')
+        async def read_item(item_id: int):
+            return {'item_id': item_id}
+
+        return app
+
+    async def run(app):
+        endpoint = Endpoint('GET', '/items/42')
+        start = perf_counter()
+        for _ in range(repeat):
+            await asgi_request(app, endpoint)
+        return (perf_counter() - start) / repeat
+
+    plain = make_app()
+    instrumented = make_app()
+    use_metrics(instrumented, Metrics())
+    # 交替运行多轮取最小值, 减少噪声
+    before, after = [], []
+    for _ in range(rounds):
+        before.append(asyncio.run(run(plain)))
+        after.append(asyncio.run(run(instrumented)))
+    before, after = min(before), min(after)
+    print(f'plain:        {before * 1e6:7.2f}us per request')
+    print(f'instrumented: {after * 1e6:7.2f}us per request  (+{(after - before) * 1e6:.2f}us)')
+
+    # 单独测量: 空的 ASGI 应用外的中间件, 以及空的处理函数外的路由包装
+    async def empty_app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+
+    async def noop(message):
+        pass
+
+    class EmptyRoute(APIRoute):
+        def get_route_handler(self):
+            async def handler(request):
+                return None
+            return handler
+
+    route = type('MetricsEmptyRoute', (MetricsRouteMixin, EmptyRoute), {})('/items/{item_id}', read_item_stub)
+    route.metrics = Metrics()
+    handler = route.get_route_handler()
+    middleware = MetricsMiddleware(empty_app, Metrics())
+    scope = {'type': 'http', 'method': 'GET', 'path': '/items/42', 'root_path': '', 'headers': []}
+
+    async def components():
+        results = {}
+        for name, call in (('empty app', lambda: empty_app(scope, None, noop)),
+                           ('middleware', lambda: middleware(scope, None, noop)),
+                           ('route wrapper', lambda: handler(Request(scope)))):
+            start = perf_counter()
+            for _ in range(repeat):
+                await call()
+            results[name] = (perf_counter() - start) / repeat
+        return results
+
+    results = min((asyncio.run(components()) for _ in range(rounds)), key=lambda r: r['middleware'])
+    print(f'middleware:    +{(results["middleware"] - results["empty app"]) * 1e6:.2f}us')
+    print(f'route wrapper:  {results["route wrapper"] * 1e6:.2f}us (including Request creation)')
+
+
+async def read_item_stub(item_id: int):
+    return {'item_id': item_id}
+
+
+if __name__ == '__main__':
+    bench_overhead()
@@ -0,0 +1,420 @@
+# coding: utf-8
+
+"""GET 路由的响应缓存, 保存编码后的响应体, 带 ETag
+
+如 c15 的 `read_keyword_weights` 每次返回相同的内容, 却每次都要做响应模型校验和 JSON 编码.
+
+1. 视图函数上的 `@cached(ttl, vary)` 标记该路由可以缓存, 需放在其他装饰器的外层 (即最上方的 `@app.get` 之下).
+   所有路由注册后调用 `use_response_cache(app, cache)` 替换这些路由
+
+2. key 为路径 (含 root_path 与路径参数), 排序后的查询参数, 以及 vary 中指定的请求头的值.
+   命中时直接返回保存的状态码, 响应头和响应体, 不解析依赖项也不调用视图函数 (因此不要缓存依赖项有副作用,
+   或结果因用户而异的路由)
+
+3. 只缓存状态码为 200, 不是流式响应, 没有后台任务和 Set-Cookie 的响应. 响应头中加上由响应体计算的 ETag,
+   请求头 If-None-Match 匹配时返回 304, 带有 ETag, Vary 和 Cache-Control 等响应头
+
+4. `ResponseCache(max_bytes, ttl)` 按响应体与响应头的大小限制总量, 超出时淘汰最久未使用的;
+   `cache.invalidate(*endpoints)` 清除指定视图函数的缓存, 修改数据的视图函数可以用 `@invalidates(cache, *endpoints)`,
+   在其成功返回后清除. 生成响应期间缓存被清除时 (如并发的修改), 不保存该响应
+
+    python response_cache.py
+"""
+
+import asyncio
+import functools
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Coroutine, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from fastapi import FastAPI, Request
+from fastapi.routing import APIRoute, request_response
+from fastapi.testclient import TestClient
+from starlette.responses import Response, StreamingResponse
+
+
+class CacheRule(NamedTuple):
+    ttl: Optional[float]
+    vary: Tuple[str, ...]
+
+
+class CachedResponse(NamedTuple):
+    status_code: int
+    raw_headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    etag: str
+    endpoint: Callable
+    expires: float
+    size: int
+
+
+def cached(ttl: Optional[float] = None, vary: Tuple[str, ...] = ()) -> Callable:
+    """ttl 为 None 时使用 ResponseCache 的默认值, vary 为参与 key 的请求头"""
+
+    def decorator(func: Callable) -> Callable:
+        func.response_cache = CacheRule(ttl, tuple(name.lower() for name in vary))
+        return func
+
+    return decorator
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = 16 * 2 ** 20, ttl: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: 'OrderedDict[Tuple, CachedResponse]' = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        # 清除时递增, 见 generation
+        self._cleared = 0
+        self._generations: Dict[Callable, int] = {}
+
+    def generation(self, endpoint: Callable) -> Tuple[int, int]:
+        """生成响应前取得, 保存时与当时的值比较, 不同说明期间缓存被清除, 响应可能已过时"""
+        return self._cleared, self._generations.get(endpoint, 0)
+
+    def get(self, key: Tuple) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple, response: Response, endpoint: Callable, ttl: Optional[float] = None,
+            vary: Tuple[str, ...] = (), generation: Optional[Tuple[int, int]] = None) -> CachedResponse:
+        body = response.body
+        etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+        raw_headers = [*response.raw_headers, (b'etag', etag.encode('latin-1'))]
+        if vary:
+            raw_headers.append((b'vary', ', '.join(vary).encode('latin-1')))
+        size = len(body) + sum(len(name) + len(value) for name, value in raw_headers)
+        entry = CachedResponse(response.status_code, raw_headers, body, etag, endpoint,
+                               self.clock() + (self.ttl if ttl is None else ttl), size)
+        if size > self.max_bytes or (generation is not None and generation != self.generation(endpoint)):
+            return entry
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return entry
+
+    def _remove(self, key: Tuple):
+        self.bytes -= self._entries.pop(key).size
+
+    def invalidate(self, *endpoints: Callable) -> int:
+        """清除指定视图函数的缓存, 不指定时清除全部, 返回清除的条数"""
+        if not endpoints:
+            removed = len(self._entries)
+            self.clear()
+            return removed
+        for endpoint in endpoints:
+            self._generations[endpoint] = self._generations.get(endpoint, 0) + 1
+        keys = [key for key, entry in self._entries.items() if entry.endpoint in endpoints]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        self._cleared += 1
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'evictions': self.evictions,
+        }
+
+
+def invalidates(cache: ResponseCache, *endpoints: Callable) -> Callable:
+    """视图函数成功返回后清除 endpoints 的缓存, 放在 `@app.xxx` 之下"""
+
+    def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                result = await func(*args, **kwargs)
+                cache.invalidate(*endpoints)
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                result = func(*args, **kwargs)
+                cache.invalidate(*endpoints)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 按弱比较, 经 CompressionMiddleware 压缩的响应带的是 `W/` 开头的弱 ETag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+
+def cache_key(request: Request, vary: Tuple[str, ...]) -> Tuple:
+    scope = request.scope
+    query_string = scope['query_string']
+    query = tuple(sorted(parse_qsl(query_string.decode('latin-1'), keep_blank_values=True))) if query_string else ()
+    headers = tuple(request.headers.get(name) for name in vary) if vary else ()
+    return scope.get('root_path', '') + scope['path'], query, headers
+
+
+class CachedBodyResponse(Response):
+    """直接使用保存的响应头与响应体, 不再重新生成"""
+
+    def __init__(self, entry: CachedResponse):
+        self.status_code = entry.status_code
+        self.body = entry.body
+        # 之后的中间件可能修改响应头
+        self.raw_headers = list(entry.raw_headers)
+        self.background = None
+
+
+# 304 响应需要带上的响应头, 见 RFC 7232 4.1
+not_modified_headers = {b'cache-control', b'content-location', b'date', b'etag', b'expires', b'vary'}
+
+
+class NotModifiedResponse(Response):
+    def __init__(self, entry: CachedResponse):
+        self.status_code = 304
+        self.body = b''
+        self.raw_headers = [(name, value) for name, value in entry.raw_headers if name in not_modified_headers]
+        self.background = None
+
+
+def cacheable(response: Response) -> bool:
+    return (response.status_code == 200 and not isinstance(response, StreamingResponse)
+            and isinstance(getattr(response, 'body', None), bytes) and response.background is None
+            and all(name != b'set-cookie' for name, _ in response.raw_headers))
+
+
+class CachedRouteMixin:
+    response_cache: ResponseCache
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        rule: Optional[CacheRule] = getattr(self.endpoint, 'response_cache', None)
+        if rule is None:
+            return handler
+        cache = self.response_cache
+        endpoint = self.endpoint
+
+        async def cached_route_handler(request: Request) -> Response:
+            if request.scope['method'] != 'GET':
+                return await handler(request)
+            key = cache_key(request, rule.vary)
+            entry = cache.get(key)
+            if entry is None:
+                generation = cache.generation(endpoint)
+                response = await handler(request)
+                if not cacheable(response):
+                    return response
+                entry = cache.put(key, response, endpoint, rule.ttl, rule.vary, generation)
+            if etag_matches(request.headers.get('if-none-match', ''), entry.etag):
+                cache.not_modified += 1
+                return NotModifiedResponse(entry)
+            return CachedBodyResponse(entry)
+
+        return cached_route_handler
+
+
+_route_classes: Dict[type, type] = {}
+
+
+def use_response_cache(app: FastAPI, cache: ResponseCache):
+    """在所有路由注册之后调用, 替换带有 `@cached` 的路由"""
+    for route in app.routes:
+        if (not isinstance(route, APIRoute) or isinstance(route, CachedRouteMixin)
+                or not hasattr(route.endpoint, 'response_cache')):
+            continue
+        cls = type(route)
+        if cls not in _route_classes:
+            _route_classes[cls] = type(f'Cached{cls.__name__}', (CachedRouteMixin, cls), {})
+        route.__class__ = _route_classes[cls]
+        route.response_cache = cache
+        route.app = request_response(route.get_route_handler())
+
+
+now = [0.0]
+cache = ResponseCache(ttl=60, clock=lambda: now[0])
+calls = {'items': 0, 'greeting': 0}
+items = {'foo': 1.0}
+app = FastAPI()
+
+
+@app.get('/items/{name}', response_model=Dict[str, float])
+@cached()
+async def read_items(name: str, limit: int = 10):
+    calls['items'] += 1
+    if name not in items:
+        return Response(status_code=404)
+    return {name: items[name], 'limit': limit}
+
+
+@app.put('/items/{name}')
+@invalidates(cache, read_items)
+def put_item(name: str, value: float):
+    items[name] = value
+    return {name: value}
+
+
+@app.get('/greeting')
+@cached(ttl=10, vary=('Accept-Language',))
+def read_greeting(request: Request, response: Response):
+    calls['greeting'] += 1
+    response.headers['cache-control'] = 'max-age=10'
+    return {'message': 'hallo' if request.headers.get('accept-language') == 'de' else 'hello'}
+
+
+use_response_cache(app, cache)
+client = TestClient(app)
+
+
+def test_response_cache():
+    resp = client.get('/items/foo?limit=2&x=1')
+    assert resp.json() == {'foo': 1.0, 'limit': 2.0}
+    etag = resp.headers['etag']
+    # 查询参数的顺序不影响 key
+    assert client.get('/items/foo?x=1&limit=2').headers['etag'] == etag
+    assert calls['items'] == 1
+    assert client.get('/items/foo').json() == {'foo': 1.0, 'limit': 10.0}
+    assert calls['items'] == 2
+
+    resp = client.get('/items/foo?limit=2&x=1', headers={'if-none-match': etag})
+    assert resp.status_code == 304
+    assert resp.headers['etag'] == etag
+    assert client.get('/items/foo?limit=2&x=1', headers={'if-none-match': f'W/{etag}'}).status_code == 304
+    assert calls['items'] == 2
+
+    # 非 200 的响应不缓存
+    assert client.get('/items/bar').status_code == 404
+    assert client.get('/items/bar').status_code == 404
+    assert calls['items'] == 4
+
+    # 修改后清除
+    assert client.put('/items/foo?value=2').status_code == 200
+    assert client.get('/items/foo?limit=2&x=1').json() == {'foo': 2.0, 'limit': 2.0}
+    assert calls['items'] == 5
+
+    assert client.get('/greeting', headers={'accept-language': 'de'}).json() == {'message': 'hallo'}
+    resp = client.get('/greeting')
+    assert resp.json() == {'message': 'hello'}
+    assert resp.headers['vary'] == 'accept-language'
+    assert client.get('/greeting').json() == {'message': 'hello'}
+    assert calls['greeting'] == 2
+    # 304 带有 Vary 与 Cache-Control, 不带 Content-Type 等
+    resp = client.get('/greeting', headers={'if-none-match': resp.headers['etag']})
+    assert resp.status_code == 304
+    assert resp.headers['vary'] == 'accept-language'
+    assert resp.headers['cache-control'] == 'max-age=10'
+    assert 'content-type' not in resp.headers
+    # 超过路由自己的 ttl
+    now[0] = 11
+    client.get('/greeting')
+    assert calls['greeting'] == 3
+
+    assert cache.stats() == {'size': 3, 'bytes': cache.bytes, 'hits': 5, 'misses': 8, 'not_modified': 3,
+                             'evictions': 0}
+
+
+def test_invalidate_during_miss():
+    """生成响应期间缓存被清除 (如并发的 PUT) 时, 不保存清除之前生成的响应"""
+    global items
+
+    class ModifiedWhileReading(dict):
+        def __getitem__(self, name):
+            value = super().__getitem__(name)
+            # 读取之后, 保存响应之前数据被修改
+            put_item(name, value + 1)
+            return value
+
+    original = items
+    items = ModifiedWhileReading(original)
+    try:
+        stale = client.get('/items/foo').json()
+    finally:
+        original.update(items)
+        items = original
+    calls['items'] = 0
+    assert client.get('/items/foo').json() == {'foo': stale['foo'] + 1, 'limit': 10.0}
+    assert client.get('/items/foo').json() == {'foo': stale['foo'] + 1, 'limit': 10.0}
+    assert calls['items'] == 1
+
+
+def test_memory_bound():
+    cache.clear()
+    max_bytes, cache.max_bytes = cache.max_bytes, 2000
+    try:
+        for limit in range(20):
+            client.get(f'/items/foo?limit={limit}')
+        assert cache.bytes <= 2000
+        assert 0 < len(cache._entries) < 20
+        assert cache.evictions == 20 - len(cache._entries)
+        # 最近使用的保留
+        calls['items'] = 0
+        client.get('/items/foo?limit=19')
+        assert calls['items'] == 0
+        client.get('/items/foo?limit=0')
+        assert calls['items'] == 1
+        assert cache.invalidate() > 0
+        assert cache.bytes == 0
+    finally:
+        cache.max_bytes = max_bytes
+
+
+def bench_hit_path(repeat=20_000, rounds=5):
+    """c15 `/keyword-weights/` 未缓存, 缓存命中和返回 304 时每个请求的耗时"""
+    from fastapi import FastAPI
+
+    import c15_extra_models
+    from loadgen import Endpoint, asgi_request
+
+    uncached = FastAPI()
+    uncached.get('/keyword-weights/', response_model=Dict[str, float])(c15_extra_models.read_keyword_weights)
+    etag = c15_extra_models.client.get('/keyword-weights/').headers['etag']
+    cases = [
+        ('uncached', uncached, Endpoint('GET', '/keyword-weights/')),
+        ('cache hit', c15_extra_models.app, Endpoint('GET', '/keyword-weights/')),
+        ('304', c15_extra_models.app, Endpoint('GET', '/keyword-weights/', headers={'If-None-Match': etag})),
+    ]
+
+    async def run(app, endpoint):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await asgi_request(app, endpoint)
+        return (time.perf_counter() - start) / repeat
+
+    results = {name: [] for name, _, _ in cases}
+    for _ in range(rounds):
+        for name, app, endpoint in cases:
+            results[name].append(asyncio.run(run(app, endpoint)))
+    base = min(results['uncached'])
+    for name, timings in results.items():
+        best = min(timings)
+        print(f'{name:<10} {best * 1e6:8.1f}us/request  {base / best:5.2f}x')
+
+
+if __name__ == '__main__':
+    bench_hit_path()
@@ -0,0 +1,194 @@
+# coding: utf-8
+
+"""预编译的响应序列化器与流式响应, 供各章节共用
+
+1. `ResponseSerializer` 在启动时按模型和 include/exclude 等参数预先确定输出字段,
+   直接从返回的对象生成 JSON 字节, 输出与 FastAPI 的 response_model 处理结果相同
+
+2. `@stream_response(model)` 允许视图函数返回 (异步) 迭代器, 或本身就是异步生成器, 每个元素产生后即校验并写出:
+   请求头 `Accept` 包含 `application/x-ndjson` 时每行一个 JSON, 否则为分块发送的 JSON 数组
+
+3. `ChunkedResponse` 同 `StreamingResponse`; starlette 0.13 的 `StreamingResponse` 把协程直接交给
+   `asyncio.wait`, Python 3.11 起会报错, 这里改为先包装为任务. 边读请求体边写出响应时指定
+   `watch_disconnect=False`, 不再另外监听断开连接, 以免与读取请求体争用 receive
+"""
+
+import asyncio
+import functools
+import inspect
+import json
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator, Optional, Set, Tuple, Type
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from starlette.responses import Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+json_native_types = (str, int, float, bool)
+ndjson_media_type = 'application/x-ndjson'
+
+
+class ResponseSerializer:
+    """按模型预先编译的序列化器, 输出与 FastAPI 的 response_model 处理结果相同
+
+    - include/exclude 只支持字段名集合
+    - 字段类型为 BaseModel 时递归编译, 为 str, int 等时直接输出, 其他类型交给 jsonable_encoder
+    """
+
+    def __init__(self, model: Type[BaseModel], *, include: Optional[Set[str]] = None,
+                 exclude: Optional[Set[str]] = None, exclude_unset: bool = False,
+                 exclude_none: bool = False, trusted: bool = False):
+        self.model = model
+        self.exclude_unset = exclude_unset
+        self.exclude_none = exclude_none
+        self.trusted = trusted
+        self.fields: Tuple[Tuple[str, str, Callable[[Any], Any]], ...] = tuple(
+            (name, field.alias, self._compile_field(field.outer_type_, exclude_unset, exclude_none))
+            for name, field in model.__fields__.items()
+            if (include is None or name in include) and (exclude is None or name not in exclude)
+        )
+
+    @staticmethod
+    def _compile_field(type_, exclude_unset: bool, exclude_none: bool) -> Callable[[Any], Any]:
+        if isinstance(type_, type) and issubclass(type_, BaseModel):
+            nested = ResponseSerializer(type_, exclude_unset=exclude_unset, exclude_none=exclude_none, trusted=True)
+            return lambda value: value if value is None else nested.to_dict(value)
+        return lambda value: value if isinstance(value, json_native_types) or value is None else jsonable_encoder(
+            value, exclude_unset=exclude_unset, exclude_none=exclude_none
+        )
+
+    def validate(self, obj: Any) -> BaseModel:
+        """与 FastAPI 相同, 先按 exclude_unset 等导出为字典, 再按模型校验"""
+        if isinstance(obj, BaseModel):
+            obj = obj.dict(by_alias=True, exclude_unset=self.exclude_unset, exclude_none=self.exclude_none)
+        return self.model.validate(obj)
+
+    def to_dict(self, obj: Any) -> dict:
+        fields_set = getattr(obj, '__fields_set__', None) if self.exclude_unset else None
+        rv = {}
+        for name, key, encode in self.fields:
+            if fields_set is not None and name not in fields_set:
+                continue
+            value = getattr(obj, name)
+            if value is None and self.exclude_none:
+                continue
+            rv[key] = encode(value)
+        return rv
+
+    def render(self, obj: Any) -> bytes:
+        if not self.trusted:
+            obj = self.validate(obj)
+        return json.dumps(
+            self.to_dict(obj), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+        ).encode("utf-8")
+
+    def response(self, obj: Any, status_code: int = 200) -> Response:
+        return Response(self.render(obj), status_code=status_code, media_type='application/json')
+
+
+class ChunkedResponse(StreamingResponse):
+    """同 StreamingResponse, 客户端断开时停止发送"""
+
+    def __init__(self, *args, watch_disconnect: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.watch_disconnect = watch_disconnect
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not self.watch_disconnect:
+            # 断开连接由读取请求体时的 ClientDisconnect 发现
+            await self.stream_response(send)
+            if self.background is not None:
+                await self.background()
+            return
+        stream = asyncio.ensure_future(self.stream_response(send))
+        disconnect = asyncio.ensure_future(self.listen_for_disconnect(receive))
+        await asyncio.wait((stream, disconnect), return_when=asyncio.FIRST_COMPLETED)
+        for task in (stream, disconnect):
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        if not stream.cancelled():
+            stream.result()
+        if self.background is not None:
+            await self.background()
+
+
+def _ndjson_lines(items: Iterable[Any], render: Callable[[Any], bytes]) -> Iterator[bytes]:
+    for item in items:
+        yield render(item) + b'\n'
+
+
+def _json_array(items: Iterable[Any], render: Callable[[Any], bytes]) -> Iterator[bytes]:
+    separator = b'['
+    for item in items:
+        yield separator + render(item)
+        separator = b','
+    yield b'[]' if separator == b'[' else b']'
+
+
+async def _aiterate(items: Any) -> AsyncIterator[Any]:
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def _ndjson_lines_async(items: Any, render: Callable[[Any], bytes]) -> AsyncIterator[bytes]:
+    async for item in _aiterate(items):
+        yield render(item) + b'\n'
+
+
+async def _json_array_async(items: Any, render: Callable[[Any], bytes]) -> AsyncIterator[bytes]:
+    separator = b'['
+    async for item in _aiterate(items):
+        yield separator + render(item)
+        separator = b','
+    yield b'[]' if separator == b'[' else b']'
+
+
+def stream_response(model: Type[BaseModel], **kwargs):
+    """为返回列表或 (异步) 迭代器的视图函数逐个校验并写出元素, 参数同 ResponseSerializer
+
+    视图函数为 `def` 时仍在线程池中执行, 返回的同步迭代器也在线程池中迭代;
+    为异步生成器时在事件循环中迭代.
+    """
+    serializer = ResponseSerializer(model, **kwargs)
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        request_param = inspect.Parameter('_stream_request', inspect.Parameter.KEYWORD_ONLY, annotation=Request)
+        is_coroutine = asyncio.iscoroutinefunction(func)
+        is_async_gen = inspect.isasyncgenfunction(func)
+
+        def response(items: Any, request: Request) -> StreamingResponse:
+            ndjson = ndjson_media_type in request.headers.get('accept', '')
+            if is_coroutine or hasattr(items, '__aiter__'):
+                body = (_ndjson_lines_async if ndjson else _json_array_async)(items, serializer.render)
+            else:
+                body = (_ndjson_lines if ndjson else _json_array)(items, serializer.render)
+            return ChunkedResponse(body, media_type=ndjson_media_type if ndjson else 'application/json')
+
+        if is_async_gen:
+            @functools.wraps(func)
+            async def wrapper(*args, _stream_request: Request, **kw):
+                return response(func(*args, **kw), _stream_request)
+        elif is_coroutine:
+            @functools.wraps(func)
+            async def wrapper(*args, _stream_request: Request, **kw):
+                return response(await func(*args, **kw), _stream_request)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, _stream_request: Request, **kw):
+                return response(func(*args, **kw), _stream_request)
+
+        wrapper.__signature__ = signature.replace(parameters=[*signature.parameters.values(), request_param])
+        wrapper.serializer = serializer
+        return wrapper
+
+    return decorator
@@ -0,0 +1,312 @@
+# coding: utf-8
+
+"""为同步视图函数指定独立的线程池
+
+`def` 定义的视图函数默认都在同一个线程池中执行: starlette 0.13 的 `run_in_threadpool` 调用
+`loop.run_in_executor(None, ...)`, 即 asyncio 默认的 ThreadPoolExecutor, 线程数为 `min(32, CPU 数 + 4)`
+(改用 anyio 的新版 starlette 默认限制为 40 个线程).
+某个慢的路由占满线程池后, 其他同步路由也只能排队, 且无从得知.
+
+1. `ThreadPool(name, max_workers, max_queue)` 为一组路由的线程池, 排队的任务超过 max_queue 时拒绝,
+   视图函数返回 503. name 不能重复
+
+2. `@run_in_pool(pool)` 将同步视图函数改为在该线程池中执行 (对 FastAPI 而言变成了 `async def`),
+   放在 `@app.xxx` 与其他装饰器之间
+
+3. 统计各线程池的排队时间 (直方图), 正在执行和排队的任务数, 完成与拒绝的次数,
+   通过 metrics 的 `/metrics` 输出, 或 `stats()` 获得
+
+    python thread_pools.py
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import pytest
+from fastapi import HTTPException
+
+from metrics import Histogram, format_labels, metrics, render_histogram
+
+
+class PoolRejected(Exception):
+    pass
+
+
+class ThreadPool:
+    def __init__(self, name: str, max_workers: int, max_queue: Optional[int] = None):
+        if name in pools:
+            raise ValueError(f'thread pool {name!r} already exists')
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_wait = Histogram()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        pools[name] = self
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=f'pool-{self.name}')
+        return self._executor
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        if self.max_queue is not None and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise PoolRejected(self.name)
+        submitted = time.perf_counter()
+        context = contextvars.copy_context()
+
+        def call():
+            # 只统计实际执行的任务, 在工作线程中持锁更新
+            with self._lock:
+                self.queue_wait.observe(time.perf_counter() - submitted)
+                self.queued -= 1
+                self.active += 1
+            try:
+                return context.run(func, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        def done(future: Future):
+            if future.cancelled():
+                # 排队时被取消 (如客户端断开), call 不会再执行
+                with self._lock:
+                    self.queued -= 1
+
+        with self._lock:
+            self.queued += 1
+        try:
+            future = self.executor.submit(call)
+        except BaseException:
+            with self._lock:
+                self.queued -= 1
+            raise
+        future.add_done_callback(done)
+        # 等待的协程被取消时, 尚未开始执行的任务随之取消
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        count = sum(self.queue_wait.counts)
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'active': self.active,
+            'queued': self.queued,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'queue_wait_avg': self.queue_wait.sum / count if count else 0.0,
+        }
+
+
+pools: Dict[str, ThreadPool] = {}
+
+# asyncio 默认线程池 (ThreadPoolExecutor 未指定 max_workers) 的线程数
+default_max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+
+def run_in_pool(pool: ThreadPool) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+            raise TypeError(f'{func.__qualname__} is already a coroutine function')
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await pool.run(func, *args, **kwargs)
+            except PoolRejected:
+                raise HTTPException(status_code=503, detail=f'Thread pool {pool.name!r} is full, retry later')
+
+        return wrapper
+
+    return decorator
+
+
+def render_pools() -> str:
+    if not pools:
+        return ''
+    lines = []
+    render_histogram(lines, 'thread_pool_queue_wait_seconds', 'Time tasks wait for a worker thread.',
+                     ('pool',), {(name,): pool.queue_wait for name, pool in pools.items()})
+    for name, help_, type_, attr in (
+            ('thread_pool_max_workers', 'Configured worker threads.', 'gauge', 'max_workers'),
+            ('thread_pool_active_workers', 'Worker threads running a task.', 'gauge', 'active'),
+            ('thread_pool_queued_tasks', 'Tasks waiting for a worker thread.', 'gauge', 'queued'),
+            ('thread_pool_completed_total', 'Tasks finished.', 'counter', 'completed'),
+            ('thread_pool_rejected_total', 'Tasks rejected because the queue was full.', 'counter', 'rejected'),
+    ):
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} {type_}')
+        for pool_name, pool in sorted(pools.items()):
+            lines.append(f'{name}{{{format_labels(("pool",), (pool_name,))}}} {getattr(pool, attr)}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics.collectors.append(render_pools)
+
+
+def test_run_in_pool():
+    pool = ThreadPool('test-pool', max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    @run_in_pool(pool)
+    def blocking(x: int) -> int:
+        release.wait(5)
+        return x * 2
+
+    async def main():
+        first = asyncio.ensure_future(blocking(1))
+        await asyncio.sleep(0.05)
+        assert (pool.active, pool.queued) == (1, 0)
+        second = asyncio.ensure_future(blocking(2))
+        await asyncio.sleep(0.05)
+        assert pool.queued == 1
+        # 排队已满
+        try:
+            await blocking(3)
+        except HTTPException as e:
+            assert e.status_code == 503
+        else:
+            raise AssertionError('expected 503')
+        release.set()
+        return await asyncio.gather(first, second)
+
+    try:
+        assert asyncio.run(main()) == [2, 4]
+        assert pool.stats()['completed'] == 2
+        assert pool.stats()['rejected'] == 1
+        assert sum(pool.queue_wait.counts) == 2
+        assert pool.queue_wait.sum >= 0.05
+        text = metrics.render()
+        assert 'thread_pool_rejected_total{pool="test-pool"} 1' in text
+        assert 'thread_pool_queue_wait_seconds_count{pool="test-pool"} 2' in text
+    finally:
+        pool.shutdown()
+        del pools['test-pool']
+
+
+def test_duplicate_name():
+    pool = ThreadPool('test-duplicate', max_workers=1)
+    try:
+        with pytest.raises(ValueError):
+            ThreadPool('test-duplicate', max_workers=2)
+        assert pools['test-duplicate'] is pool
+    finally:
+        pools.pop('test-duplicate').shutdown()
+
+
+def test_cancel_queued():
+    """排队时被取消的任务不再执行, 也不占用排队名额"""
+    pool = ThreadPool('test-cancel', max_workers=1, max_queue=1)
+    release = threading.Event()
+    calls = []
+
+    @run_in_pool(pool)
+    def blocking(x: int) -> int:
+        calls.append(x)
+        release.wait(5)
+        return x * 2
+
+    async def main():
+        first = asyncio.ensure_future(blocking(1))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(blocking(2))
+        await asyncio.sleep(0.05)
+        assert pool.queued == 1
+        second.cancel()
+        try:
+            await second
+        except asyncio.CancelledError:
+            pass
+        assert (pool.active, pool.queued) == (1, 0)
+        third = asyncio.ensure_future(blocking(3))
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(first, third)
+
+    try:
+        assert asyncio.run(main()) == [2, 6]
+        assert calls == [1, 3]
+        stats = pool.stats()
+        assert (stats['queued'], stats['active'], stats['completed'], stats['rejected']) == (0, 0, 2, 0)
+        assert sum(pool.queue_wait.counts) == 2
+    finally:
+        pool.shutdown()
+        del pools['test-cancel']
+
+
+def bench_isolation(slow_clients=60, fast_requests=100, slow_seconds=0.05):
+    """slow_clients 个客户端持续请求慢的同步路由, 占满线程池时, 另一个快的同步路由的延迟:
+    共用默认线程池 (`default_max_workers` 个线程) 与使用独立线程池 (慢路由的线程数与之相同) 对比"""
+    from fastapi import FastAPI
+
+    from loadgen import Endpoint, asgi_request
+
+    def make_app(isolated: bool) -> FastAPI:
+        app = FastAPI()
+
+        def slow():
+            time.sleep(slow_seconds)
+            return {}
+
+        def fast():
+            return {}
+
+        if isolated:
+            slow = run_in_pool(ThreadPool('bench-slow', max_workers=default_max_workers))(slow)
+            fast = run_in_pool(ThreadPool('bench-fast', max_workers=4))(fast)
+        app.get('/slow')(slow)
+        app.get('/fast')(fast)
+        return app
+
+    async def run(app: FastAPI) -> List[float]:
+        latencies = []
+        done = False
+
+        async def slow_client():
+            while not done:
+                await asgi_request(app, Endpoint('GET', '/slow'))
+
+        slow = [asyncio.ensure_future(slow_client()) for _ in range(slow_clients)]
+        await asyncio.sleep(slow_seconds)
+        for _ in range(fast_requests):
+            start = time.perf_counter()
+            await asgi_request(app, Endpoint('GET', '/fast'))
+            latencies.append(time.perf_counter() - start)
+        done = True
+        await asyncio.gather(*slow)
+        return sorted(latencies)
+
+    print(f'{slow_clients} clients on /slow, dedicated /slow pool {default_max_workers} threads')
+    try:
+        for isolated in (False, True):
+            latencies = asyncio.run(run(make_app(isolated)))
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[int(len(latencies) * 0.99)]
+            name = 'dedicated pools' if isolated else 'shared pool'
+            print(f'{name:<16} /fast p50 {p50 * 1e3:8.2f}ms  p99 {p99 * 1e3:8.2f}ms  (while /slow saturates its pool)')
+    finally:
+        for name in list(pools):
+            if name.startswith('bench-'):
+                pools.pop(name).shutdown()
+
+
+if __name__ == '__main__':
+    bench_isolation()
@@ -0,0 +1,199 @@
+# coding: utf-8
+
+"""事件循环阻塞检测
+
+`async def` 视图函数中的同步调用 (如 c15 `create_user` 中的 `fake_save_user` 及其中的 `print`)
+会阻塞整个事件循环, 所有请求的延迟都随之上升, 但很难从延迟统计中找到原因.
+
+`LoopWatchdog` 在事件循环中运行一个心跳任务, 每 interval 秒记录一次时间; 独立的哨兵线程检查心跳,
+超过 threshold 秒没有更新即认为事件循环被阻塞, 此时通过 `sys._current_frames()` 取得事件循环线程的调用栈,
+即正在阻塞的协程及其调用的同步函数. 调用栈中 `WatchdogMiddleware` 的 scope 用于确定所属的路由.
+每次阻塞记录一次, 写入日志, 并保存最近的 max_reports 条, 由 `/debug/loop-stalls` 返回.
+
+    use_watchdog(app, threshold=0.1)
+"""
+
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Any, Deque, Dict, Optional
+
+from fastapi import FastAPI
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+
+class WatchdogMiddleware:
+    """不做任何处理, 只为在调用栈上留下 scope, 以便确定阻塞发生在哪个请求中"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await self.app(scope, receive, send)
+
+
+middleware_code = WatchdogMiddleware.__call__.__code__
+
+
+def describe_request(frame: Optional[FrameType]) -> Optional[Dict[str, Any]]:
+    """在调用栈中查找最内层的 WatchdogMiddleware, 返回其请求的路由信息"""
+    while frame is not None:
+        if frame.f_code is middleware_code:
+            scope = frame.f_locals.get('scope') or {}
+            endpoint = scope.get('endpoint')
+            return {
+                'method': scope.get('method'),
+                'path': scope.get('root_path', '') + scope.get('path', ''),
+                # 使用了 metrics 时有路由模板
+                'route': scope.get('metrics.route'),
+                'endpoint': endpoint and f'{endpoint.__module__}.{getattr(endpoint, "__qualname__", endpoint)}',
+            }
+        frame = frame.f_back
+    return None
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = 0.1, interval: Optional[float] = None, max_reports: int = 100):
+        self.threshold = threshold
+        self.interval = interval or threshold / 5
+        self.reports: Deque[Dict[str, Any]] = collections.deque(maxlen=max_reports)
+        self.stalls = 0
+        self.max_lag = 0.0
+        self._beat = 0.0
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    async def start(self):
+        """在事件循环中调用"""
+        if self._thread is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat = asyncio.ensure_future(self._run_heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._heartbeat.cancel()
+        await asyncio.gather(self._heartbeat, return_exceptions=True)
+        self._thread.join()
+        self._thread = None
+
+    async def _run_heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        report: Optional[Dict[str, Any]] = None
+        stalled_since = 0.0
+        while not self._stop.wait(self.interval / 2):
+            beat = self._beat
+            lag = time.monotonic() - beat - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if report is None and lag > self.threshold:
+                stalled_since = beat
+                report = self._capture(lag)
+            elif report is not None and beat != stalled_since:
+                # 心跳恢复, 记录阻塞的总时长
+                report['duration'] = beat - stalled_since - self.interval
+                logger.warning('event loop was blocked for %.3fs in %s', report['duration'], report['request'])
+                report = None
+
+    def _capture(self, lag: float) -> Dict[str, Any]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        report = {
+            'time': time.time() - lag,
+            'lag': lag,
+            'duration': None,
+            'request': describe_request(frame),
+            'stack': traceback.format_stack(frame) if frame is not None else [],
+        }
+        del frame
+        self.stalls += 1
+        self.reports.append(report)
+        logger.warning('event loop blocked for more than %.3fs in %s\n%s',
+                       self.threshold, report['request'], ''.join(report['stack']))
+        return report
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'threshold': self.threshold,
+            'stalls': self.stalls,
+            'max_lag': self.max_lag,
+            'reports': list(self.reports),
+        }
+
+
+def use_watchdog(app: FastAPI, threshold: float = 0.1, path: str = '/debug/loop-stalls') -> LoopWatchdog:
+    watchdog = LoopWatchdog(threshold)
+    app.add_middleware(WatchdogMiddleware)
+    app.add_event_handler('startup', watchdog.start)
+    app.add_event_handler('shutdown', watchdog.stop)
+
+    @app.get(path, include_in_schema=False)
+    async def read_loop_stalls():
+        return watchdog.stats()
+
+    return watchdog
+
+
+def test_catch_blocking_create_user(monkeypatch, tmp_path):
+    """c15 的 create_user 在协程中同步调用 fake_save_user, 模拟其中的 print 因输出阻塞而变慢"""
+    import c15_extra_models
+    from loadgen import Endpoint, asgi_request
+
+    writer = c15_extra_models.UserWriter(str(tmp_path / 'users.db'))
+    monkeypatch.setattr(c15_extra_models, 'user_writer', writer)
+
+    def slow_print(*args, **kwargs):
+        time.sleep(0.3)
+
+    monkeypatch.setattr(c15_extra_models, 'print', slow_print, raising=False)
+    watchdog = LoopWatchdog(threshold=0.1)
+    app = WatchdogMiddleware(c15_extra_models.app)
+
+    async def main():
+        await watchdog.start()
+        try:
+            status, _ = await asgi_request(app, Endpoint('POST', '/user/', json=c15_extra_models.user))
+            assert status == 200
+            await asyncio.sleep(0.1)
+        finally:
+            await watchdog.stop()
+            await writer.close()
+
+    asyncio.run(main())
+    reports = [r for r in watchdog.reports if any('slow_print' in line for line in r['stack'])]
+    assert len(reports) == 1
+    report = reports[0]
+    assert report['request']['path'] == '/user/'
+    assert report['request']['endpoint'] == 'c15_extra_models.create_user'
+    stack = ''.join(report['stack'])
+    assert stack.index('create_user') < stack.index('fake_save_user') < stack.index('slow_print')
+    assert report['duration'] >= 0.2
+
+
+def test_no_stall_when_awaiting():
+    watchdog = LoopWatchdog(threshold=0.05)
+
+    async def main():
+        await watchdog.start()
+        await asyncio.sleep(0.3)
+        await watchdog.stop()
+
+    asyncio.run(main())
+    assert watchdog.stalls == 0